@@ -18,6 +18,7 @@ from machina.pols import GaussianPol, CategoricalPol, MultiCategoricalPol, Deter
 from machina.noise import OUActionNoise
 from machina.envs import GymEnv, C2DEnv
 from machina.samplers import EpiSampler
+from machina.traj import epi_file
 from machina import logger
 from machina.utils import measure, set_device
 
@@ -33,6 +34,8 @@ parser.add_argument('--epis_dir', type=str, default='../data/expert_epis',
                     help='Directory path to store file of expert trajectory.')
 parser.add_argument('--epis_fname', type=str, default='',
                     help='File name of expert trajectory.')
+parser.add_argument('--pickle', action='store_true', default=False,
+                    help='If True, epis are pickled instead of saved by epi_file.')
 parser.add_argument('--env_name', type=str,
                     default='Pendulum-v0', help='Name of environment.')
 parser.add_argument('--c2d', action='store_true',
@@ -114,9 +117,14 @@ with open(os.path.join(args.pol_dir, args.pol_fname), 'rb') as f:
 epis = sampler.sample(pol, max_epis=args.num_epis)
 
 filename = args.epis_fname if len(
-    args.epis_fname) != 0 else env.env.spec.id + '_{}epis.pkl'.format(len(epis))
-with open(os.path.join(args.epis_dir, filename), 'wb') as f:
-    pickle.dump(epis, f)
+    args.epis_fname) != 0 else env.env.spec.id + '_{}epis'.format(len(epis))
+if args.pickle:
+    if len(args.epis_fname) == 0:
+        filename += '.pkl'
+    with open(os.path.join(args.epis_dir, filename), 'wb') as f:
+        pickle.dump(epis, f)
+else:
+    epi_file.save_epis(epis, os.path.join(args.epis_dir, filename))
 rewards = [np.sum(epi['rews']) for epi in epis]
 mean_rew = np.mean(rewards)
 logger.log('expert_score={}'.format(mean_rew))
@@ -22,6 +22,8 @@ from machina.vfuncs import DeterministicSVfunc, DeterministicSAVfunc
 from machina.envs import GymEnv, C2DEnv
 from machina.traj import Traj
 from machina.traj import epi_functional as ef
+from machina.traj import traj_functional as tf
+from machina.traj import epi_file
 from machina.samplers import EpiSampler
 from machina import logger
 from machina.utils import measure, set_device
@@ -47,7 +49,7 @@ parser.add_argument('--cuda', type=int, default=-1, help='cuda device number.')
 parser.add_argument('--expert_dir', type=str, default='../data/expert_epis',
                     help='Directory path storing file of expert trajectory.')
 parser.add_argument('--expert_fname', type=str,
-                    default='Pendulum-v0_100epis.pkl', help='Name of pkl file of expert trajectory')
+                    default='Pendulum-v0_100epis.pkl', help='Name of pkl file or directory made by epi_file of expert trajectory')
 
 parser.add_argument('--max_steps_per_iter', type=int, default=50000,
                     help='Number of steps to use in an iteration.')
@@ -179,12 +181,18 @@ sampler = EpiSampler(env, pol, num_parallel=args.num_parallel, seed=args.seed)
 optim_pol = torch.optim.Adam(pol_net.parameters(), args.pol_lr)
 optim_vf = torch.optim.Adam(vf_net.parameters(), args.vf_lr)
 
-with open(os.path.join(args.expert_dir, args.expert_fname), 'rb') as f:
-    expert_epis = pickle.load(f)
-expert_traj = Traj()
-expert_traj.add_epis(expert_epis)
-expert_traj = ef.add_next_obs(expert_traj)
-expert_traj.register_epis()
+expert_path = os.path.join(args.expert_dir, args.expert_fname)
+if os.path.isdir(expert_path):
+    expert_epis = epi_file.load_epis(expert_path)
+    expert_traj = epi_file.load_traj(expert_path)
+    expert_traj = tf.add_next_obs(expert_traj)
+else:
+    with open(expert_path, 'rb') as f:
+        expert_epis = pickle.load(f)
+    expert_traj = Traj()
+    expert_traj.add_epis(expert_epis)
+    expert_traj = ef.add_next_obs(expert_traj)
+    expert_traj.register_epis()
 expert_rewards = [np.sum(epi['rews']) for epi in expert_epis]
 expert_mean_rew = np.mean(expert_rewards)
 logger.log('expert_score={}'.format(expert_mean_rew))
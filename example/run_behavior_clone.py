@@ -18,6 +18,7 @@ from machina.algos import behavior_clone
 from machina.envs import GymEnv, C2DEnv
 from machina.traj import Traj
 from machina.traj import epi_functional as ef
+from machina.traj import epi_file
 from machina.samplers import EpiSampler
 from machina import logger
 from machina.utils import measure, set_device
@@ -44,7 +45,7 @@ parser.add_argument('--rnn', action='store_true',
 
 parser.add_argument('--expert_dir', type=str, default='../data/expert_epis')
 parser.add_argument('--expert_fname', type=str,
-                    default='Pendulum-v0_100epis.pkl')
+                    default='Pendulum-v0_100epis.pkl', help='Name of pkl file or directory made by epi_file of expert trajectory')
 
 parser.add_argument('--max_epis_per_iter', type=int,
                     default=10, help='Number of episodes in an iteration.')
@@ -118,16 +119,24 @@ else:
 sampler = EpiSampler(env, pol, num_parallel=args.num_parallel, seed=args.seed)
 optim_pol = torch.optim.Adam(pol_net.parameters(), args.pol_lr)
 
-with open(os.path.join(args.expert_dir, args.expert_fname), 'rb') as f:
-    expert_epis = pickle.load(f)
-train_epis, test_epis = ef.train_test_split(
-    expert_epis, train_size=args.train_size)
-train_traj = Traj()
-train_traj.add_epis(train_epis)
-train_traj.register_epis()
-test_traj = Traj()
-test_traj.add_epis(test_epis)
-test_traj.register_epis()
+expert_path = os.path.join(args.expert_dir, args.expert_fname)
+if os.path.isdir(expert_path):
+    expert_epis = epi_file.load_epis(expert_path)
+    # same split as ef.train_test_split without copy
+    num_train = int(len(expert_epis) * args.train_size)
+    train_traj = epi_file.load_traj(expert_path, end_epi=num_train)
+    test_traj = epi_file.load_traj(expert_path, start_epi=num_train)
+else:
+    with open(expert_path, 'rb') as f:
+        expert_epis = pickle.load(f)
+    train_epis, test_epis = ef.train_test_split(
+        expert_epis, train_size=args.train_size)
+    train_traj = Traj()
+    train_traj.add_epis(train_epis)
+    train_traj.register_epis()
+    test_traj = Traj()
+    test_traj.add_epis(test_epis)
+    test_traj.register_epis()
 expert_rewards = [np.sum(epi['rews']) for epi in expert_epis]
 expert_mean_rew = np.mean(expert_rewards)
 logger.log('expert_score={}'.format(expert_mean_rew))
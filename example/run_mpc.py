@@ -17,7 +17,7 @@ import machina as mc
 from machina.pols import GaussianPol, CategoricalPol, MultiCategoricalPol, MPCPol, RandomPol
 from machina.algos import mpc
 from machina.vfuncs import DeterministicSVfunc
-from machina.models import DeterministicSModel
+from machina.models import DeterministicSModel, ModelEnsemble
 from machina.envs import GymEnv, C2DEnv
 from machina.traj import Traj
 from machina.traj import epi_functional as ef
@@ -74,6 +74,14 @@ parser.add_argument('--n_samples', type=int, default=1000,
                     help='Number of samples of action sequence in MPC.')
 parser.add_argument('--horizon_of_samples', type=int, default=20,
                     help='Length of horizon of samples of action sequence in MPC.')
+parser.add_argument('--mpc_method', type=str, default='random', choices=['random', 'cem', 'mppi'],
+                    help='Method of planning in MPC.')
+parser.add_argument('--mpc_n_iter', type=int, default=1,
+                    help='Number of iterations of refinement of cem and mppi in MPC.')
+parser.add_argument('--warm_start', action='store_true', default=False,
+                    help='If True, the plan of the previous step is reused in MPC.')
+parser.add_argument('--num_models', type=int, default=1,
+                    help='Number of dynamics models in an ensemble. If more than 1, ModelEnsemble is used.')
 parser.add_argument('--max_epis_per_iter', type=int, default=9,
                     help='Number of episodes in an iteration.')
 parser.add_argument('--epoch_per_iter', type=int, default=60,
@@ -145,13 +153,20 @@ del rand_sampler
 # initialize dynamics model and mpc policy
 if args.rnn:
     dm_net = ModelNetLSTM(ob_space, ac_space)
+    dm = DeterministicSModel(ob_space, ac_space, dm_net, args.rnn,
+                             data_parallel=args.data_parallel, parallel_dim=1)
+elif args.num_models > 1:
+    dm_net = ModelEnsemble(ob_space, ac_space, [ModelNet(
+        ob_space, ac_space) for _ in range(args.num_models)])
+    dm = dm_net
 else:
     dm_net = ModelNet(ob_space, ac_space)
-dm = DeterministicSModel(ob_space, ac_space, dm_net, args.rnn,
-                         data_parallel=args.data_parallel, parallel_dim=1 if args.rnn else 0)
+    dm = DeterministicSModel(ob_space, ac_space, dm_net, args.rnn,
+                             data_parallel=args.data_parallel, parallel_dim=0)
 mpc_pol = MPCPol(ob_space, ac_space, dm_net, rew_func,
                  args.n_samples, args.horizon_of_samples,
-                 mean_obs, std_obs, mean_acs, std_acs, args.rnn)
+                 mean_obs, std_obs, mean_acs, std_acs, args.rnn,
+                 method=args.mpc_method, n_iter=args.mpc_n_iter, warm_start=args.warm_start)
 optim_dm = torch.optim.Adam(dm_net.parameters(), args.dm_lr)
 
 rl_sampler = EpiSampler(
@@ -167,9 +182,10 @@ while args.max_epis > total_epi:
         result_dict = mpc.train_dm(
             traj, dm, optim_dm, epoch=args.epoch_per_iter, batch_size=args.batch_size)
     with measure('sample'):
-        mpc_pol = MPCPol(ob_space, ac_space, dm.net, rew_func,
+        mpc_pol = MPCPol(ob_space, ac_space, dm_net, rew_func,
                          args.n_samples, args.horizon_of_samples,
-                         mean_obs, std_obs, mean_acs, std_acs, args.rnn)
+                         mean_obs, std_obs, mean_acs, std_acs, args.rnn,
+                         method=args.mpc_method, n_iter=args.mpc_n_iter, warm_start=args.warm_start)
         epis = rl_sampler.sample(
             mpc_pol, max_epis=args.max_epis_per_iter)
 
@@ -44,6 +44,8 @@ parser.add_argument('--max_steps_off', type=int,
 parser.add_argument('--num_parallel', type=int, default=4,
                     help='Number of processes to sample.')
 parser.add_argument('--cuda', type=int, default=-1, help='cuda device number.')
+parser.add_argument('--on_host', action='store_true', default=False,
+                    help='If True, off traj is kept in host memory instead of gpu.')
 parser.add_argument('--data_parallel', action='store_true', default=False,
                     help='If True, inference is done in parallel on gpus.')
 
@@ -129,7 +131,8 @@ sampler = EpiSampler(env, pol, num_parallel=args.num_parallel, seed=args.seed)
 
 optim_qf = torch.optim.Adam(qf_net.parameters(), args.qf_lr)
 
-off_traj = Traj(args.max_steps_off)
+off_traj = Traj(args.max_steps_off, on_host=args.on_host,
+                virtual_next_obs=True)
 
 total_epi = 0
 total_step = 0
@@ -45,6 +45,8 @@ parser.add_argument('--max_steps_off', type=int,
 parser.add_argument('--num_parallel', type=int, default=4,
                     help='Number of processes to sample.')
 parser.add_argument('--cuda', type=int, default=-1, help='cuda device number.')
+parser.add_argument('--compact', action='store_true', default=False,
+                    help='If True, masks are stored in bool and hidden states in float16 in off traj.')
 parser.add_argument('--data_parallel', action='store_true', default=False,
                     help='If True, inference is done in parallel on gpus.')
 
@@ -131,7 +133,14 @@ optim_qf2 = torch.optim.Adam(qf_net2.parameters(), args.qf_lr)
 optim_qfs = [optim_qf1, optim_qf2]
 optim_alpha = torch.optim.Adam([log_alpha], args.pol_lr)
 
-off_traj = Traj(args.max_steps_off)
+if args.compact:
+    dtypes = dict(dones=torch.bool, h_masks=torch.bool, hs=torch.half)
+    for i in range(len(qfs)):
+        dtypes['q_hs'+str(i)] = torch.half
+        dtypes['targ_q_hs'+str(i)] = torch.half
+else:
+    dtypes = None
+off_traj = Traj(args.max_steps_off, dtypes=dtypes, virtual_next_obs=True)
 
 total_epi = 0
 total_step = 0
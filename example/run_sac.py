@@ -45,11 +45,15 @@ parser.add_argument('--max_steps_off', type=int,
 parser.add_argument('--num_parallel', type=int, default=4,
                     help='Number of processes to sample.')
 parser.add_argument('--cuda', type=int, default=-1, help='cuda device number.')
+parser.add_argument('--on_host', action='store_true', default=False,
+                    help='If True, off traj is kept in host memory instead of gpu.')
 parser.add_argument('--data_parallel', action='store_true', default=False,
                     help='If True, inference is done in parallel on gpus.')
 
 parser.add_argument('--max_steps_per_iter', type=int, default=10000,
                     help='Number of steps to use in an iteration.')
+parser.add_argument('--async_sampling', action='store_true', default=False,
+                    help='If True, sampling is done while training.')
 parser.add_argument('--batch_size', type=int, default=256)
 parser.add_argument('--sampling', type=int, default=1,
                     help='Number of sampling in calculation of expectation.')
@@ -126,15 +130,23 @@ optim_qf2 = torch.optim.Adam(qf_net2.parameters(), args.qf_lr)
 optim_qfs = [optim_qf1, optim_qf2]
 optim_alpha = torch.optim.Adam([log_alpha], args.pol_lr)
 
-off_traj = Traj(args.max_steps_off)
+off_traj = Traj(args.max_steps_off, on_host=args.on_host,
+                virtual_next_obs=True)
 
 total_epi = 0
 total_step = 0
 max_rew = -1e6
 
+if args.async_sampling:
+    sampler.start_async(pol, max_steps=args.max_steps_per_iter)
+
 while args.max_epis > total_epi:
     with measure('sample'):
-        epis = sampler.sample(pol, max_steps=args.max_steps_per_iter)
+        if args.async_sampling:
+            sampler.publish(pol)
+            epis = sampler.get_epis(max_steps=args.max_steps_per_iter)
+        else:
+            epis = sampler.sample(pol, max_steps=args.max_steps_per_iter)
 
     with measure('train'):
         on_traj = Traj()
@@ -200,4 +212,6 @@ while args.max_epis > total_epi:
     torch.save(optim_qf2.state_dict(), os.path.join(
         args.log, 'models', 'optim_qf2_last.pkl'))
     del on_traj
+if args.async_sampling:
+    sampler.stop_async()
 del sampler
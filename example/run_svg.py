@@ -96,7 +96,7 @@ sampler = EpiSampler(env, pol, args.num_parallel, seed=args.seed)
 optim_pol = torch.optim.Adam(pol_net.parameters(), args.pol_lr)
 optim_qf = torch.optim.Adam(qf_net.parameters(), args.qf_lr)
 
-off_traj = Traj(args.max_steps_off)
+off_traj = Traj(args.max_steps_off, virtual_next_obs=True)
 
 total_epi = 0
 total_step = 0
@@ -53,7 +53,7 @@ def train(traj,
     pol_losses = []
     qf_losses = []
     logger.log("Optimizing...")
-    for batch in traj.random_batch(batch_size, epoch):
+    for batch in traj.prefetch(traj.random_batch(batch_size, epoch)):
         qf_bellman_loss = lf.bellman(qf, targ_qf, targ_pol, batch, gamma)
         optim_qf.zero_grad()
         qf_bellman_loss.backward()
@@ -8,6 +8,7 @@ import torch.nn as nn
 import numpy as np
 
 from machina import loss_functional as lf
+from machina.models import ModelEnsemble
 from machina.utils import detach_tensor_dict
 from machina import logger
 
@@ -21,6 +22,19 @@ def update_dm(dm, optim_dm, batch, target='next_obs', td=True):
     return dm_loss.detach().cpu().numpy()
 
 
+def _bootstrap_batch(traj, num_models, batch_size, epoch):
+    """
+    Batches of shape (num_models, batch_size, *).
+    Each model is given its own minibatch sampled with replacement.
+    """
+    for _ in range(epoch):
+        indices = torch.randint(
+            traj.num_step, (num_models * batch_size, ), dtype=torch.long)
+        batch = traj.random_batch_once(
+            num_models * batch_size, indices=indices)
+        yield {key: value.reshape((num_models, batch_size) + value.shape[1:]) for key, value in batch.items()}
+
+
 def train_dm(traj, dyn_model, optim_dm, epoch=60, batch_size=512, target='next_obs', td=True, num_epi_per_seq=1):
     """
     Train function for dynamics model.
@@ -31,6 +45,7 @@ def train_dm(traj, dyn_model, optim_dm, epoch=60, batch_size=512, target='next_o
         On policy trajectory.
     dyn_model : Model
         dynamics model.
+        If ModelEnsemble, all models are trained together on bootstrapped batches.
     optim_dm : torch.optim.Optimizer
         Optimizer for dynamics model.
     epoch : int
@@ -54,7 +69,10 @@ def train_dm(traj, dyn_model, optim_dm, epoch=60, batch_size=512, target='next_o
     logger.log("Optimizing...")
 
     batch_size = min(batch_size, traj.num_epi)
-    if dyn_model.rnn:
+    if isinstance(dyn_model, ModelEnsemble):
+        iterator = _bootstrap_batch(
+            traj, dyn_model.num_models, batch_size, epoch)
+    elif dyn_model.rnn:
         iterator = traj.random_batch_rnn(
             batch_size=batch_size, epoch=epoch)
     else:
@@ -25,7 +25,7 @@ def train(traj,
         qf_bellman_loss = lf.bellman(
             qf, targ_qf, targ_pol, batch, gamma, reduction='none')
         td_loss = torch.sqrt(qf_bellman_loss*2)
-        qf_bellman_loss = torch.mean(qf_bellman_loss)
+        qf_bellman_loss = torch.mean(qf_bellman_loss * batch['is_weights'])
         optim_qf.zero_grad()
         qf_bellman_loss.backward()
         optim_qf.step()
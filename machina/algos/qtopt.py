@@ -50,9 +50,8 @@ def train(traj,
     qf_losses = []
     logger.log("Optimizing...")
 
-    iterator = traj.random_batch(batch_size, epoch)
-    grad_step = len(list(iterator))
-    for batch in traj.random_batch(batch_size, epoch):
+    grad_step = epoch
+    for batch in traj.prefetch(traj.random_batch(batch_size, epoch)):
         qf_bellman_loss = lf.clipped_double_bellman(
             qf, targ_qf1, targ_qf2, batch, gamma, loss_type=loss_type)
         optim_qf.zero_grad()
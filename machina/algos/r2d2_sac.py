@@ -68,17 +68,21 @@ def train(traj,
         batch, pol_loss, qf_losses, alpha_loss, td_losses = lf.r2d2_sac(
             pol, qfs, targ_qfs, log_alpha, batch, gamma, sampling, burn_in_length, reparam)
 
+        # losses share a graph of fused forwards,
+        # so each of them is backwarded only to its own parameters
         optim_pol.zero_grad()
-        pol_loss.backward()
-        optim_pol.step()
-
-        for optim_qf, qf_loss in zip(optim_qfs, qf_losses):
+        pol_loss.backward(retain_graph=True, inputs=[
+                          p for p in pol.parameters() if p.requires_grad])
+        for optim_qf in optim_qfs:
             optim_qf.zero_grad()
-            qf_loss.backward()
-            optim_qf.step()
-
+        sum(qf_losses).backward(
+            retain_graph=True, inputs=[p for qf in qfs for p in qf.parameters() if p.requires_grad])
         optim_alpha.zero_grad()
-        alpha_loss.backward()
+        alpha_loss.backward(inputs=[log_alpha])
+
+        optim_pol.step()
+        for optim_qf in optim_qfs:
+            optim_qf.step()
         optim_alpha.step()
 
         for qf, targ_qf in zip(qfs, targ_qfs):
@@ -92,11 +96,11 @@ def train(traj,
 
         # update seq_pris
         train_length = seq_length - burn_in_length
-        for i in range(batch_size):
-            start = start_indices[i] + burn_in_length
-            seq_indices = torch.arange(start, start+train_length-1)
-            traj = tf.update_pris(
-                traj, td_losses[:, i], seq_indices, update_epi_pris=True, seq_length=seq_length)
+        starts = torch.as_tensor(start_indices) + burn_in_length
+        # (train_length-1, batch_size) same as td_losses
+        seq_indices = torch.arange(train_length-1).unsqueeze(1) + starts
+        traj = tf.update_pris(
+            traj, td_losses, seq_indices, update_epi_pris=True, seq_length=seq_length)
 
     logger.log("Optimization finished!")
 
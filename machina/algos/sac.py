@@ -8,6 +8,7 @@ import torch.nn as nn
 
 from machina import loss_functional as lf
 from machina import logger
+from machina.vfuncs import EnsembleSAVfunc
 
 
 def train(traj,
@@ -59,21 +60,27 @@ def train(traj,
     _qf_losses = []
     alpha_losses = []
     logger.log("Optimizing...")
-    for batch in traj.random_batch(batch_size, epoch):
+    ensemble_qfs = EnsembleSAVfunc(qfs)
+    ensemble_targ_qfs = EnsembleSAVfunc(targ_qfs)
+    for batch in traj.prefetch(traj.random_batch(batch_size, epoch)):
         pol_loss, qf_losses, alpha_loss = lf.sac(
-            pol, qfs, targ_qfs, log_alpha, batch, gamma, sampling, reparam)
+            pol, ensemble_qfs, ensemble_targ_qfs, log_alpha, batch, gamma, sampling, reparam)
 
+        # losses share a graph of fused forwards,
+        # so each of them is backwarded only to its own parameters
         optim_pol.zero_grad()
-        pol_loss.backward()
-        optim_pol.step()
-
-        for optim_qf, qf_loss in zip(optim_qfs, qf_losses):
+        pol_loss.backward(retain_graph=True, inputs=[
+                          p for p in pol.parameters() if p.requires_grad])
+        for optim_qf in optim_qfs:
             optim_qf.zero_grad()
-            qf_loss.backward()
-            optim_qf.step()
-
+        sum(qf_losses).backward(
+            retain_graph=True, inputs=[p for qf in qfs for p in qf.parameters() if p.requires_grad])
         optim_alpha.zero_grad()
-        alpha_loss.backward()
+        alpha_loss.backward(inputs=[log_alpha])
+
+        optim_pol.step()
+        for optim_qf in optim_qfs:
+            optim_qf.step()
         optim_alpha.step()
 
         for qf, targ_qf in zip(qfs, targ_qfs):
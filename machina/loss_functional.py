@@ -9,6 +9,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from machina.utils import detach_tensor_dict, get_device
+from machina.vfuncs import EnsembleSAVfunc
 
 
 def pg_clip(pol, batch, clip_param, ent_beta):
@@ -215,12 +216,18 @@ def clipped_double_bellman(qf, targ_qf1, targ_qf2, batch, gamma, loss_type='bce'
 def sac(pol, qfs, targ_qfs, log_alpha, batch, gamma, sampling=1, reparam=True, normalize=False, eps=1e-6):
     """
     Loss for soft actor critic.
+    pol is computed for obs and next_obs in one forward,
+    and Q functions are computed for batch and sampled actions in one forward of EnsembleSAVfunc.
+    Since losses share a graph, each of them should be backwarded
+    only to its own parameters with retain_graph as in algos.sac.
 
     Parameters
     ----------
     pol : Pol
-    qfs : list of SAVfunction
-    targ_qfs : list of SAVfunction
+    qfs : list of SAVfunction or EnsembleSAVfunc
+        EnsembleSAVfunc made once should be given in training loop,
+        so that it is not made in every call.
+    targ_qfs : list of SAVfunction or EnsembleSAVfunc
     log_alpha : torch.Tensor
     batch : dict of torch.Tensor
     gamma : float
@@ -234,55 +241,65 @@ def sac(pol, qfs, targ_qfs, log_alpha, batch, gamma, sampling=1, reparam=True, n
 
     Returns
     -------
-    pol_loss, qf_loss, alpha_loss : torch.Tensor, torch.Tensor, torch.Tensor
+    pol_loss, qf_losses, alpha_loss : torch.Tensor, list of torch.Tensor, torch.Tensor
     """
     obs = batch['obs']
     acs = batch['acs']
     rews = batch['rews']
     next_obs = batch['next_obs']
     dones = batch['dones']
+    batch_size = obs.shape[0]
+
+    if not isinstance(qfs, EnsembleSAVfunc):
+        qfs = EnsembleSAVfunc(qfs)
+    if not isinstance(targ_qfs, EnsembleSAVfunc):
+        targ_qfs = EnsembleSAVfunc(targ_qfs)
 
     alpha = torch.exp(log_alpha)
 
     pol.reset()
-    _, _, pd_params = pol(obs)
-    pol.reset()
-    _, _, next_pd_params = pol(next_obs)
+    _, _, pd_params = pol(torch.cat([obs, next_obs], dim=0))
     pd = pol.pd
 
-    sampled_obs = obs.expand([sampling] + list(obs.size()))
-    sampled_next_obs = next_obs.expand([sampling] + list(next_obs.size()))
-
-    sampled_acs = pd.sample(pd_params, torch.Size([sampling]))
-    sampled_next_acs = pd.sample(next_pd_params, torch.Size([sampling]))
-
-    sampled_llh = pd.llh(sampled_acs.detach(), pd_params)
-    sampled_next_llh = pd.llh(sampled_next_acs, next_pd_params)
-
-    sampled_qs = [qf(sampled_obs, sampled_acs)[0] for qf in qfs]
-    sampled_next_targ_qs = [targ_qf(sampled_next_obs, sampled_next_acs)[
-        0] for targ_qf in targ_qfs]
-
-    next_vs = [torch.mean(sampled_next_targ_q - alpha * sampled_next_llh, dim=0)
-               for sampled_next_targ_q in sampled_next_targ_qs]
-    next_v = torch.min(*next_vs)
+    # (sampling, 2 * batch_size, *)
+    all_sampled_acs = pd.sample(pd_params, torch.Size([sampling]))
+    all_sampled_llh = pd.llh(all_sampled_acs.detach(), pd_params)
+    sampled_acs = all_sampled_acs[:, :batch_size]
+    sampled_next_acs = all_sampled_acs[:, batch_size:]
+    sampled_llh = all_sampled_llh[:, :batch_size]
+    sampled_next_llh = all_sampled_llh[:, batch_size:]
 
-    q_targ = rews + gamma * next_v * (1 - dones)
-    q_targ = q_targ.detach()
-
-    qs = [qf(obs, acs)[0] for qf in qfs]
-
-    qf_losses = [0.5 * torch.mean((q - q_targ)**2) for q in qs]
+    with torch.no_grad():
+        sampled_next_obs = next_obs.expand(
+            [sampling] + list(next_obs.size())).reshape((-1, ) + next_obs.shape[1:])
+        # (num_qf, sampling, batch_size)
+        sampled_next_targ_qs, _ = targ_qfs(
+            sampled_next_obs, sampled_next_acs.reshape((-1, ) + sampled_next_acs.shape[2:]))
+        sampled_next_targ_qs = sampled_next_targ_qs.reshape(
+            (-1, sampling, batch_size))
+        next_vs = torch.mean(sampled_next_targ_qs -
+                             alpha * sampled_next_llh, dim=1)
+        next_v = torch.min(next_vs, dim=0)[0]
+        q_targ = rews + gamma * next_v * (1 - dones)
+
+    # Q functions of batch actions and sampled actions at once
+    sampled_obs = obs.expand(
+        [sampling] + list(obs.size())).reshape((-1, ) + obs.shape[1:])
+    all_qs, _ = qfs(torch.cat([obs, sampled_obs], dim=0), torch.cat(
+        [acs, sampled_acs.reshape((-1, ) + sampled_acs.shape[2:])], dim=0))
+    qs = all_qs[:, :batch_size]
+    sampled_qs = all_qs[:, batch_size:].reshape((-1, sampling, batch_size))
+
+    qf_losses = list(0.5 * torch.mean((qs - q_targ)**2, dim=1))
 
     if reparam:
-        pol_losses = [torch.mean(alpha * sampled_llh - sampled_q, dim=0)
-                      for sampled_q in sampled_qs]
-        pol_loss = torch.max(*pol_losses)
+        pol_losses = torch.mean(alpha * sampled_llh - sampled_qs, dim=1)
+        pol_loss = torch.max(pol_losses, dim=0)[0]
         pol_loss = torch.mean(pol_loss)
     else:
-        pg_weights = [torch.mean(
-            alpha * sampled_llh - sampled_q, dim=0).detach() for sampled_q in sampled_qs]
-        pg_weight = torch.max(*pg_weights)
+        pg_weights = torch.mean(
+            alpha * sampled_llh - sampled_qs, dim=1).detach()
+        pg_weight = torch.max(pg_weights, dim=0)[0]
 
         if normalize:
             pg_weight = (pg_weight - pg_weight.mean()) / \
@@ -296,9 +313,35 @@ def sac(pol, qfs, targ_qfs, log_alpha, batch, gamma, sampling=1, reparam=True, n
     return pol_loss, qf_losses, alpha_loss
 
 
+def _repeat_batch(x, n):
+    """
+    (time_seq, batch_size, *) -> (time_seq, n * batch_size, *)
+    """
+    return x.repeat((1, n) + (1, ) * (x.dim() - 2))
+
+
+def _fold_sampling(x):
+    """
+    (sampling, time_seq, batch_size, *) -> (time_seq, sampling * batch_size, *)
+    """
+    return x.transpose(0, 1).reshape((x.shape[1], -1) + x.shape[3:])
+
+
+def _unfold_sampling(x, sampling):
+    """
+    (time_seq, sampling * batch_size) -> (sampling, time_seq, batch_size)
+    """
+    return x.reshape(x.shape[0], sampling, -1).transpose(0, 1)
+
+
 def r2d2_sac(pol, qfs, targ_qfs, log_alpha, batch, gamma, sampling=1, burn_in_length=40, reparam=True, normalize=False, eps=1e-6):
     """
     Loss for soft actor critic.
+    Time, batch and sampling are tensor axes.
+    Sampling is folded into batch axis of rnn, so each network runs
+    one recurrent pass for burn-in and one for train.
+    Since losses share a graph, each of them should be backwarded
+    only to its own parameters with retain_graph as in algos.r2d2_sac.
 
     Parameters
     ----------
@@ -323,145 +366,109 @@ def r2d2_sac(pol, qfs, targ_qfs, log_alpha, batch, gamma, sampling=1, burn_in_le
     pol_loss, qf_loss, alpha_loss, td_losses : torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor
     """
     time_seq, batch_size, *_ = batch['obs'].size()
-    train_length = time_seq - burn_in_length - 1
+    bi = burn_in_length
 
     pol.reset()
     for qf, targ_qf in zip(qfs, targ_qfs):
         qf.reset()
         targ_qf.reset()
 
-    # trajectories for burn-in
-    bi_obs = batch['obs'][:burn_in_length]
-    bi_next_obs = batch['next_obs'][:burn_in_length]
-    bi_acs = batch['acs'][:burn_in_length]
-    bi_h_masks = batch['h_masks'][:burn_in_length]
-    bi_next_h_masks = batch['h_masks'][1:burn_in_length+1]
+    all_obs = batch['obs']
+    all_next_obs = batch['next_obs']
+    all_acs = batch['acs']
+    all_h_masks = batch['h_masks']
 
     # trajectories for train
-    obs = batch['obs'][burn_in_length: -1]
-    acs = batch['acs'][burn_in_length: -1]
-    rews = batch['rews'][burn_in_length: -1]
-    next_obs = batch['next_obs'][burn_in_length: -1]
-    dones = batch['dones'][burn_in_length: -1]
-    h_masks = batch['h_masks'][burn_in_length: -1]
-    next_h_masks = batch['h_masks'][burn_in_length+1:]
-
-    # hidden states (time_seq, batch_size, *, cell_size)
+    rews = batch['rews'][bi: -1]
+    dones = batch['dones'][bi: -1]
+
+    # hidden states (batch_size, cell_size)
     init_a_hs = (batch['hs'][0, :, 0], batch['hs'][0, :, 1])
     init_qf_hs = [(batch['q_hs'+str(i)][0, :, 0], batch['q_hs'+str(i)][0, :, 1])
                   for i in range(len(qfs))]
     init_targ_qf_hs = [(batch['targ_q_hs'+str(i)][0, :, 0],
                         batch['targ_q_hs'+str(i)][0, :, 1]) for i in range(len(targ_qfs))]
 
+    def repeat_hs(hs, n):
+        return (hs[0].repeat(n, 1), hs[1].repeat(n, 1))
+
     alpha = torch.exp(log_alpha)
 
+    # pd_params of all steps, (time_seq, batch_size, *)
     pol.hs = init_a_hs
-    # (time_seq, ['mean', 'log_std', 'hs'], *)
-    with torch.no_grad():
-        _bi_pd_params = pol(bi_obs, h_masks=bi_h_masks)[-1]
-        keys = sorted(_bi_pd_params.keys())
-        keys.remove('hs')
-        separated_bi_pd_params = [_bi_pd_params[key] for key in keys]
-        bi_pd_params = []
-        for params in zip(*separated_bi_pd_params):
-            params_dict = {key: param for key, param in zip(
-                keys, params)}
-            bi_pd_params.append(params_dict)
-
-    _pd_params = pol(obs, h_masks=h_masks)[-1]
-    keys = sorted(_pd_params.keys())
-    keys.remove('hs')
-    separated_pd_params = [_pd_params[key] for key in keys]
-    pd_params = []
-    for params in zip(*separated_pd_params):
-        params_dict = {key: param for key, param in zip(
-            keys, params)}
-        pd_params.append(params_dict)
-
-    bi_next_pd_params = bi_pd_params[1:] + pd_params[0:1]
-    next_pd_params = pd_params[1:] + \
-        [pol(obs[-1:], h_masks=next_h_masks[-1:])[-1]]
-    for key in sorted(pd_params[0].keys()):
-        next_pd_params[-1][key] = next_pd_params[-1][key][0]
+    if bi > 0:
+        with torch.no_grad():
+            bi_pd_params = pol(all_obs[:bi], h_masks=all_h_masks[:bi])[-1]
+    train_pd_params = pol(all_obs[bi:], h_masks=all_h_masks[bi:])[-1]
+    keys = [key for key in train_pd_params if key != 'hs']
+    if bi > 0:
+        pd_params = dict([(key, torch.cat([bi_pd_params[key], train_pd_params[key]], dim=0))
+                          for key in keys])
+    else:
+        pd_params = dict([(key, train_pd_params[key]) for key in keys])
     pd = pol.pd
 
     # (sampling, time_seq, batch_size, *)
-    bi_sampled_obs = bi_obs.expand([sampling] + list(bi_obs.size()))
-    bi_sampled_next_obs = bi_next_obs.expand(
-        [sampling] + list(bi_next_obs.size()))
-    sampled_obs = obs.expand([sampling] + list(obs.size()))
-    sampled_next_obs = next_obs.expand([sampling] + list(next_obs.size()))
-
-    # (time_seq, sampling, 1, batch_size, *)
-    bi_sampled_acs = torch.stack([pd.sample(bi_pd_params[i], torch.Size([sampling]))
-                                  for i in range(burn_in_length)])
-    bi_sampled_next_acs = torch.stack([pd.sample(bi_next_pd_params[i], torch.Size([sampling]))
-                                       for i in range(burn_in_length)])
-    sampled_acs = torch.stack([pd.sample(pd_params[i], torch.Size([sampling]))
-                               for i in range(train_length)])
-    sampled_next_acs = torch.stack([pd.sample(next_pd_params[i], torch.Size([sampling]))
-                                    for i in range(train_length)])
-
-    #    (time_seq, sampling, batch_size, *)
-    # -> (sampling, time_seq, batch_size, *)
-    bi_sampled_acs = bi_sampled_acs.transpose(0, 1)
-    bi_sampled_next_acs = bi_sampled_next_acs.transpose(0, 1)
-    sampled_acs = sampled_acs.transpose(0, 1)
-    sampled_next_acs = sampled_next_acs.transpose(0, 1)
-
-    # (sampling, time_seq, batch_size)
-    sampled_llh = torch.stack(
-        [torch.stack([pd.llh(sampled_acs[s][i].detach(), pd_params[i]) for i in range(train_length)]) for s in range(sampling)])
-    sampled_next_llh = torch.stack(
-        [torch.stack([pd.llh(sampled_next_acs[s][i], next_pd_params[i]) for i in range(train_length)]) for s in range(sampling)])
-
-    # forward of qfs and targ_qfs for burn-in
-    with torch.no_grad():
-        qf_hs = [[qf(bi_sampled_obs[i], bi_sampled_acs[i], hs=init_qf_hs[q],
-                     h_masks=bi_h_masks)[-1]['hs'] for i in range(sampling)] for q, qf in enumerate(qfs)]
-        targ_qf_hs = [[targ_qf(bi_sampled_next_obs[i], bi_sampled_next_acs[i], hs=init_targ_qf_hs[q],
-                               h_masks=bi_next_h_masks)[-1]['hs'] for i in range(sampling)] for q, targ_qf in enumerate(targ_qfs)]
-
-    # forward of qfs and targ_qfs for train
-    # (len(qfs), sampling, time_seq, batch_size)
-    sampled_qs = torch.stack([torch.stack([qf(sampled_obs[s], sampled_acs[s], hs=qf_hs[q][s], h_masks=h_masks)[
-        0] for s in range(sampling)]) for q, qf in enumerate(qfs)])
-    sampled_next_targ_qs = torch.stack([torch.stack([targ_qf(sampled_next_obs[s], sampled_next_acs[s], hs=targ_qf_hs[q][s], h_masks=next_h_masks)[
-        0] for s in range(sampling)]) for q, targ_qf in enumerate(targ_qfs)])
-
-    # (len(qfs), time_seq, batch_size)
-    next_vs = torch.stack([torch.mean(sampled_next_targ_q - alpha * sampled_next_llh, dim=0)
-                           for sampled_next_targ_q in sampled_next_targ_qs])
-
-    # (time-seq, batch_size)
-    next_vs = torch.min(next_vs, dim=0)[0]
-
-    # (time-seq, batch_size)
-    q_targ = rews + gamma * next_vs * (1 - dones)
-    q_targ = q_targ.detach()
-
-    for i in range(len(qfs)):
-        qfs[i].hs = init_qf_hs[i]
+    # next actions of a step are sampled actions of the next step
+    sampled_acs = pd.sample(pd_params, torch.Size([sampling]))
+    all_sampled_llh = pd.llh(sampled_acs.detach(), pd_params)
+    # (sampling, train_length, batch_size)
+    sampled_llh = all_sampled_llh[:, bi:-1]
+    sampled_next_llh = all_sampled_llh[:, bi+1:]
 
-    # (len(qfs), time_seq, batch_size)
+    # target of all qfs, burn-in and train in one pass
     with torch.no_grad():
-        _ = [qf(bi_obs, bi_acs, h_masks=bi_h_masks)[0] for qf in qfs]
-    qs = [qf(obs, acs, h_masks=h_masks)[0] for qf in qfs]
-
-    td_losses = [(q - q_targ) for q in qs]
-    qf_losses = [0.5 * torch.mean((td_loss)**2) for td_loss in td_losses]
-    td_losses = torch.stack([td_loss for td_loss in td_losses])
+        next_obs = _repeat_batch(all_next_obs[:-1], sampling)
+        next_acs = _fold_sampling(sampled_acs[:, 1:])
+        next_h_masks = _repeat_batch(all_h_masks[1:], sampling)
+        # (len(targ_qfs), sampling, train_length, batch_size)
+        sampled_next_targ_qs = torch.stack([_unfold_sampling(targ_qf(next_obs, next_acs, hs=repeat_hs(
+            init_targ_qf_hs[q], sampling), h_masks=next_h_masks)[0][bi:], sampling) for q, targ_qf in enumerate(targ_qfs)])
+
+        # (len(qfs), train_length, batch_size)
+        next_vs = torch.mean(sampled_next_targ_qs -
+                             alpha * sampled_next_llh, dim=1)
+        # (train_length, batch_size)
+        next_vs = torch.min(next_vs, dim=0)[0]
+        q_targ = rews + gamma * next_vs * (1 - dones)
+
+    # sampled actions and batch actions are given at once
+    # (time_seq - 1, (sampling + 1) * batch_size, *)
+    q_obs = _repeat_batch(all_obs[:-1], sampling + 1)
+    q_acs = torch.cat(
+        [_fold_sampling(sampled_acs[:, :-1]), all_acs[:-1]], dim=1)
+    q_h_masks = _repeat_batch(all_h_masks[:-1], sampling + 1)
+    sampled_qs = []
+    qs = []
+    for q, qf in enumerate(qfs):
+        hs = repeat_hs(init_qf_hs[q], sampling + 1)
+        if bi > 0:
+            with torch.no_grad():
+                hs = qf(q_obs[:bi], q_acs[:bi], hs=hs,
+                        h_masks=q_h_masks[:bi])[-1]['hs']
+        vs = qf(q_obs[bi:], q_acs[bi:], hs=hs, h_masks=q_h_masks[bi:])[0]
+        sampled_qs.append(_unfold_sampling(
+            vs[:, :sampling * batch_size], sampling))
+        qs.append(vs[:, sampling * batch_size:])
+    # (len(qfs), sampling, train_length, batch_size)
+    sampled_qs = torch.stack(sampled_qs)
+    # (len(qfs), train_length, batch_size)
+    qs = torch.stack(qs)
+
+    td_losses = qs - q_targ
+    qf_losses = list(
+        0.5 * torch.mean(td_losses.reshape(len(qfs), -1)**2, dim=1))
     td_losses = torch.mean(td_losses, dim=0)
 
     if reparam:
-        pol_losses = [torch.mean(torch.mean(alpha * sampled_llh - sampled_q, dim=0), dim=0)
-                      for sampled_q in sampled_qs]
-        pol_loss = torch.max(*pol_losses)
+        pol_losses = torch.mean(torch.mean(
+            alpha * sampled_llh - sampled_qs, dim=1), dim=1)
+        pol_loss = torch.max(pol_losses, dim=0)[0]
         pol_loss = torch.mean(pol_loss)
     else:
-        pg_weights = [torch.mean(torch.mean(
-            alpha * sampled_llh - sampled_q, dim=0), dim=0).detach() for sampled_q in sampled_qs]
-        pg_weight = torch.max(*pg_weights)
+        pg_weights = torch.mean(torch.mean(
+            alpha * sampled_llh - sampled_qs, dim=1), dim=1).detach()
+        pg_weight = torch.max(pg_weights, dim=0)[0]
 
         if normalize:
             pg_weight = (pg_weight - pg_weight.mean()) / \
@@ -610,7 +617,7 @@ def dynamics(dm, batch, target='next_obs', td=True):
         pred, _ = dm(obs, acs, h_masks=h_masks)
     else:
         out_masks = torch.ones(
-            obs.size()[0], dtype=torch.float, device=get_device())
+            obs.size()[:-1], dtype=torch.float, device=get_device())
         pred, _ = dm(obs, acs)
 
     if target == 'rews' or not td:
@@ -1,2 +1,3 @@
 from machina.models.base import BaseModel
 from machina.models.deterministic_state_model import DeterministicSModel
+from machina.models.model_ensemble import ModelEnsemble
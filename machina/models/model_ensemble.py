@@ -0,0 +1,121 @@
+"""
+Ensemble of Deterministic State Dynamics Models
+"""
+
+import copy
+
+import torch
+import torch.nn as nn
+
+try:
+    from torch.func import functional_call, stack_module_state, vmap
+except ImportError:
+    vmap = None
+
+from machina.models.base import BaseModel
+from machina.utils import get_device
+
+
+class ModelEnsemble(BaseModel):
+    """
+    Ensemble of Deterministic State Dynamics Models.
+    Parameters of networks which have the same architecture are stacked,
+    and all of them are computed in one forward with batched matmul.
+    If torch.func is not available, copied networks are computed one by one.
+
+    Parameters
+    ----------
+    ob_space : gym.Space
+    ac_space : gym.Space
+    nets : list of torch.nn.Module
+        Networks with the same architecture.
+        Their parameters are copied, so they are not updated by training the ensemble.
+    """
+
+    def __init__(self, ob_space, ac_space, nets):
+        super().__init__(ob_space, ac_space, None)
+        self.num_models = len(nets)
+        self.stacked = vmap is not None
+        if not self.stacked:
+            self.nets = nn.ModuleList([copy.deepcopy(net) for net in nets])
+            self.to(get_device())
+            return
+        params, buffers = stack_module_state(nets)
+        self.param_names = list(params.keys())
+        self.params = nn.ParameterList(
+            [nn.Parameter(params[name].detach().clone()) for name in self.param_names])
+        self.buffer_names = list(buffers.keys())
+        for i, name in enumerate(self.buffer_names):
+            self.register_buffer('buffer{}'.format(i), buffers[name].clone())
+        # network without data, which is called with stacked parameters.
+        # it is in a list so that it is not registered as a submodule.
+        self._base_net = [copy.deepcopy(nets[0]).to('meta')]
+        self.to(get_device())
+
+    def _call(self, obs, acs):
+        ob_dim = 0 if obs.dim() == len(self.ob_space.shape) + 2 else None
+        ac_dim = 0 if acs.dim() == len(self.ac_space.shape) + 2 else None
+        if not self.stacked:
+            return torch.stack([net(obs if ob_dim is None else obs[i], acs if ac_dim is None else acs[i])
+                                for i, net in enumerate(self.nets)])
+
+        params = dict(zip(self.param_names, self.params))
+        buffers = {name: getattr(self, 'buffer{}'.format(i))
+                   for i, name in enumerate(self.buffer_names)}
+
+        def call(params, buffers, ob, ac):
+            return functional_call(self._base_net[0], (params, buffers), (ob, ac))
+        return vmap(call, in_dims=(0, 0, ob_dim, ac_dim))(params, buffers, obs, acs)
+
+    def forward(self, obs, acs, hs=None, h_masks=None):
+        """
+        Calculating predictions of all models.
+
+        Parameters
+        ----------
+        obs : torch.Tensor
+            shape (num_models, batch_size, *) or (batch_size, *).
+            In the latter case, all models are given the same inputs.
+        acs : torch.Tensor
+            shape (num_models, batch_size, *) or (batch_size, *).
+
+        Returns
+        -------
+        d_obs, info : torch.Tensor, dict
+            d_obs is of shape (num_models, batch_size, *).
+        """
+        obs = self._check_obs_shape(obs)
+        acs = self._check_acs_shape(acs)
+        d_obs = self._call(obs, acs)
+        return d_obs, dict(mean=d_obs)
+
+    def ts_forward(self, obs, acs):
+        """
+        Calculating predictions with trajectory sampling.
+        i-th row of inputs is predicted by (i % num_models)-th model,
+        so a row keeps the same model over steps of a rollout.
+
+        Parameters
+        ----------
+        obs : torch.Tensor
+            shape (batch_size, *)
+        acs : torch.Tensor
+            shape (batch_size, *)
+
+        Returns
+        -------
+        d_obs : torch.Tensor
+            shape (batch_size, *)
+        """
+        batch_size = obs.shape[0]
+        num_pad = -batch_size % self.num_models
+        if num_pad > 0:
+            obs = torch.cat([obs, obs[:num_pad]], dim=0)
+            acs = torch.cat([acs, acs[:num_pad]], dim=0)
+        obs = obs.reshape((-1, self.num_models) +
+                          obs.shape[1:]).transpose(0, 1)
+        acs = acs.reshape((-1, self.num_models) +
+                          acs.shape[1:]).transpose(0, 1)
+        d_obs = self._call(obs, acs).transpose(0, 1)
+        d_obs = d_obs.reshape((-1, ) + d_obs.shape[2:])
+        return d_obs[:batch_size]
@@ -7,6 +7,8 @@ import torch.nn as nn
 class BasePol(nn.Module):
     """
     Base class of Policy.
+    If use_h_masks is True, which is default for rnn,
+    samplers give h_masks which are 1 at the first step of episodes.
 
     Parameters
     ----------
@@ -33,6 +35,7 @@ class BasePol(nn.Module):
 
         self.rnn = rnn
         self.hs = None
+        self.use_h_masks = rnn
 
         self.normalize_ac = normalize_ac
         self.data_parallel = data_parallel
@@ -2,6 +2,7 @@ import numpy as np
 import torch
 import copy
 
+from machina.models import ModelEnsemble
 from machina.pds import DeterministicPd
 from machina.pols import BasePol
 from machina.utils import get_device
@@ -11,6 +12,10 @@ class MPCPol(BasePol):
     """
     Policy with model predictive control.
 
+    Action sequences of all observations in a batch are planned at once,
+    so this can be used with VecEpiSampler.
+    Buffers of rollouts are allocated once and reused over calls.
+
     Parameters
     ----------
     ob_space : gym.Space
@@ -19,7 +24,9 @@ class MPCPol(BasePol):
         action's space.
         This should be gym.spaces.Box
     net : torch.nn.Module
-        dymamics model
+        dymamics model.
+        If ModelEnsemble, each sample is rolled out by one of the models
+        with trajectory sampling.
     rew_func : function
         rt = rew_func(st+1, at). rt, st+1 and at are torch.tensor.
     n_samples : int
@@ -38,84 +45,217 @@ class MPCPol(BasePol):
         If True, network computation is executed in parallel.
     parallel_dim : int
         Splitted dimension in data parallel.
+    method : str
+        'random', 'cem' or 'mppi'.
+        'random' samples action sequences uniformly and takes the best one.
+        'cem' refines a Gaussian of action sequences by elite samples.
+        'mppi' refines a Gaussian of action sequences by softmax weights of returns.
+    n_iter : int
+        Number of iterations of refinement for 'cem' and 'mppi'.
+    n_elites : int or None
+        Number of elite samples for 'cem'. If None, n_samples // 10 is used.
+    alpha : float
+        Weight of the previous mean and std in updates for 'cem' and 'mppi'.
+    init_std : float or np.array or None
+        Initial std of Gaussian for 'cem' and 'mppi'.
+        If None, quarter of width of ac_space is used.
+    temperature : float
+        Temperature of softmax weights for 'mppi'.
+    warm_start : bool
+        If True, the plan of the previous call shifted by one step is used as
+        the initial mean for 'cem' and 'mppi', or as one of samples for 'random'.
+        The plan is discarded by reset and for observations whose h_masks are 1,
+        and use_h_masks is set so that samplers give h_masks.
     """
 
     def __init__(self, ob_space, ac_space, net, rew_func, n_samples=1000, horizon=20,
                  mean_obs=0., std_obs=1., mean_acs=0., std_acs=1., rnn=False,
-                 normalize_ac=True, data_parallel=False, parallel_dim=0):
+                 normalize_ac=True, data_parallel=False, parallel_dim=0,
+                 method='random', n_iter=1, n_elites=None, alpha=0., init_std=None,
+                 temperature=1., warm_start=False):
         BasePol.__init__(self, ob_space, ac_space, net, rnn=rnn, normalize_ac=normalize_ac,
                          data_parallel=data_parallel, parallel_dim=parallel_dim)
+        if method not in ['random', 'cem', 'mppi']:
+            raise ValueError('method should be random, cem or mppi.')
         self.rew_func = rew_func
         self.n_samples = n_samples
         self.horizon = horizon
+        self.method = method
+        self.n_iter = n_iter if method != 'random' else 1
+        self.n_elites = n_elites if n_elites is not None else max(
+            n_samples // 10, 1)
+        self.alpha = alpha
+        self.temperature = temperature
+        self.warm_start = warm_start
+        self.use_h_masks = rnn or warm_start
         self.to(get_device())
 
-        self.mean_obs = torch.tensor(
-            mean_obs, dtype=torch.float).repeat(n_samples, 1)
-        self.std_obs = torch.tensor(
-            std_obs, dtype=torch.float).repeat(n_samples, 1)
-        self.mean_acs = torch.tensor(
-            mean_acs, dtype=torch.float).repeat(n_samples, 1)
-        self.std_acs = torch.tensor(
-            std_acs, dtype=torch.float).repeat(n_samples, 1)
+        self.mean_obs = torch.tensor(mean_obs, dtype=torch.float)
+        self.std_obs = torch.tensor(std_obs, dtype=torch.float)
+        self.mean_acs = torch.tensor(mean_acs, dtype=torch.float)
+        self.std_acs = torch.tensor(std_acs, dtype=torch.float)
+        self.low = torch.tensor(ac_space.low, dtype=torch.float)
+        self.high = torch.tensor(ac_space.high, dtype=torch.float)
+        if init_std is None:
+            init_std = (ac_space.high - ac_space.low) / 4
+        self.init_std = torch.tensor(
+            init_std, dtype=torch.float).expand(ac_space.shape)
+
+        self._rollout_bufs = None
+        self.plan = None
 
     def reset(self):
         super(MPCPol, self).reset()
+        self.plan = None
+
+    def _get_buffers(self, batch_size, device):
+        """
+        Buffers of rollouts for batch_size observations.
+        They are allocated only when batch_size or device is changed.
+        """
+        if self._rollout_bufs is None or self._rollout_bufs['batch_size'] != batch_size or self._rollout_bufs['device'] != device:
+            dim_ob = self.ob_space.shape[0]
+            dim_ac = self.ac_space.shape[0]
+            num = batch_size * self.n_samples
+            self._rollout_bufs = dict(
+                batch_size=batch_size,
+                device=device,
+                obs=torch.zeros((self.horizon + 1, num, dim_ob),
+                                dtype=torch.float, device=device),
+                rews_sum=torch.zeros(
+                    (batch_size, self.n_samples), dtype=torch.float, device=device),
+                # (horizon, batch_size, n_samples, dim_ac)
+                acs=torch.zeros((self.horizon, batch_size, self.n_samples, dim_ac),
+                                dtype=torch.float, device=device),
+                normalized_acs=torch.zeros(
+                    (self.horizon, num, dim_ac), dtype=torch.float, device=device),
+                h_masks=torch.zeros((1, num, 1), dtype=torch.float, device=device))
+            for key in ['mean_obs', 'std_obs', 'mean_acs', 'std_acs', 'low', 'high', 'init_std']:
+                self._rollout_bufs[key] = getattr(self, key).to(device)
+        return self._rollout_bufs
+
+    def _sample(self, buf, mean, std):
+        acs = buf['acs']
+        low, high = buf['low'], buf['high']
+        if self.method == 'random':
+            acs.uniform_()
+            acs.mul_(high - low).add_(low)
+            if mean is not None:
+                acs[:, :, 0] = mean[:, :, 0]
+        else:
+            acs.normal_()
+            acs.mul_(std).add_(mean)
+            torch.max(acs, low, out=acs)
+            torch.min(acs, high, out=acs)
+        torch.sub(acs.reshape(buf['normalized_acs'].shape),
+                  buf['mean_acs'], out=buf['normalized_acs'])
+        buf['normalized_acs'].div_(buf['std_acs'])
+
+    def _rollout(self, buf, ob, h_masks):
+        """
+        Simulating sampled action sequences with the dynamics model.
+        Returns are written to buf['rews_sum'].
+        """
+        obs = buf['obs']
+        acs = buf['acs'].reshape((self.horizon, -1, self.ac_space.shape[0]))
+        normalized_acs = buf['normalized_acs']
+        obs[0] = ((ob - buf['mean_obs']) / buf['std_obs']
+                  ).repeat_interleave(self.n_samples, dim=0)
+        rews_sum = buf['rews_sum'].reshape(-1)
+        rews_sum.zero_()
+        hs = self.hs
+        for i in range(self.horizon):
+            ac = normalized_acs[i]
+            if self.rnn:
+                d_ob, hs = self.net(obs[i].unsqueeze(
+                    0), ac.unsqueeze(0), hs, h_masks if i == 0 else buf['h_masks'])
+                d_ob = d_ob[0]
+            elif isinstance(self.net, ModelEnsemble):
+                d_ob = self.net.ts_forward(obs[i], ac)
+            else:
+                d_ob = self.net(obs[i], ac)
+            torch.add(obs[i], d_ob, out=obs[i + 1])
+            rews_sum += self.rew_func(obs[i+1], acs[i],
+                                      buf['mean_obs'], buf['std_obs'])
 
     def forward(self, ob, hs=None, h_masks=None):
-        # randomly sample N candidate action sequences
-        sample_acs = torch.empty(self.horizon, self.n_samples, self.ac_space.shape[0], dtype=torch.float).uniform_(
-            self.ac_space.low[0], self.ac_space.high[0])
-        normalized_acs = (sample_acs - self.mean_acs) / self.std_acs
-
-        # forward simulate the action sequences to get predicted trajectories
-        obs = torch.zeros((self.horizon+1, self.n_samples,
-                           self.ob_space.shape[0]), dtype=torch.float)
-        rews_sum = torch.zeros(
-            (self.n_samples), dtype=torch.float)
-        obs[0] = ob.repeat(self.n_samples, 1)
-        obs[0] = (obs[0] - self.mean_obs) / self.std_obs
-
-        if self.rnn:
-            time_seq, batch_size, *_ = obs.shape
-
-            if hs is None:
-                if self.hs is None:
-                    self.hs = self.net.init_hs(batch_size)
-                hs = self.hs
-
-            if h_masks is None:
-                h_masks = hs[0].new(time_seq, batch_size, 1).zero_()
-            h_masks = h_masks.reshape(time_seq, batch_size, 1)
+        device = next(self.net.parameters()).device
+        single = ob.dim() == len(self.ob_space.shape)
+        ob = ob.reshape((-1, self.ob_space.shape[0])).to(device)
+        batch_size = ob.shape[0]
+        buf = self._get_buffers(batch_size, device)
+        num = batch_size * self.n_samples
+
+        # h_masks is 1 at the first step of episodes
+        if h_masks is not None:
+            h_masks = h_masks.reshape(batch_size).to(device)
+            if self.plan is not None and self.plan.shape[1] == batch_size:
+                self.plan[:, h_masks > 0] = (
+                    buf['low'] + buf['high']) / 2
+            h_masks = h_masks.repeat_interleave(
+                self.n_samples).reshape(1, num, 1)
+        else:
+            h_masks = buf['h_masks']
+        if self.rnn and (self.hs is None or self.hs[0].shape[0] != num):
+            self.hs = self.net.init_hs(num)
+
+        if self.warm_start and self.plan is not None and self.plan.shape[1] == batch_size:
+            mean = self.plan
+        elif self.method != 'random':
+            mean = ((buf['low'] + buf['high']) / 2).expand(
+                (self.horizon, batch_size, 1, self.ac_space.shape[0])).clone()
+        else:
+            mean = None
+        std = buf['init_std']
 
         with torch.no_grad():
-            for i in range(self.horizon):
-                ac = normalized_acs[i]
-                if self.rnn:
-                    d_ob, hs = self.net(obs[i].unsqueeze(
-                        0), ac.unsqueeze(0), hs, h_masks)
-                    obs[i+1] = obs[i] + d_ob
+            for _ in range(self.n_iter):
+                self._sample(buf, mean, std)
+                self._rollout(buf, ob, h_masks)
+                rews_sum = buf['rews_sum']
+                if self.method == 'random':
+                    best_index = rews_sum.max(1)[1]
+                    plan = buf['acs'][:, torch.arange(
+                        batch_size, device=device), best_index].unsqueeze(2)
+                    continue
+                if self.method == 'cem':
+                    _, elite_index = torch.topk(rews_sum, self.n_elites, dim=1)
+                    elites = torch.gather(buf['acs'], 2, elite_index.reshape(
+                        1, batch_size, self.n_elites, 1).expand((self.horizon, batch_size, self.n_elites, self.ac_space.shape[0])))
+                    new_mean = elites.mean(dim=2, keepdim=True)
+                    new_std = elites.std(dim=2, keepdim=True) if self.n_elites > 1 \
+                        else torch.zeros_like(new_mean)
                 else:
-                    obs[i+1] = obs[i] + self.net(obs[i], ac)
-                rews_sum += self.rew_func(obs[i+1], sample_acs[i],
-                                          self.mean_obs, self.std_obs)
+                    weights = torch.softmax(
+                        rews_sum / self.temperature, dim=1).reshape(1, batch_size, self.n_samples, 1)
+                    new_mean = torch.sum(weights * buf['acs'],
+                                         dim=2, keepdim=True)
+                    new_std = torch.sqrt(torch.sum(
+                        weights * (buf['acs'] - new_mean) ** 2, dim=2, keepdim=True))
+                mean = self.alpha * mean + (1 - self.alpha) * new_mean
+                std = self.alpha * std + (1 - self.alpha) * new_std
+            if self.method != 'random':
+                plan = mean
 
-        best_sample_index = rews_sum.max(0)[1]
-        ac = sample_acs[0][best_sample_index]
-        ac_real = ac.cpu().numpy()
-
-        if self.rnn:
-            normalized_ac = normalized_acs[0][best_sample_index].repeat(
-                self.n_samples, 1)
-            with torch.no_grad():
-                _, self.hs = self.net(obs[0].unsqueeze(
+            if self.rnn:
+                normalized_ac = ((plan[0] - buf['mean_acs']) / buf['std_acs']).expand(
+                    (batch_size, self.n_samples, self.ac_space.shape[0])).reshape(num, -1)
+                _, self.hs = self.net(buf['obs'][0].unsqueeze(
                     0), normalized_ac.unsqueeze(0), self.hs, h_masks)
 
+        ac = plan[0, :, 0]
+        # shift the plan by one step for the next call
+        self.plan = torch.cat([plan[1:], ((buf['low'] + buf['high']) / 2).expand(
+            (1, batch_size, 1, self.ac_space.shape[0]))], dim=0)
+        if single:
+            ac = ac[0]
+        ac_real = ac.cpu().numpy()
+
         return ac_real, ac, dict(mean=ac)
 
-    def deterministic_ac_real(self, obs):
+    def deterministic_ac_real(self, obs, hs=None, h_masks=None):
         """
         action for deployment
         """
-        mean_read, mean, dic = self.forward(obs)
+        mean_real, mean, dic = self.forward(obs, hs, h_masks)
         return mean_real, mean, dic
@@ -1 +1,2 @@
 from machina.samplers.epi_sampler import EpiSampler
+from machina.samplers.vec_epi_sampler import VecEpiSampler
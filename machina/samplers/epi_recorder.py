@@ -0,0 +1,81 @@
+"""
+Recorder of steps in an episode.
+"""
+
+import numpy as np
+
+
+def _dtype(value):
+    # compact dtypes like uint8 of images are kept
+    if isinstance(value, np.ndarray) and value.dtype.itemsize < 4:
+        return value.dtype
+    return np.float32
+
+
+class EpiRecorder(object):
+    """
+    Recorder which writes each step of an episode into preallocated arrays.
+    Shape and dtype of each field are decided by its first value.
+    Values are recorded as float32 unless they are np.ndarray
+    in a dtype smaller than float32, e.g. uint8 images.
+    Arrays are doubled when they are full.
+
+    Keys are 'obs', 'acs', 'rews', 'dones' or tuples like ('a_is', key) and ('e_is', key).
+
+    Parameters
+    ----------
+    init_size : int
+        Initial number of steps which arrays can hold.
+    """
+
+    def __init__(self, init_size=256):
+        self.size = init_size
+        self.data_map = dict()
+        self.length = 0
+
+    def record(self, key, value):
+        """
+        Recording value of current step.
+
+        Parameters
+        ----------
+        key : str or tuple
+        value : float or bool or np.ndarray or tuple of np.ndarray
+        """
+        if key not in self.data_map:
+            self.data_map[key] = np.zeros(
+                (self.size, ) + np.shape(value), dtype=_dtype(value))
+        self.data_map[key][self.length] = value
+
+    def next_step(self):
+        """
+        Proceeding to next step.
+        """
+        self.length += 1
+        if self.length == self.size:
+            self.size *= 2
+            for key in self.data_map:
+                array = self.data_map[key]
+                self.data_map[key] = np.zeros(
+                    (self.size, ) + array.shape[1:], dtype=array.dtype)
+                self.data_map[key][:self.length] = array
+
+    def get_epi(self):
+        """
+        Getting recorded episode.
+        Recorder is reset and next episode is recorded in new arrays.
+
+        Returns
+        -------
+        epi : dict
+        """
+        epi = dict(a_is=dict(), e_is=dict())
+        for key in self.data_map:
+            array = self.data_map[key][:self.length]
+            if isinstance(key, tuple):
+                epi[key[0]][key[1]] = array
+            else:
+                epi[key] = array
+        self.data_map = dict()
+        self.length = 0
+        return epi
@@ -3,17 +3,22 @@ Sampler class
 """
 
 import copy
-import time
+import queue
+import threading
 
 import gym
 import numpy as np
 import torch
 import torch.multiprocessing as mp
 
+from machina.samplers.epi_recorder import EpiRecorder
+from machina.samplers.shared_epi_buffer import SharedEpiReader, SharedEpiWriter
+from machina.samplers.shared_params import SharedParams
 from machina.utils import cpu_mode
 
 
 LARGE_NUMBER = 100000000
+WORKER_CHECK_INTERVAL = 1.0
 
 
 def one_epi(env, pol, deterministic=False, prepro=None):
@@ -35,16 +40,10 @@ def one_epi(env, pol, deterministic=False, prepro=None):
     with cpu_mode():
         if prepro is None:
             def prepro(x): return x
-        obs = []
-        acs = []
-        rews = []
-        dones = []
-        a_is = []
-        e_is = []
+        recorder = EpiRecorder()
         o = env.reset()
         pol.reset()
         done = False
-        epi_length = 0
         while not done:
             o = prepro(o)
             if not deterministic:
@@ -54,41 +53,31 @@ def one_epi(env, pol, deterministic=False, prepro=None):
                     torch.tensor(o, dtype=torch.float))
             ac_real = ac_real.reshape(pol.ac_space.shape)
             next_o, r, done, e_i = env.step(np.array(ac_real))
-            obs.append(o)
-            rews.append(r)
-            dones.append(done)
-            acs.append(ac.squeeze().detach().cpu(
+            recorder.record('obs', o)
+            recorder.record('rews', r)
+            recorder.record('dones', done)
+            recorder.record('acs', ac.squeeze().detach().cpu(
             ).numpy().reshape(pol.ac_space.shape))
-            _a_i = dict()
             for key in a_i.keys():
                 if a_i[key] is None:
                     continue
                 if isinstance(a_i[key], tuple):
-                    _a_i[key] = tuple([h.squeeze().detach().cpu().numpy()
-                                       for h in a_i[key]])
+                    recorder.record(('a_is', key), tuple([h.squeeze().detach().cpu().numpy()
+                                                          for h in a_i[key]]))
                 else:
-                    _a_i[key] = a_i[key].squeeze().detach(
-                    ).cpu().numpy().reshape(pol.a_i_shape)
-            a_i = _a_i
-            a_is.append(a_i)
-            e_is.append(e_i)
-            epi_length += 1
+                    recorder.record(('a_is', key), a_i[key].squeeze().detach(
+                    ).cpu().numpy().reshape(pol.a_i_shape))
+            for key in e_i.keys():
+                recorder.record(('e_is', key), e_i[key])
+            recorder.next_step()
             if done:
                 break
             o = next_o
-        return epi_length, dict(
-            obs=np.array(obs, dtype='float32'),
-            acs=np.array(acs, dtype='float32'),
-            rews=np.array(rews, dtype='float32'),
-            dones=np.array(dones, dtype='float32'),
-            a_is=dict([(key, np.array([a_i[key] for a_i in a_is], dtype='float32'))
-                       for key in a_is[0].keys()]),
-            e_is=dict([(key, np.array([e_i[key] for e_i in e_is], dtype='float32'))
-                       for key in e_is[0].keys()])
-        )
-
-
-def mp_sample(pol, env, max_steps, max_epis, n_steps_global, n_epis_global, epis, exec_flags, deterministic_flag, process_id, prepro=None, seed=256):
+        epi_length = recorder.length
+        return epi_length, recorder.get_epi()
+
+
+def mp_sample(pol, env, max_steps, max_epis, n_steps_global, n_epis_global, epi_queue, exec_events, counter_lock, deterministic_flag, process_id, prepro=None, seed=256):
     """
     Multiprocess sample.
     Sampling episodes until max_steps or max_epis is achieved.
@@ -105,10 +94,12 @@ def mp_sample(pol, env, max_steps, max_epis, n_steps_global, n_epis_global, epis
         shared Tensor
     n_epis_global : torch.Tensor
         shared Tensor
-    epis : list
-        multiprocessing's list for sharing episodes between processes.
-    exec_flags : list of torch.Tensor
-        execution flag
+    epi_queue : torch.multiprocessing.Queue
+        Queue for sending episodes written on shared memory.
+    exec_events : list of multiprocessing.Event
+        Sampling is started when the event is set.
+    counter_lock : multiprocessing.Lock
+        Lock for n_steps_global and n_epis_global.
     deterministic_flag : torch.Tensor
     process_id : int
     prepro : Prepro
@@ -119,21 +110,39 @@ def mp_sample(pol, env, max_steps, max_epis, n_steps_global, n_epis_global, epis
     torch.manual_seed(seed + process_id)
     torch.set_num_threads(1)
 
+    writer = SharedEpiWriter(epi_queue, process_id)
     while True:
-        time.sleep(0.1)
-        if exec_flags[process_id] > 0:
-            while max_steps > n_steps_global and max_epis > n_epis_global:
-                l, epi = one_epi(env, pol, deterministic_flag, prepro)
+        exec_events[process_id].wait()
+        exec_events[process_id].clear()
+        writer.reset()
+        while max_steps > n_steps_global and max_epis > n_epis_global:
+            l, epi = one_epi(env, pol, deterministic_flag, prepro)
+            with counter_lock:
                 n_steps_global += l
                 n_epis_global += 1
-                epis.append(epi)
-            exec_flags[process_id].zero_()
+            writer.write(epi)
+        writer.finish()
+
+
+def _copy_epi(epi):
+    _epi = dict()
+    for key in epi:
+        if isinstance(epi[key], dict):
+            _epi[key] = _copy_epi(epi[key])
+        else:
+            _epi[key] = np.array(epi[key])
+    return _epi
 
 
 class EpiSampler(object):
     """
     A sampler which sample episodes.
 
+    Episodes are sampled synchronously by sample,
+    or asynchronously while learner is training by
+    start_async, publish, get_epis and stop_async.
+    Sampled episodes are also given to sinks added by add_sink.
+
     Parameters
     ----------
     env : gym.Env
@@ -142,12 +151,15 @@ class EpiSampler(object):
         Number of processes
     prepro : Prepro
     seed : int
+    half_params : bool
+        If True, parameters of pol are transferred to sampling processes in float16.
     """
 
-    def __init__(self, env, pol, num_parallel=8, prepro=None, seed=256):
+    def __init__(self, env, pol, num_parallel=8, prepro=None, seed=256, half_params=False):
         self.env = env
         self.pol = copy.deepcopy(pol)
         self.pol.to('cpu')
+        self.shared_params = SharedParams(self.pol, half_params)
         self.pol.share_memory()
         self.pol.eval()
         self.num_parallel = num_parallel
@@ -158,24 +170,100 @@ class EpiSampler(object):
             0, dtype=torch.long).share_memory_()
         self.max_epis = torch.tensor(0, dtype=torch.long).share_memory_()
 
-        self.exec_flags = [torch.tensor(
-            0, dtype=torch.long).share_memory_() for _ in range(self.num_parallel)]
+        self.exec_events = [mp.Event() for _ in range(self.num_parallel)]
+        self.counter_lock = mp.Lock()
         self.deterministic_flag = torch.tensor(
             0, dtype=torch.uint8).share_memory_()
 
-        self.epis = mp.Manager().list()
+        self.epi_queue = mp.Queue()
+        self.epi_reader = SharedEpiReader()
         self.processes = []
         for ind in range(self.num_parallel):
-            p = mp.Process(target=mp_sample, args=(self.pol, env, self.max_steps, self.max_epis, self.n_steps_global,
-                                                   self.n_epis_global, self.epis, self.exec_flags, self.deterministic_flag, ind, prepro, seed))
+            p = self._make_process(env, ind, prepro, seed)
             p.start()
             self.processes.append(p)
 
+        self.pol_version = 0
+        self._published_version = 0
+        self._published_params = None
+        self._publish_lock = threading.Lock()
+        self._async_thread = None
+        self.sinks = []
+
+    def _make_process(self, env, process_id, prepro, seed):
+        return mp.Process(target=mp_sample, args=(self.pol, env, self.max_steps, self.max_epis, self.n_steps_global,
+                                                  self.n_epis_global, self.epi_queue, self.exec_events, self.counter_lock,
+                                                  self.deterministic_flag, process_id, prepro, seed))
+
     def __del__(self):
+        if self._async_thread is not None:
+            self._async_stop.set()
         for p in self.processes:
             p.terminate()
 
-    def sample(self, pol, max_epis=None, max_steps=None, deterministic=False):
+    def _check_max(self, max_epis, max_steps):
+        if max_epis is None and max_steps is None:
+            raise ValueError(
+                'Either max_epis or max_steps needs not to be None')
+
+    def _sample_round(self, max_epis, max_steps, deterministic):
+        max_epis = max_epis if max_epis is not None else LARGE_NUMBER
+        max_steps = max_steps if max_steps is not None else LARGE_NUMBER
+
+        self.n_steps_global.zero_()
+        self.n_epis_global.zero_()
+
+        self.max_steps.zero_()
+        self.max_steps += max_steps
+        self.max_epis.zero_()
+        self.max_epis += max_epis
+
+        if deterministic:
+            self.deterministic_flag.zero_()
+            self.deterministic_flag += 1
+        else:
+            self.deterministic_flag.zero_()
+
+        for exec_event in self.exec_events:
+            exec_event.set()
+
+        epis = []
+        num_finished = 0
+        while num_finished < self.num_parallel:
+            try:
+                # timeout is only used for noticing dead processes
+                msg = self.epi_queue.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                if not all([p.is_alive() for p in self.processes]):
+                    raise RuntimeError('Sampling process is dead.')
+                continue
+            if msg[0] == 'finish':
+                num_finished += 1
+                continue
+            epi = self.epi_reader.read(msg)
+            if epi is not None:
+                epis.append(epi)
+        for sink in self.sinks:
+            for epi in epis:
+                sink.write(epi)
+        return epis
+
+    def add_sink(self, sink):
+        """
+        Adding a sink to which every sampled episode is written,
+        e.g. machina.traj.epi_file.EpiWriter.
+        This also works in asynchronous sampling.
+
+        Parameters
+        ----------
+        sink : object
+            It has write method which takes an episode.
+            Arrays of the episode are overwritten after write,
+            so they should be copied in write.
+        """
+        self.sinks.append(sink)
+
+    def sample(self, pol, max_epis=None, max_steps=None, deterministic=False, version=None):
         """
         Switch on sampling processes.
 
@@ -189,45 +277,182 @@ class EpiSampler(object):
             maximum steps of episodes
             If None, this value is ignored.
         deterministic : bool
+        version : int or None
+            Version of parameters of pol, e.g. number of updates.
+            If same as last sampling, parameters are not copied.
+            If None, parameters are always copied.
 
         Returns
         -------
         epis : list of dict
             Sampled epis.
+            Arrays in epis are views of shared memory of sampling processes,
+            so they are overwritten by next sampling.
 
         Raises
         ------
         ValueError
             If max_steps and max_epis are botch None.
+        RuntimeError
+            If a sampling process is dead or asynchronous sampling is running.
         """
-        for sp, p in zip(self.pol.parameters(), pol.parameters()):
-            sp.data.copy_(p.data.to('cpu'))
+        if self._async_thread is not None:
+            raise RuntimeError(
+                'sample can not be called while asynchronous sampling is running.')
+        self._check_max(max_epis, max_steps)
 
-        if max_epis is None and max_steps is None:
-            raise ValueError(
-                'Either max_epis or max_steps needs not to be None')
-        max_epis = max_epis if max_epis is not None else LARGE_NUMBER
-        max_steps = max_steps if max_steps is not None else LARGE_NUMBER
+        if self.shared_params.publish(pol, version):
+            self.pol_version = version if version is not None else self.pol_version + 1
 
-        self.n_steps_global.zero_()
-        self.n_epis_global.zero_()
+        return self._sample_round(max_epis, max_steps, deterministic)
 
-        self.max_steps.zero_()
-        self.max_steps += max_steps
-        self.max_epis.zero_()
-        self.max_epis += max_epis
+    def publish(self, pol, version=None):
+        """
+        Publishing parameters of pol for asynchronous sampling.
+        Sampling processes use them from the next round.
 
-        if deterministic:
-            self.deterministic_flag.zero_()
-            self.deterministic_flag += 1
-        else:
-            self.deterministic_flag.zero_()
+        Parameters
+        ----------
+        pol : Pol
+        version : int or None
+            Version of parameters of pol, e.g. number of updates.
+            If same as last published one, nothing is published.
+            If None, parameters are always published with incremented version.
 
-        del self.epis[:]
+        Returns
+        -------
+        version : int
+            Version of published parameters.
+        """
+        if version is not None and version == self._published_version:
+            return version
+        params = self.shared_params.flatten(pol)
+        with self._publish_lock:
+            if version is None:
+                version = self._published_version + 1
+            self._published_params = params
+            self._published_version = version
+            return version
+
+    def start_async(self, pol, max_epis=None, max_steps=None, deterministic=False, max_queued_epis=1000, version=None):
+        """
+        Starting asynchronous sampling.
+        Sampling is repeated in rounds in a background thread.
+        Each round is same as sample with max_epis and max_steps,
+        and uses parameters lastly published before the round starts.
+        Sampled episodes are copied out of shared memory and queued,
+        and each episode has pol_version which is version of parameters.
 
-        for exec_flag in self.exec_flags:
-            exec_flag += 1
+        Parameters
+        ----------
+        pol : Pol
+        max_epis : int or None
+            maximum episodes of a round.
+        max_steps : int or None
+            maximum steps of a round.
+        deterministic : bool
+        max_queued_epis : int
+            If this number of episodes are queued,
+            sampling waits until they are taken by get_epis.
+        version : int or None
+            Version of parameters of pol.
+        """
+        if self._async_thread is not None:
+            raise RuntimeError('Asynchronous sampling is already running.')
+        self._check_max(max_epis, max_steps)
+
+        self._published_version = self.pol_version
+        self._published_params = None
+        self.publish(pol, version)
+        self._async_queue = queue.Queue(max_queued_epis)
+        self._async_stop = threading.Event()
+        self._async_error = None
+        self._async_thread = threading.Thread(
+            target=self._async_loop, args=(max_epis, max_steps, deterministic))
+        self._async_thread.daemon = True
+        self._async_thread.start()
+
+    def _async_loop(self, max_epis, max_steps, deterministic):
+        try:
+            while not self._async_stop.is_set():
+                with self._publish_lock:
+                    params = self._published_params
+                    version = self._published_version
+                    self._published_params = None
+                if params is not None:
+                    self.shared_params.load(params, version)
+                    self.pol_version = version
+                # episodes are copied before next round overwrites shared memory
+                epis = [_copy_epi(epi) for epi in self._sample_round(
+                    max_epis, max_steps, deterministic)]
+                for epi in epis:
+                    epi['pol_version'] = self.pol_version
+                    while not self._async_stop.is_set():
+                        try:
+                            self._async_queue.put(
+                                epi, timeout=WORKER_CHECK_INTERVAL)
+                            break
+                        except queue.Full:
+                            continue
+        except Exception as e:
+            self._async_error = e
+
+    def get_epis(self, max_epis=None, max_steps=None):
+        """
+        Getting episodes sampled asynchronously.
+        This blocks until max_epis or max_steps is achieved.
+        If both are None, all queued episodes are returned
+        after waiting for at least one episode.
 
+        Parameters
+        ----------
+        max_epis : int or None
+        max_steps : int or None
+
+        Returns
+        -------
+        epis : list of dict
+            Each episode has pol_version.
+
+        Raises
+        ------
+        RuntimeError
+            If asynchronous sampling is not running or failed.
+        """
+        if self._async_thread is None:
+            raise RuntimeError('Asynchronous sampling is not running.')
+        epis = []
+        n_steps = 0
         while True:
-            if all([exec_flag == 0 for exec_flag in self.exec_flags]):
-                return list(self.epis)
+            if max_epis is not None and len(epis) >= max_epis:
+                break
+            if max_steps is not None and n_steps >= max_steps:
+                break
+            try:
+                if max_epis is None and max_steps is None and len(epis) > 0:
+                    epi = self._async_queue.get_nowait()
+                else:
+                    epi = self._async_queue.get(
+                        timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                if self._async_error is not None:
+                    raise RuntimeError(
+                        'Asynchronous sampling failed.') from self._async_error
+                if len(epis) > 0 and max_epis is None and max_steps is None:
+                    break
+                continue
+            epis.append(epi)
+            n_steps += len(epi['rews'])
+        return epis
+
+    def stop_async(self):
+        """
+        Stopping asynchronous sampling.
+        This waits for the current round and discards queued episodes.
+        """
+        if self._async_thread is None:
+            return
+        self._async_stop.set()
+        self._async_thread.join()
+        self._async_thread = None
+        self._async_queue = None
@@ -0,0 +1,149 @@
+"""
+Transport of episodes between processes through shared memory.
+"""
+
+import numpy as np
+import torch
+
+
+EPI_KEYS = ['obs', 'acs', 'rews', 'dones']
+INFO_KEYS = ['a_is', 'e_is']
+
+
+def _torch_dtype(array):
+    return torch.from_numpy(np.asarray(array)[:0]).dtype
+
+
+def _flatten_epi(epi):
+    flat = dict()
+    for key in EPI_KEYS:
+        flat[key] = epi[key]
+    for info_key in INFO_KEYS:
+        for key in epi[info_key]:
+            flat[(info_key, key)] = epi[info_key][key]
+    return flat
+
+
+class SharedEpiWriter(object):
+    """
+    Writer of episodes used in a sampling process.
+    Episodes are written into buffers on shared memory
+    and only their positions are sent through the queue.
+    Buffers are allocated when the first episode comes
+    and reallocated with double size when they overflow.
+    Each buffer keeps dtype of its field.
+    Writing position is rewound by reset.
+
+    Parameters
+    ----------
+    queue : torch.multiprocessing.Queue
+    process_id : int
+    buffer_size : int or None
+        Initial number of steps which buffers can hold.
+        If None, length of the first episode is used.
+    """
+
+    def __init__(self, queue, process_id, buffer_size=None):
+        self.queue = queue
+        self.process_id = process_id
+        self.buffer_size = buffer_size
+        self.data_map = None
+        self.head = 0
+
+    def reset(self):
+        self.head = 0
+
+    def _fits(self, flat_epi, length):
+        if self.data_map is None:
+            return False
+        if self.head + length > self.buffer_size:
+            return False
+        if set(flat_epi.keys()) != set(self.data_map.keys()):
+            return False
+        for key in flat_epi:
+            if flat_epi[key].shape[1:] != self.data_map[key].shape[1:]:
+                return False
+            if _torch_dtype(flat_epi[key]) != self.data_map[key].dtype:
+                return False
+        return True
+
+    def _allocate(self, flat_epi, length):
+        if self.buffer_size is None:
+            self.buffer_size = max(length, 1)
+        elif self.data_map is not None and self.head + length > self.buffer_size:
+            self.buffer_size *= 2
+        while self.buffer_size < length:
+            self.buffer_size *= 2
+        self.data_map = dict()
+        for key in flat_epi:
+            self.data_map[key] = torch.zeros(
+                (self.buffer_size, ) + flat_epi[key].shape[1:], dtype=_torch_dtype(flat_epi[key])).share_memory_()
+        self.head = 0
+        self.queue.put(('buffer', self.process_id, self.data_map))
+
+    def write(self, epi):
+        """
+        Writing an episode to shared memory.
+
+        Parameters
+        ----------
+        epi : dict
+            Episode which is output of one_epi.
+        """
+        flat_epi = _flatten_epi(epi)
+        length = len(epi['rews'])
+        if not self._fits(flat_epi, length):
+            self._allocate(flat_epi, length)
+        for key in flat_epi:
+            self.data_map[key][self.head:self.head+length] = torch.from_numpy(
+                np.ascontiguousarray(flat_epi[key]))
+        self.queue.put(('epi', self.process_id, self.head, length))
+        self.head += length
+
+    def finish(self):
+        """
+        Notifying that sampling in this process is finished.
+        """
+        self.queue.put(('finish', self.process_id))
+
+
+class SharedEpiReader(object):
+    """
+    Reader of episodes written by SharedEpiWriter.
+    Episodes are numpy views of buffers on shared memory.
+    They are valid until the sampling process overwrites them,
+    i.e. until next sampling.
+    """
+
+    def __init__(self):
+        self.data_maps = dict()
+
+    def read(self, msg):
+        """
+        Reading a message from SharedEpiWriter.
+
+        Parameters
+        ----------
+        msg : tuple
+
+        Returns
+        -------
+        epi : dict or None
+            If msg is not episode, None is returned.
+        """
+        kind, process_id = msg[:2]
+        if kind == 'buffer':
+            self.data_maps[process_id] = msg[2]
+            return None
+        elif kind == 'epi':
+            start, length = msg[2:]
+            data_map = self.data_maps[process_id]
+            epi = dict([(info_key, dict()) for info_key in INFO_KEYS])
+            for key in data_map:
+                view = data_map[key][start:start+length].numpy()
+                if isinstance(key, tuple):
+                    epi[key[0]][key[1]] = view
+                else:
+                    epi[key] = view
+            return epi
+        return None
@@ -0,0 +1,103 @@
+"""
+Parameters of a policy shared with sampling processes.
+"""
+
+import torch
+from torch.nn.utils import parameters_to_vector
+
+
+class SharedParams(object):
+    """
+    Flat buffer on shared memory which holds all parameters of a module.
+    Parameters of the module are replaced by views of the buffer,
+    so processes which have the module read published parameters without copy.
+
+    Parameters
+    ----------
+    module : torch.nn.Module
+        Module on cpu whose parameters are shared.
+    half : bool
+        If True, parameters are transferred from the learner in float16.
+        This halves the transfer from gpu, but published parameters are rounded.
+    """
+
+    def __init__(self, module, half=False):
+        self.half = half
+        params = list(module.parameters())
+        numel = sum([p.numel() for p in params])
+        self.flat = torch.zeros(numel, dtype=torch.float).share_memory_()
+        offset = 0
+        for p in params:
+            n = p.numel()
+            self.flat[offset:offset+n] = p.data.reshape(-1)
+            p.data = self.flat[offset:offset+n].view_as(p)
+            offset += n
+        self.version = None
+
+    def changed(self, version=None):
+        """
+        Whether parameters of given version need to be published.
+
+        Parameters
+        ----------
+        version : int or None
+            If None, parameters are always regarded as changed.
+
+        Returns
+        -------
+        changed : bool
+        """
+        return version is None or version != self.version
+
+    def flatten(self, module):
+        """
+        Gathering parameters of module into one tensor on cpu.
+        Parameters on gpu are transferred at once.
+
+        Parameters
+        ----------
+        module : torch.nn.Module
+
+        Returns
+        -------
+        flat : torch.Tensor
+        """
+        with torch.no_grad():
+            flat = parameters_to_vector(module.parameters())
+            if self.half:
+                flat = flat.half()
+            return flat.to('cpu', copy=True)
+
+    def load(self, flat, version=None):
+        """
+        Writing flattened parameters to the shared buffer.
+
+        Parameters
+        ----------
+        flat : torch.Tensor
+            Output of flatten.
+        version : int or None
+        """
+        self.flat.copy_(flat)
+        self.version = version
+
+    def publish(self, module, version=None):
+        """
+        Publishing parameters of module.
+        Nothing is copied if version is same as last published one.
+
+        Parameters
+        ----------
+        module : torch.nn.Module
+        version : int or None
+            Version of parameters, e.g. number of updates.
+
+        Returns
+        -------
+        published : bool
+            Whether parameters are copied.
+        """
+        if not self.changed(version):
+            return False
+        self.load(self.flatten(module), version)
+        return True
@@ -0,0 +1,212 @@
+"""
+Sampler class which steps several environments in lockstep.
+"""
+
+import copy
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from machina.samplers.epi_recorder import EpiRecorder
+from machina.samplers.epi_sampler import EpiSampler
+from machina.samplers.shared_epi_buffer import SharedEpiWriter
+from machina.utils import cpu_mode
+
+
+def _a_i_to_numpy(a_i, num_envs, a_i_shape):
+    """
+    Converting batched agent infos to numpy arrays whose first axis is environments.
+    """
+    _a_i = dict()
+    for key in a_i.keys():
+        if a_i[key] is None:
+            continue
+        if isinstance(a_i[key], tuple):
+            _a_i[key] = np.stack([h.detach().cpu().numpy().reshape(num_envs, -1)
+                                  for h in a_i[key]], axis=1)
+        else:
+            value = a_i[key].detach().cpu().numpy().reshape(
+                (-1, ) + tuple(a_i_shape))
+            _a_i[key] = np.broadcast_to(
+                value, (num_envs, ) + tuple(a_i_shape))
+    return _a_i
+
+
+def vec_epis(envs, pol, max_steps, max_epis, n_steps_global, n_epis_global, deterministic=False, prepro=None):
+    """
+    Sampling episodes from several environments in lockstep.
+    Observations of all environments are stacked and
+    the policy is called once per step.
+    An environment whose episode is finished is reset
+    as long as max_steps and max_epis are not achieved.
+    Running episodes are counted for max_epis,
+    so at most max_epis episodes are sampled by one call.
+
+    Parameters
+    ----------
+    envs : list of gym.Env
+    pol : Pol
+        Pol which can take a batch of observations.
+    max_steps : int or torch.Tensor
+        maximum steps of episodes
+    max_epis : int or torch.Tensor
+        maximum episodes of episodes
+    n_steps_global : torch.Tensor
+        Number of sampled steps. This should be updated by caller.
+    n_epis_global : torch.Tensor
+        Number of sampled episodes. This should be updated by caller.
+    deterministic : bool
+        If True, policy is deterministic.
+    prepro : Prepro
+
+    Returns
+    -------
+    epi_length, epi : int, dict
+        Generator of finished episodes.
+    """
+    with cpu_mode():
+        if prepro is None:
+            def prepro(x): return x
+        num_envs = len(envs)
+        recorders = [EpiRecorder() for _ in range(num_envs)]
+        obs = [env.reset() for env in envs]
+        active = [False] * num_envs
+        for i in range(num_envs):
+            # episodes which are running are counted for max_epis
+            active[i] = bool(max_steps > n_steps_global and
+                             max_epis > n_epis_global + sum(active))
+        # preprocessed observations. finished environments keep their last ones
+        obs = [prepro(o) if act else None for o, act in zip(obs, active)]
+        h_masks = np.ones((1, num_envs, 1), dtype='float32')
+        pol.reset()
+        while any(active):
+            # environments which are never active are given a dummy observation
+            dummy_ob = next(o for o in obs if o is not None)
+            ob_batch = torch.tensor(np.array(
+                [o if o is not None else dummy_ob for o in obs]), dtype=torch.float)
+            kwargs = dict()
+            if pol.use_h_masks:
+                kwargs['h_masks'] = torch.tensor(h_masks)
+            if not deterministic:
+                ac_real, ac, a_i = pol(ob_batch, **kwargs)
+            else:
+                ac_real, ac, a_i = pol.deterministic_ac_real(
+                    ob_batch, **kwargs)
+            ac_real = np.array(ac_real).reshape(
+                (num_envs, ) + pol.ac_space.shape)
+            ac = ac.detach().cpu().numpy().reshape(
+                (num_envs, ) + pol.ac_space.shape)
+            a_i = _a_i_to_numpy(a_i, num_envs, pol.a_i_shape)
+            for i, env in enumerate(envs):
+                if not active[i]:
+                    continue
+                next_o, r, done, e_i = env.step(np.array(ac_real[i]))
+                recorder = recorders[i]
+                recorder.record('obs', obs[i])
+                recorder.record('acs', ac[i])
+                recorder.record('rews', r)
+                recorder.record('dones', done)
+                for key in a_i.keys():
+                    recorder.record(('a_is', key), a_i[key][i])
+                for key in e_i.keys():
+                    recorder.record(('e_is', key), e_i[key])
+                recorder.next_step()
+                h_masks[0, i, 0] = 0
+                if done:
+                    epi_length = recorder.length
+                    yield epi_length, recorder.get_epi()
+                    active[i] = False
+                    if max_steps > n_steps_global and max_epis > n_epis_global + sum(active):
+                        active[i] = True
+                        obs[i] = prepro(env.reset())
+                        h_masks[0, i, 0] = 1
+                else:
+                    obs[i] = prepro(next_o)
+
+
+def mp_vec_sample(pol, env, num_envs, max_steps, max_epis, n_steps_global, n_epis_global, epi_queue, exec_events, counter_lock, deterministic_flag, process_id, prepro=None, seed=256):
+    """
+    Multiprocess sample with vectorized environments.
+    Sampling episodes until max_steps or max_epis is achieved.
+
+    Parameters
+    ----------
+    pol : Pol
+    env : gym.Env
+        This env is copied num_envs times in each process.
+    num_envs : int
+        Number of environments stepped in lockstep.
+    max_steps : int
+        maximum steps of episodes
+    max_epis : int
+        maximum episodes of episodes
+    n_steps_global : torch.Tensor
+        shared Tensor
+    n_epis_global : torch.Tensor
+        shared Tensor
+    epi_queue : torch.multiprocessing.Queue
+        Queue for sending episodes written on shared memory.
+    exec_events : list of multiprocessing.Event
+        Sampling is started when the event is set.
+    counter_lock : multiprocessing.Lock
+        Lock for n_steps_global and n_epis_global.
+    deterministic_flag : torch.Tensor
+    process_id : int
+    prepro : Prepro
+    seed : int
+    """
+
+    np.random.seed(seed + process_id)
+    torch.manual_seed(seed + process_id)
+    torch.set_num_threads(1)
+
+    envs = [copy.deepcopy(env) for _ in range(num_envs)]
+    for i, e in enumerate(envs):
+        if hasattr(e, 'original_env') and hasattr(e.original_env, 'seed'):
+            e.original_env.seed(seed + process_id * num_envs + i)
+
+    writer = SharedEpiWriter(epi_queue, process_id)
+    while True:
+        exec_events[process_id].wait()
+        exec_events[process_id].clear()
+        writer.reset()
+        for l, epi in vec_epis(envs, pol, max_steps, max_epis, n_steps_global, n_epis_global, deterministic_flag, prepro):
+            with counter_lock:
+                n_steps_global += l
+                n_epis_global += 1
+            writer.write(epi)
+        writer.finish()
+
+
+class VecEpiSampler(EpiSampler):
+    """
+    A sampler which sample episodes with vectorized environments.
+    Each process steps num_envs copies of env in lockstep
+    and calls the policy once per step with a batch of observations.
+    Sampled episodes are same format as EpiSampler.
+
+    Parameters
+    ----------
+    env : gym.Env
+    pol : Pol
+        Pol which can take a batch of observations.
+    num_parallel : int
+        Number of processes
+    num_envs : int
+        Number of environments in each process.
+    prepro : Prepro
+    seed : int
+    half_params : bool
+        If True, parameters of pol are transferred to sampling processes in float16.
+    """
+
+    def __init__(self, env, pol, num_parallel=8, num_envs=8, prepro=None, seed=256, half_params=False):
+        self.num_envs = num_envs
+        EpiSampler.__init__(self, env, pol, num_parallel,
+                            prepro, seed, half_params)
+
+    def _make_process(self, env, process_id, prepro, seed):
+        return mp.Process(target=mp_vec_sample, args=(self.pol, env, self.num_envs, self.max_steps, self.max_epis, self.n_steps_global,
+                                                      self.n_epis_global, self.epi_queue, self.exec_events, self.counter_lock,
+                                                      self.deterministic_flag, process_id, prepro, seed))
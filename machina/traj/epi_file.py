@@ -0,0 +1,350 @@
+"""
+Columnar file format of episodes.
+
+Episodes are stored in a directory.
+Each field of episodes is concatenated over all steps and saved in one .npy file.
+Fields in nested dict like a_is and e_is are saved as <key>.<new_key>.npy.
+epis_index.npy holds boundaries of episodes and is written last,
+so a directory without it is regarded as incomplete.
+Files are opened with np.memmap, and only steps which are read are loaded.
+
+EpiWriter appends episodes to a directory of chunks,
+each of which is a subdirectory in the format above.
+merge_chunks merges them into one directory in the format above.
+"""
+
+import os
+import queue
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+from machina.traj.traj import Traj
+
+INDEX_FNAME = 'epis_index.npy'
+CHUNK_FORMAT = 'chunk_{:06d}'
+TMP_SUFFIX = '.tmp'
+MERGED_DIRNAME = 'merged'
+CHUNKS_FNAME = 'chunks.txt'
+
+
+def _fields(epi):
+    fields = dict()
+    for key, value in epi.items():
+        if isinstance(value, dict):
+            for new_key in value:
+                fields[key + '.' + new_key] = (key, new_key)
+        elif isinstance(value, list) or isinstance(value, np.ndarray):
+            fields[key] = (key, )
+    return fields
+
+
+def _get_field(epi, path):
+    for key in path:
+        epi = epi[key]
+    return epi
+
+
+def _numpy_dtype(dtype):
+    return torch.empty(0, dtype=dtype).numpy().dtype
+
+
+def save_epis(epis, dirname, dtypes=None):
+    """
+    Saving episodes to a directory.
+    Values are cast to float32 as in Traj.register_epis unless dtypes are given.
+    Each file is written through np.memmap, so episodes are not concatenated in memory.
+
+    Parameters
+    ----------
+    epis : list of dict
+    dirname : str
+    dtypes : dict or None
+        torch dtypes of keys as in Traj, e.g. dict(obs=torch.uint8).
+    """
+    dtypes = dtypes if dtypes is not None else dict()
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    index_path = os.path.join(dirname, INDEX_FNAME)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+    lengths = [len(epi['rews']) for epi in epis]
+    epis_index = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    for name, path in _fields(epis[0]).items():
+        dtype = _numpy_dtype(dtypes.get(path[-1], torch.float))
+        first = np.asarray(_get_field(epis[0], path), dtype=dtype)
+        array = np.lib.format.open_memmap(
+            os.path.join(dirname, name + '.npy'), mode='w+', dtype=dtype,
+            shape=(epis_index[-1], ) + first.shape[1:])
+        for epi, start, end in zip(epis, epis_index[:-1], epis_index[1:]):
+            array[start:end] = _get_field(epi, path)
+        array.flush()
+        del array
+    np.save(index_path, epis_index)
+
+
+def _chunk_dirs(dirname):
+    # chunks being written have TMP_SUFFIX and are ignored
+    return [os.path.join(dirname, name) for name in sorted(os.listdir(dirname))
+            if name.startswith('chunk_') and not name.endswith(TMP_SUFFIX)]
+
+
+def _open_fields(dirname):
+    epis_index = np.load(os.path.join(dirname, INDEX_FNAME))
+    arrays = dict()
+    for fname in sorted(os.listdir(dirname)):
+        if fname == INDEX_FNAME or not fname.endswith('.npy'):
+            continue
+        # copy on write, so that data_map can be modified without changing files
+        arrays[fname[:-len('.npy')]] = np.load(
+            os.path.join(dirname, fname), mmap_mode='c')
+    return epis_index, arrays
+
+
+def load_epis(dirname):
+    """
+    Opening episodes in a directory.
+    Values of episodes are slices of memory mapped files.
+    If the directory is written by EpiWriter, episodes of all chunks are opened.
+
+    Parameters
+    ----------
+    dirname : str
+
+    Returns
+    -------
+    epis : list of dict
+    """
+    if not os.path.exists(os.path.join(dirname, INDEX_FNAME)):
+        return [epi for chunk_dir in _chunk_dirs(dirname) for epi in load_epis(chunk_dir)]
+    epis_index, arrays = _open_fields(dirname)
+    epis = []
+    for start, end in zip(epis_index[:-1], epis_index[1:]):
+        epi = dict()
+        for name, array in arrays.items():
+            keys = name.split('.')
+            if len(keys) == 1:
+                epi[name] = array[start:end]
+            else:
+                epi.setdefault(keys[0], dict())[keys[1]] = array[start:end]
+        epis.append(epi)
+    return epis
+
+
+def merge_chunks(dirname, merged_dirname=None):
+    """
+    Merging chunks written by EpiWriter into one directory in the format of save_epis.
+    Chunks are copied one by one through np.memmap, so they are not loaded in memory at once.
+    Names of merged chunks are recorded, and the directory is merged again
+    only when chunks are added.
+
+    Parameters
+    ----------
+    dirname : str
+        Directory written by EpiWriter.
+    merged_dirname : str or None
+        If None, <dirname>/merged is used.
+
+    Returns
+    -------
+    merged_dirname : str
+    """
+    if merged_dirname is None:
+        merged_dirname = os.path.join(dirname, MERGED_DIRNAME)
+    chunk_dirs = _chunk_dirs(dirname)
+    if not chunk_dirs:
+        raise ValueError('No chunk is found in {}.'.format(dirname))
+    chunk_names = [os.path.basename(chunk_dir) for chunk_dir in chunk_dirs]
+    chunks_path = os.path.join(merged_dirname, CHUNKS_FNAME)
+    index_path = os.path.join(merged_dirname, INDEX_FNAME)
+    if os.path.exists(index_path) and os.path.exists(chunks_path):
+        with open(chunks_path) as f:
+            if f.read().split() == chunk_names:
+                return merged_dirname
+
+    if not os.path.exists(merged_dirname):
+        os.makedirs(merged_dirname)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    chunk_indices = [np.load(os.path.join(chunk_dir, INDEX_FNAME))
+                     for chunk_dir in chunk_dirs]
+    offsets = np.concatenate(
+        [[0], np.cumsum([index[-1] for index in chunk_indices])])
+    epis_index = np.concatenate([[0]] + [index[1:] + offset for index, offset in zip(
+        chunk_indices, offsets)]).astype(np.int64)
+    _, first_arrays = _open_fields(chunk_dirs[0])
+    for name, first in first_arrays.items():
+        array = np.lib.format.open_memmap(
+            os.path.join(merged_dirname, name + '.npy'), mode='w+', dtype=first.dtype,
+            shape=(offsets[-1], ) + first.shape[1:])
+        for chunk_dir, start, end in zip(chunk_dirs, offsets[:-1], offsets[1:]):
+            array[start:end] = np.load(os.path.join(
+                chunk_dir, name + '.npy'), mmap_mode='r')
+        array.flush()
+        del array
+    with open(chunks_path, 'w') as f:
+        f.write('\n'.join(chunk_names))
+    np.save(index_path, epis_index)
+    return merged_dirname
+
+
+def load_traj(dirname, start_epi=0, end_epi=None):
+    """
+    Opening episodes in a directory as Traj without copy.
+    data_map is made of tensors on memory mapped files,
+    and the Traj is on_host, so that batches are read from files on demand.
+    Keys saved in other dtypes than float32 are kept in them as dtypes of the Traj.
+    Chunks written by EpiWriter are merged by merge_chunks and opened.
+
+    Parameters
+    ----------
+    dirname : str
+    start_epi : int
+        First episode which is opened.
+    end_epi : int or None
+        Episode after the last opened one.
+        If None, episodes until the end are opened.
+
+    Returns
+    -------
+    traj : Traj
+    """
+    if not os.path.exists(os.path.join(dirname, INDEX_FNAME)):
+        dirname = merge_chunks(dirname)
+
+    epis_index, arrays = _open_fields(dirname)
+    epis_index = epis_index[start_epi:None if end_epi is None else end_epi + 1]
+    start, end = epis_index[0], epis_index[-1]
+
+    traj = Traj(on_host=True)
+    for name, array in arrays.items():
+        key = name.split('.')[-1]
+        traj.data_map[key] = torch.from_numpy(array[start:end])
+        if traj.data_map[key].dtype != torch.float:
+            traj.dtypes[key] = traj.data_map[key].dtype
+    traj._epis_index = epis_index - start
+    return traj
+
+
+def _copy_epi(epi):
+    _epi = dict()
+    for key, value in epi.items():
+        if isinstance(value, dict):
+            _epi[key] = _copy_epi(value)
+        elif isinstance(value, list) or isinstance(value, np.ndarray):
+            _epi[key] = np.array(value)
+    return _epi
+
+
+class EpiWriter(object):
+    """
+    Writer which streams episodes to a directory from a background thread.
+
+    Episodes are buffered until chunk_steps is reached and written as a chunk,
+    which is a subdirectory in the format of save_epis.
+    A chunk is written under a temporary name and renamed when it is complete,
+    so a crash loses only buffered episodes and never leaves a broken chunk.
+    Chunks already in the directory are kept and new ones are appended after them.
+    Written episodes are read by load_epis and load_traj.
+
+    This can be given to EpiSampler.add_sink.
+
+    Parameters
+    ----------
+    dirname : str
+    chunk_steps : int
+        Number of steps of a chunk.
+    max_queued_epis : int
+        If this number of episodes are waiting to be written,
+        write blocks until they are written.
+    dtypes : dict or None
+        dtypes of keys given to save_epis.
+    """
+
+    def __init__(self, dirname, chunk_steps=100000, max_queued_epis=100, dtypes=None):
+        self.dirname = dirname
+        self.chunk_steps = chunk_steps
+        self.dtypes = dtypes
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        for name in os.listdir(dirname):
+            if name.startswith('chunk_') and name.endswith(TMP_SUFFIX):
+                shutil.rmtree(os.path.join(dirname, name))
+        chunk_dirs = _chunk_dirs(dirname)
+        self.num_chunk = int(os.path.basename(
+            chunk_dirs[-1])[len('chunk_'):]) + 1 if chunk_dirs else 0
+
+        self._queue = queue.Queue(max_queued_epis)
+        self._error = None
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError('Writing episodes failed.') from self._error
+
+    def write(self, epi):
+        """
+        Queueing an episode to be written.
+        Arrays of the episode are copied, so it can be modified after this call.
+
+        Parameters
+        ----------
+        epi : dict
+        """
+        if self._thread is None:
+            raise RuntimeError('EpiWriter is already closed.')
+        epi = _copy_epi(epi)
+        while True:
+            self._check_error()
+            try:
+                self._queue.put(epi, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _write_chunk(self, epis):
+        name = CHUNK_FORMAT.format(self.num_chunk)
+        tmp_dirname = os.path.join(self.dirname, name + TMP_SUFFIX)
+        save_epis(epis, tmp_dirname, self.dtypes)
+        os.rename(tmp_dirname, os.path.join(self.dirname, name))
+        self.num_chunk += 1
+
+    def _loop(self):
+        epis = []
+        num_step = 0
+        try:
+            while True:
+                epi = self._queue.get()
+                if epi is None:
+                    break
+                epis.append(epi)
+                num_step += len(epi['rews'])
+                if num_step >= self.chunk_steps:
+                    self._write_chunk(epis)
+                    epis = []
+                    num_step = 0
+            if len(epis) > 0:
+                self._write_chunk(epis)
+        except Exception as e:
+            self._error = e
+
+    def close(self):
+        """
+        Writing all queued episodes and stopping the thread.
+        """
+        if self._thread is None:
+            return
+        while self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=1)
+                break
+            except queue.Full:
+                continue
+        self._thread.join()
+        self._thread = None
+        self._check_error()
@@ -6,35 +6,95 @@ import numpy as np
 import copy
 import torch
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 
 from machina.utils import get_device
 from machina import loss_functional as lf
 
 
-def compute_vs(data, vf):
+def _get_epis_index(epis):
+    lengths = [len(epi['rews']) for epi in epis]
+    return np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+
+def _apply_epis(epis, keys, func, rnn=False, batch_size=None):
+    """
+    Applying func to all episodes at once.
+    Without rnn, steps of all episodes are concatenated.
+    With rnn, episodes are padded at the end into sequences of shape (max_length, num_epi, *),
+    and outputs of padded steps are dropped.
+
+    Parameters
+    ----------
+    epis : list of dict
+    keys : list of str
+        Keys of episodes which are given to func.
+    func : function
+        Function which takes dict of torch.Tensor and returns torch.Tensor.
+    rnn : bool
+    batch_size : int or None
+        Maximum number of steps (episodes if rnn) given to func at once.
+        If None, all of them are given at once.
+
+    Returns
+    -------
+    outs : list of np.ndarray
+        Outputs of each episode.
+    """
+    lengths = [len(epi['rews']) for epi in epis]
+    outs = []
+    with torch.no_grad():
+        if rnn:
+            batch_size = len(epis) if batch_size is None else batch_size
+            for i in range(0, len(epis), batch_size):
+                data_map = dict()
+                for key in keys:
+                    data_map[key] = pad_sequence([torch.tensor(
+                        epi[key], dtype=torch.float, device=get_device()) for epi in epis[i:i+batch_size]])
+                out = func(data_map).detach().cpu().numpy()
+                # shape of outputs is same as a sequence of batch size 1
+                outs.extend([out[:l, j:j+1]
+                             for j, l in enumerate(lengths[i:i+batch_size])])
+        else:
+            num_step = sum(lengths)
+            batch_size = num_step if batch_size is None else batch_size
+            data_map = dict()
+            for key in keys:
+                data_map[key] = torch.tensor(np.concatenate(
+                    [epi[key] for epi in epis]), dtype=torch.float, device=get_device())
+            out = np.concatenate([func(dict([(key, data_map[key][i:i+batch_size]) for key in keys])).detach().cpu().numpy()
+                                  for i in range(0, num_step, batch_size)])
+            epis_index = _get_epis_index(epis)
+            outs = [out[start:end]
+                    for start, end in zip(epis_index[:-1], epis_index[1:])]
+    return outs
+
+
+def compute_vs(data, vf, batch_size=None):
     """
     Computing Value Function.
+    All episodes are evaluated at once.
 
     Parameters
     ----------
     data : Traj
     vf : SVFunction
+    batch_size : int or None
+        Maximum number of steps (episodes if rnn) evaluated at once.
+        If None, all of them are evaluated at once.
 
     Returns
     -------
     data : Traj
     """
     epis = data.current_epis
-    vf.reset()
-    with torch.no_grad():
-        for epi in epis:
-            if vf.rnn:
-                obs = torch.tensor(
-                    epi['obs'], dtype=torch.float, device=get_device()).unsqueeze(1)
-            else:
-                obs = torch.tensor(
-                    epi['obs'], dtype=torch.float, device=get_device())
-            epi['vs'] = vf(obs)[0].detach().cpu().numpy()
+
+    def func(data_map):
+        vf.reset()
+        return vf(data_map['obs'])[0]
+    vs = _apply_epis(epis, ['obs'], func, vf.rnn, batch_size)
+    for epi, v in zip(epis, vs):
+        epi['vs'] = v
 
     return data
 
@@ -47,27 +107,23 @@ def set_all_pris(data, pri):
     return data
 
 
-def compute_pris(data, qf, targ_qf, pol, gamma, continuous=True, deterministic=True, rnn=False, sampling=1, alpha=0.6, epsilon=1e-6):
+def compute_pris(data, qf, targ_qf, pol, gamma, continuous=True, deterministic=True, rnn=False, sampling=1, alpha=0.6, epsilon=1e-6, batch_size=None):
     if continuous:
         epis = data.current_epis
-        for epi in epis:
-            data_map = dict()
-            keys = ['obs', 'acs', 'rews', 'next_obs', 'dones']
-            for key in keys:
-                data_map[key] = torch.tensor(epi[key], device=get_device())
+
+        def func(data_map):
             if rnn:
                 qf.reset()
                 targ_qf.reset()
                 pol.reset()
-                keys = ['obs', 'acs', 'next_obs']
-                for key in keys:
-                    data_map[key] = data_map[key].unsqueeze(1)
-            with torch.no_grad():
-                bellman_loss = lf.bellman(
-                    qf, targ_qf, pol, data_map, gamma, continuous, deterministic, sampling, reduction='none')
-                td_loss = torch.sqrt(bellman_loss*2)
-                pris = (torch.abs(td_loss) + epsilon) ** alpha
-                epi['pris'] = pris.cpu().numpy()
+            bellman_loss = lf.bellman(
+                qf, targ_qf, pol, data_map, gamma, continuous, deterministic, sampling, reduction='none')
+            td_loss = torch.sqrt(bellman_loss*2)
+            return (torch.abs(td_loss) + epsilon) ** alpha
+        pris = _apply_epis(epis, ['obs', 'acs', 'rews', 'next_obs', 'dones'],
+                           func, rnn, batch_size)
+        for epi, pri in zip(epis, pris):
+            epi['pris'] = pri
         return data
     else:
         raise NotImplementedError(
@@ -90,16 +146,106 @@ def compute_seq_pris(data, seq_length, eta=0.9):
     data : Traj
     """
     epis = data.current_epis
-    for epi in epis:
-        n_seq = len(epi['pris']) - seq_length + 1
-        abs_pris = np.abs(epi['pris'])
-        seq_pris = np.array([eta * np.max(abs_pris[i:i+seq_length]) + (1 - eta) *
-                             np.mean(abs_pris[i:i+seq_length]) for i in range(n_seq)], dtype='float32')
-        pad = np.zeros((seq_length - 1,), dtype='float32')
-        epi['seq_pris'] = np.concatenate([seq_pris, pad])
+    epis_index = _get_epis_index(epis)
+    abs_pris = np.abs(np.concatenate(
+        [np.reshape(epi['pris'], -1) for epi in epis]))
+    seq_pris = np.zeros(len(abs_pris), dtype='float32')
+    if len(abs_pris) >= seq_length:
+        # sliding windows without copy
+        windows = np.lib.stride_tricks.as_strided(
+            abs_pris, (len(abs_pris) - seq_length + 1, seq_length),
+            (abs_pris.strides[0], abs_pris.strides[0]), writeable=False)
+        values = eta * np.max(windows, axis=1) + \
+            (1 - eta) * np.mean(windows, axis=1)
+        # sequences which cross the end of episode are left 0
+        epi_ends = np.repeat(epis_index[1:], np.diff(epis_index))
+        starts = np.arange(len(values))
+        valid = starts + seq_length <= epi_ends[:len(values)]
+        seq_pris[starts[valid]] = values[valid]
+    for epi, start, end in zip(epis, epis_index[:-1], epis_index[1:]):
+        epi['seq_pris'] = seq_pris[start:end]
     return data
 
 
+def _discounted_cumsum_loop(xs, discount, epis_index):
+    # loop is over steps of the longest episode and vectorized over episodes
+    lengths = np.diff(epis_index)
+    # longer episodes come first, so running episodes are always a prefix
+    order = np.argsort(-lengths, kind='stable')
+    lengths = lengths[order]
+    ends = epis_index[1:][order] - 1
+    if isinstance(xs, torch.Tensor):
+        sums = torch.zeros_like(xs)
+        ends = torch.as_tensor(ends, dtype=torch.long, device=xs.device)
+    else:
+        sums = np.zeros_like(xs)
+    num_epi = len(lengths)
+    max_length = lengths[0] if num_epi > 0 else 0
+    for k in range(max_length):
+        while lengths[num_epi - 1] <= k:
+            num_epi -= 1
+        indices = ends[:num_epi] - k
+        if k == 0:
+            sums[indices] = xs[indices]
+        else:
+            sums[indices] = xs[indices] + discount * sums[indices + 1]
+    return sums
+
+
+def _discounted_cumsum_scan(xs, discount, epis_index):
+    # segmented scan by doubling offsets,
+    # loop is over log2 of steps of the longest episode and vectorized over all steps
+    lengths = np.diff(epis_index)
+    # number of steps until the end of episode
+    rest = np.repeat(epis_index[1:], lengths) - \
+        np.arange(epis_index[0], epis_index[-1])
+    if isinstance(xs, torch.Tensor):
+        sums = xs.clone()
+        rest = torch.as_tensor(rest, device=xs.device)
+    else:
+        sums = np.array(xs)
+    rest = rest.reshape((-1, ) + (1, ) * (len(xs.shape) - 1))
+    max_length = np.max(lengths) if len(lengths) > 0 else 0
+    offset = 1
+    # after each iteration, sums[i] is the sum of values in [i, i + 2 * offset)
+    while offset < max_length:
+        # right hand side is computed before addition
+        sums[:-offset] += discount ** offset * \
+            sums[offset:] * (rest[:-offset] > offset)
+        offset *= 2
+    return sums
+
+
+def discounted_cumsum(xs, discount, epis_index):
+    """
+    Computing discounted cumulative sums backward in each episode
+    for concatenated episodes at once.
+    If there are many episodes compared to steps of the longest one,
+    steps are looped and episodes are vectorized.
+    Otherwise, e.g. for a few long episodes,
+    a segmented scan over all steps is used, which loops log2 of steps.
+
+    Parameters
+    ----------
+    xs : np.ndarray or torch.Tensor
+        Concatenated values of episodes.
+        Sums are accumulated in dtype and on device of xs.
+    discount : float
+    epis_index : np.ndarray
+        Boundaries of episodes like Traj._epis_index.
+
+    Returns
+    -------
+    sums : np.ndarray or torch.Tensor
+    """
+    epis_index = np.asarray(epis_index, dtype=np.int64)
+    lengths = np.diff(epis_index)
+    if len(lengths) == 0 or np.max(lengths) <= 8 * len(lengths):
+        return _discounted_cumsum_loop(xs, discount, epis_index)
+    else:
+        return _discounted_cumsum_scan(xs, discount, epis_index)
+
+
 def compute_rets(data, gamma):
     """
     Computing discounted cumulative returns.
@@ -115,13 +261,11 @@ def compute_rets(data, gamma):
     data : Traj
     """
     epis = data.current_epis
-    for epi in epis:
-        rews = epi['rews']
-        rets = np.empty(len(rews), dtype=np.float32)
-        last_rew = 0
-        for t in reversed(range(len(rews))):
-            rets[t] = last_rew = rews[t] + gamma * last_rew
-        epi['rets'] = rets
+    epis_index = _get_epis_index(epis)
+    rews = np.concatenate([epi['rews'] for epi in epis]).astype(np.float64)
+    rets = discounted_cumsum(rews, gamma, epis_index).astype(np.float32)
+    for epi, start, end in zip(epis, epis_index[:-1], epis_index[1:]):
+        epi['rets'] = rets[start:end]
 
     return data
 
@@ -143,54 +287,74 @@ def compute_advs(data, gamma, lam):
     data : Traj
     """
     epis = data.current_epis
-    for epi in epis:
-        rews = epi['rews']
-        vs = epi['vs']
-        vs = np.append(vs, 0)
-        advs = np.empty(len(rews), dtype=np.float32)
-        last_gaelam = 0
-        for t in reversed(range(len(rews))):
-            delta = rews[t] + gamma * vs[t + 1] - vs[t]
-            advs[t] = last_gaelam = delta + gamma * lam * last_gaelam
-        epi['advs'] = advs
+    epis_index = _get_epis_index(epis)
+    rews = np.concatenate([epi['rews'] for epi in epis]).astype(np.float64)
+    vs = np.concatenate([epi['vs'].reshape(-1)
+                         for epi in epis]).astype(np.float64)
+    next_vs = np.append(vs[1:], 0)
+    next_vs[epis_index[1:] - 1] = 0
+    deltas = rews + gamma * next_vs - vs
+    advs = discounted_cumsum(
+        deltas, gamma * lam, epis_index).astype(np.float32)
+    for epi, start, end in zip(epis, epis_index[:-1], epis_index[1:]):
+        epi['advs'] = advs[start:end]
 
     return data
 
 
-def compute_hs(data, func, hs_name='hs', input_acs=False):
+def compute_hs(data, func, hs_name='hs', input_acs=False, batch_size=None):
     """
     Computing Hidden State of RNN Cell.
+    Episodes are padded into a batch and func is called once per time step for all of them.
+    Each episode starts from initial hidden state.
 
     Parameters
     ----------
     data : Traj
     func : 
         Any function. for example pols, vf and qf.
+    hs_name : str
+    input_acs : bool
+        If True, actions are also given to func.
+    batch_size : int or None
+        Number of episodes computed at once.
+        If None, all episodes are computed at once.
 
     Returns
     -------
     data : Traj
     """
     epis = data.current_epis
-    func.reset()
+    batch_size = len(epis) if batch_size is None else batch_size
     with torch.no_grad():
-        for epi in epis:
-            obs = torch.tensor(
-                epi['obs'], dtype=torch.float, device=get_device()).unsqueeze(1)
-            time_seq = obs.size()[0]
+        for i in range(0, len(epis), batch_size):
+            _epis = epis[i:i+batch_size]
+            obs = pad_sequence([torch.tensor(
+                epi['obs'], dtype=torch.float, device=get_device()) for epi in _epis])
             if input_acs:
-                acs = torch.tensor(
-                    epi['acs'], dtype=torch.float, device=get_device()).unsqueeze(1)
-                hs_seq = [func(obs[i:i+1], acs[i:i+1])[-1]['hs']
-                          for i in range(time_seq)]
-            else:
-                hs_seq = [func(obs[i:i+1])[-1]['hs'] for i in range(time_seq)]
-            if isinstance(hs_seq[0], tuple):
-                hs = np.array([[h.squeeze().detach().cpu().numpy()
-                                for h in hs] for hs in hs_seq], dtype='float32')
-            else:
-                hs = np.array(hs.detach().cpu().numpy(), dtype='float32')
-            epi[hs_name] = hs
+                acs = pad_sequence([torch.tensor(
+                    epi['acs'], dtype=torch.float, device=get_device()) for epi in _epis])
+            func.reset()
+            hs_seq = []
+            for t in range(obs.size(0)):
+                if input_acs:
+                    hs = func(obs[t:t+1], acs[t:t+1])[-1]['hs']
+                else:
+                    hs = func(obs[t:t+1])[-1]['hs']
+                if isinstance(hs, tuple):
+                    # (batch_size, *) -> (len(hs), batch_size, *)
+                    hs = torch.stack([h.reshape(len(_epis), -1)
+                                      for h in hs])
+                else:
+                    hs = hs.reshape(len(_epis), -1)
+                hs_seq.append(hs)
+            hs_seq = torch.stack(hs_seq).cpu().numpy()
+            for j, epi in enumerate(_epis):
+                if hs_seq.ndim == 4:
+                    hs = hs_seq[:len(epi['obs']), :, j]
+                else:
+                    hs = hs_seq[:len(epi['obs']), j]
+                epi[hs_name] = np.array(hs, dtype='float32')
 
     return data
 
@@ -231,10 +395,8 @@ def add_next_obs(data):
     """
     epis = data.current_epis
     for epi in epis:
-        obs = epi['obs']
-        _obs = [ob for ob in obs]
-        next_obs = np.array(_obs[1:] + _obs[:1], dtype=np.float32)
-        epi['next_obs'] = next_obs
+        epi['next_obs'] = np.roll(
+            np.asarray(epi['obs'], dtype=np.float32), -1, axis=0)
 
     return data
 
@@ -261,20 +423,20 @@ def compute_h_masks(data):
     return data
 
 
-def compute_pseudo_rews(data, rew_giver, state_only=False):
+def compute_pseudo_rews(data, rew_giver, state_only=False, batch_size=None):
     epis = data.current_epis
-    for epi in epis:
-        obs = torch.tensor(epi['obs'], dtype=torch.float, device=get_device())
+
+    def func(data_map):
         if state_only:
-            logits, _ = rew_giver(obs)
+            logits, _ = rew_giver(data_map['obs'])
         else:
-            acs = torch.tensor(
-                epi['acs'], dtype=torch.float, device=get_device())
-            logits, _ = rew_giver(obs, acs)
-        with torch.no_grad():
-            rews = -F.logsigmoid(-logits).cpu().numpy()
+            logits, _ = rew_giver(data_map['obs'], data_map['acs'])
+        return -F.logsigmoid(-logits)
+    keys = ['obs'] if state_only else ['obs', 'acs']
+    rews = _apply_epis(epis, keys, func, batch_size=batch_size)
+    for epi, rew in zip(epis, rews):
         epi['real_rews'] = copy.deepcopy(epi['rews'])
-        epi['rews'] = rews
+        epi['rews'] = rew
     return data
 
 
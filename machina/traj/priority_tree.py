@@ -0,0 +1,110 @@
+"""
+Tree of priorities for prioritized experience replay.
+"""
+
+import numpy as np
+
+
+class PriorityTree(object):
+    """
+    Sum tree and min tree of priorities.
+    Sampling and updating take O(log N) for each index,
+    and they are vectorized over a batch of indices.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of priorities which the tree can hold.
+    """
+
+    def __init__(self, capacity):
+        size = 1
+        while size < capacity:
+            size *= 2
+        self.size = size
+        self.capacity = capacity
+        self.sums = np.zeros(2 * size, dtype=np.float64)
+        self.mins = np.full(2 * size, np.inf, dtype=np.float64)
+
+    def build(self, pris):
+        """
+        Setting all priorities at once.
+
+        Parameters
+        ----------
+        pris : np.ndarray
+            Priorities from index 0. Rest of the tree is cleared.
+        """
+        leaves = np.zeros(self.size, dtype=np.float64)
+        leaves[:len(pris)] = pris
+        self.sums[self.size:] = leaves
+        # items which are never sampled are ignored in min tree
+        self.mins[self.size:] = np.where(leaves > 0, leaves, np.inf)
+        level = self.size
+        while level > 1:
+            self.sums[level//2:level] = self.sums[level:2 *
+                                                  level].reshape(-1, 2).sum(axis=1)
+            self.mins[level//2:level] = self.mins[level:2 *
+                                                  level].reshape(-1, 2).min(axis=1)
+            level //= 2
+
+    def update(self, indices, pris):
+        """
+        Updating priorities of indices.
+
+        Parameters
+        ----------
+        indices : np.ndarray
+        pris : np.ndarray
+            If pris is None, priorities of indices are removed.
+        """
+        nodes = np.asarray(indices, dtype=np.int64) + self.size
+        if pris is None:
+            self.sums[nodes] = 0
+            self.mins[nodes] = np.inf
+        else:
+            pris = np.asarray(pris, dtype=np.float64)
+            self.sums[nodes] = pris
+            self.mins[nodes] = np.where(pris > 0, pris, np.inf)
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.sums[nodes] = self.sums[2 * nodes] + self.sums[2 * nodes + 1]
+            self.mins[nodes] = np.minimum(
+                self.mins[2 * nodes], self.mins[2 * nodes + 1])
+            if nodes[0] == 1:
+                break
+            nodes = np.unique(nodes // 2)
+
+    def get(self, indices):
+        return self.sums[np.asarray(indices, dtype=np.int64) + self.size]
+
+    def total(self):
+        return self.sums[1]
+
+    def min(self):
+        """
+        Minimum of positive priorities.
+        """
+        return self.mins[1]
+
+    def sample(self, batch_size):
+        """
+        Sampling indices in proportion to priorities.
+
+        Parameters
+        ----------
+        batch_size : int
+
+        Returns
+        -------
+        indices : np.ndarray
+        """
+        values = np.random.uniform(0, self.total(), batch_size)
+        nodes = np.ones(batch_size, dtype=np.int64)
+        while nodes[0] < self.size:
+            lefts = self.sums[2 * nodes]
+            # rounding error should not lead to empty subtree
+            right = (values >= lefts) & (self.sums[2 * nodes + 1] > 0)
+            values = np.where(right, values - lefts, values)
+            nodes = 2 * nodes + right
+        return np.minimum(nodes - self.size, self.capacity - 1)
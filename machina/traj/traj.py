@@ -2,14 +2,15 @@
 trajectory class
 """
 
-import functools
+import queue
+import threading
 
 import numpy as np
 import torch
-from torch.nn.utils.rnn import pad_sequence
 import torch.utils.data
 
 from machina import loss_functional as lf
+from machina.traj.priority_tree import PriorityTree
 from machina.utils import get_device
 
 LARGE_NUMBER = 1000000000000
@@ -22,9 +23,31 @@ class Traj(object):
     An episode is a sequence of steps.
 
     This class provides batch methods.
+
+    Parameters
+    ----------
+    max_steps : int or None
+        Maximum number of steps stored by add_traj.
+        Storage for add_traj is grown until max_steps
+        and used as a ring buffer after that.
+    on_host : bool
+        If True, data_map is kept in host memory, which is pinned if cuda is available,
+        instead of get_device().
+        Batches are gathered on host and copied to get_device() without blocking.
+        This allows a trajectory larger than gpu memory.
+    dtypes : dict or None
+        dtypes of keys in data_map, e.g.
+        dict(obs=torch.uint8, dones=torch.bool, hs=torch.half).
+        Other keys are stored in torch.float.
+        Batches are cast to torch.float when they are gathered.
+    virtual_next_obs : bool
+        If True, next_obs is not stored and batches have next_obs
+        gathered from obs at the next step in the same episode.
+        As in epi_functional.add_next_obs,
+        next_obs of the last step is the first obs of the episode.
     """
 
-    def __init__(self, max_steps=None):
+    def __init__(self, max_steps=None, on_host=False, dtypes=None, virtual_next_obs=False):
         self.data_map = dict()
         self._next_id = 0
 
@@ -32,6 +55,18 @@ class Traj(object):
         self._epis_index = np.array([0])
 
         self.max_steps = max_steps if max_steps is not None else LARGE_NUMBER
+        self.on_host = on_host
+        self.dtypes = dtypes if dtypes is not None else dict()
+        self.virtual_next_obs = virtual_next_obs
+
+        self._storage = None
+        self._capacity = 0
+        self._head = 0
+
+        self._pri_tree = None
+        self._pri_tree_key = None
+        self._rank_probs = None
+        self._rank_probs_key = None
 
     @property
     def num_step(self):
@@ -50,31 +85,75 @@ class Traj(object):
     def add_epis(self, epis):
         self.current_epis = epis
 
-    def _concat_data_map(self, data_map, remain_index=None):
+    def _data_device(self):
+        return torch.device('cpu') if self.on_host else get_device()
+
+    def _pin(self, tensor):
+        if self.on_host and torch.cuda.is_available():
+            return tensor.pin_memory()
+        return tensor
+
+    def _to_device(self, data_map):
+        """
+        Transferring a batch to get_device() and casting it to torch.float.
+        A batch gathered on host is pinned so that the copy does not block,
+        and values in compact dtypes are cast after the copy.
+        """
+        device = get_device()
+        batch = dict()
+        for key, value in data_map.items():
+            if self.on_host and device.type != 'cpu':
+                value = self._pin(value).to(device, non_blocking=True)
+            batch[key] = value.float()
+        return batch
+
+    def _next_indices(self, indices):
+        if isinstance(indices, slice):
+            indices = torch.arange(
+                *indices.indices(self.num_step), device=self._data_device())
+        epis_index = torch.as_tensor(
+            self._epis_index, dtype=torch.long, device=indices.device)
+        epi_ends = torch.searchsorted(epis_index, indices, right=True)
+        next_indices = indices + 1
+        return torch.where(next_indices == epis_index[epi_ends], epis_index[epi_ends - 1], next_indices)
+
+    def _take(self, indices):
+        """
+        Taking steps of all keys by indices, which is a tensor or a slice.
+        next_obs is gathered from obs if virtual_next_obs is True.
+        """
+        data_map = dict()
+        for key in self.data_map:
+            data_map[key] = self.data_map[key][indices]
+        if self.virtual_next_obs:
+            data_map['next_obs'] = self.data_map['obs'][self._next_indices(
+                indices)]
+        return data_map
+
+    def _concat_data_map(self, data_map):
         if self.data_map:
             for key in data_map:
-                if remain_index is not None:
-                    self.data_map[key] = torch.cat(
-                        [self.data_map[key][self._epis_index[remain_index]:], data_map[key]], dim=0)
-                else:
-                    self.data_map[key] = torch.cat(
-                        [self.data_map[key], data_map[key]], dim=0)
+                self.data_map[key] = self._pin(torch.cat(
+                    [self.data_map[key], data_map[key]], dim=0))
         else:
-            self.data_map = data_map
+            self.data_map = {key: self._pin(value)
+                             for key, value in data_map.items()}
 
     def register_epis(self):
         epis = self.current_epis
         keys = epis[0].keys()
         data_map = dict()
         for key in keys:
+            if self.virtual_next_obs and key == 'next_obs':
+                continue
             if isinstance(epis[0][key], list) or isinstance(epis[0][key], np.ndarray):
                 data_map[key] = torch.tensor(np.concatenate(
-                    [epi[key] for epi in epis], axis=0), dtype=torch.float, device=get_device())
+                    [epi[key] for epi in epis], axis=0), dtype=self.dtypes.get(key, torch.float), device=self._data_device())
             elif isinstance(epis[0][key], dict):
                 new_keys = epis[0][key].keys()
                 for new_key in new_keys:
                     data_map[new_key] = torch.tensor(np.concatenate(
-                        [epi[key][new_key] for epi in epis], axis=0), dtype=torch.float, device=get_device())
+                        [epi[key][new_key] for epi in epis], axis=0), dtype=self.dtypes.get(new_key, torch.float), device=self._data_device())
 
         self._concat_data_map(data_map)
 
@@ -89,43 +168,144 @@ class Traj(object):
 
         self.current_epis = None
 
+    def _is_stored(self):
+        # data_map may be replaced by other tensors than views of storage
+        if self._storage is None:
+            return False
+        for key in self.data_map:
+            if key not in self._storage:
+                return False
+            if self.data_map[key].data_ptr() != self._storage[key].data_ptr():
+                return False
+            if len(self.data_map[key]) != self.num_step:
+                return False
+        return True
+
+    def _update_views(self):
+        for key in self._storage:
+            self.data_map[key] = self._storage[key][:self.num_step]
+
+    def _reserve(self, num_step, data_map):
+        if self._is_stored() and num_step <= self._capacity:
+            return
+        capacity = max(num_step, min(2 * self._capacity, self.max_steps))
+        storage = dict()
+        for key in set(self.data_map.keys()) | set(data_map.keys()):
+            tensor = data_map[key] if key in data_map else self.data_map[key]
+            storage[key] = self._pin(torch.zeros(
+                (capacity, ) + tensor.shape[1:], dtype=self.dtypes.get(key, tensor.dtype), device=self._data_device()))
+            if key in self.data_map:
+                storage[key][:self.num_step] = self.data_map[key][:self.num_step]
+        self._storage = storage
+        self._capacity = capacity
+        self._update_views()
+        self._pri_tree = None
+
     def add_traj(self, traj):
+        """
+        Adding episodes of traj.
+        Episodes are written in place into storage, which is grown until max_steps.
+        After that, storage is used as a ring buffer and new episodes overwrite oldest steps.
+        An episode is not split at the end of storage.
+        Oldest steps behind the end of last episode are dropped instead,
+        and an episode whose first steps are overwritten remains as a shorter episode.
+
+        Parameters
+        ----------
+        traj : Traj
+        """
         epis_index = traj._epis_index
-        pre_num_step = self.num_step
-        add_num_step = traj.num_step
-        if pre_num_step + add_num_step <= self.max_steps:
-            self._concat_data_map(traj.data_map)
-            epis_index = epis_index + self._epis_index[-1]
-            self._epis_index = np.concatenate(
-                [self._epis_index, epis_index[1:]])
-        elif add_num_step <= self.max_steps:
-            remain_index = 0
-            while self.max_steps < pre_num_step + add_num_step - self._epis_index[remain_index]:
-                remain_index += 1
-            self._concat_data_map(traj.data_map, remain_index)
-            self._epis_index = self._epis_index[remain_index:] - \
-                self._epis_index[remain_index]
-            epis_index = epis_index + self._epis_index[-1]
-            self._epis_index = np.concatenate(
-                [self._epis_index, epis_index[1:]])
-        else:  # self.max_steps < add_step
-            remain_index = -1
-            while self.max_steps < epis_index[remain_index]:
-                if remain_index == - len(epis_index):
-                    raise ValueError(
-                        'max_steps should be larger than the number of steps in one episode.')
-                remain_index -= 1
-            for key in traj.data_map:
-                self.data_map[key] = traj.data_map[key][:epis_index[remain_index]]
-            self._epis_index = traj._epis_index[:remain_index+1]
+        data_map = dict([(key, value) for key, value in traj.data_map.items()
+                         if not (self.virtual_next_obs and key == 'next_obs')])
+        if np.any(np.diff(epis_index) > self.max_steps):
+            raise ValueError(
+                'max_steps should be larger than the number of steps in one episode.')
+        if not self._is_stored():
+            self._head = self.num_step
+
+        num_epi = len(epis_index) - 1
+        i = 0
+        while i < num_epi:
+            # episodes which fit before the end of storage are written at once
+            j = i
+            while j < num_epi and self._head + epis_index[j+1] - epis_index[i] <= self.max_steps:
+                j += 1
+            if j == i:
+                self._update_pri_tree(
+                    np.arange(self._head, self.num_step), remove=True)
+                self._epis_index = self._epis_index[self._epis_index <= self._head]
+                self._head = 0
+                self._update_views()
+                continue
+            start, end = epis_index[i], epis_index[j]
+            length = end - start
+            head = self._head
+            self._reserve(max(self.num_step, head + length), data_map)
+            for key in data_map:
+                self._storage[key][head:head +
+                                   length] = data_map[key][start:end]
+            index = self._epis_index
+            index = index[(index < head) | (index > head + length)]
+            self._epis_index = np.sort(np.concatenate(
+                [index, epis_index[i:j+1] - start + head]))
+            self._head = head + length
+            self._update_views()
+            self._update_pri_tree(np.arange(head, head + length))
+            i = j
+
+    def _get_pri_tree(self):
+        key = (self.data_map['pris'].data_ptr(), self.num_step)
+        if self._pri_tree is None or self._pri_tree_key != key:
+            self._pri_tree = PriorityTree(max(self._capacity, self.num_step))
+            self._pri_tree.build(self.data_map['pris'].cpu().numpy())
+            self._pri_tree_key = key
+        return self._pri_tree
+
+    def _get_rank_probs(self, alpha):
+        """
+        Probabilities of rank_based mode and their cumulative sum.
+        They are cached until data_map['pris'] is reallocated or changed in place.
+        """
+        pris = self.data_map['pris']
+        key = (pris.data_ptr(), self.num_step, pris._version, alpha)
+        if self._rank_probs is None or self._rank_probs_key != key:
+            index = np.argsort(-pris.cpu().numpy())
+            probs = ((index.astype(np.float32)+1) ** -1) ** alpha
+            probs = probs / probs.sum()
+            cdf = np.cumsum(probs)
+            cdf /= cdf[-1]
+            self._rank_probs = (probs, cdf, np.min(probs))
+            self._rank_probs_key = key
+        return self._rank_probs
+
+    def _update_pri_tree(self, indices, remove=False):
+        """
+        Updating priority tree after data_map['pris'][indices] is changed in place.
+        If the tree is not built or out of date, it is rebuilt when it is used.
+        """
+        if self._pri_tree is None or 'pris' not in self.data_map or len(indices) == 0:
+            return
+        if self._pri_tree_key[0] != self.data_map['pris'].data_ptr():
+            return
+        if remove:
+            self._pri_tree.update(indices, None)
+        else:
+            indices = torch.as_tensor(indices, dtype=torch.long).cpu()
+            pris = self.data_map['pris'][indices.to(
+                self.data_map['pris'].device)]
+            self._pri_tree.update(indices.numpy(), pris.cpu().numpy())
+        self._pri_tree_key = (self.data_map['pris'].data_ptr(), self.num_step)
 
     def _shuffled_indices(self, indices):
-        return indices[torch.randperm(len(indices), device=get_device())]
+        return indices[torch.randperm(len(indices), device=indices.device)]
 
     def _get_indices(self, indices=None, shuffle=True):
         if indices is None:
             indices = torch.arange(
-                self.num_step, device=get_device(), dtype=torch.long)
+                self.num_step, device=self._data_device(), dtype=torch.long)
+        else:
+            indices = torch.as_tensor(
+                indices, dtype=torch.long, device=self._data_device())
         if shuffle:
             indices = self._shuffled_indices(indices)
         return indices
@@ -135,10 +315,7 @@ class Traj(object):
         cur_batch_size = min(batch_size, len(indices) - self._next_id)
         self._next_id += cur_batch_size
 
-        data_map = dict()
-        for key in self.data_map:
-            data_map[key] = self.data_map[key][cur_id:cur_id+cur_batch_size]
-        return data_map
+        return self._to_device(self._take(slice(cur_id, cur_id+cur_batch_size)))
 
     def iterate_once(self, batch_size, indices=None, shuffle=True):
         """
@@ -211,15 +388,37 @@ class Traj(object):
         """
         indices = self._get_indices(indices, shuffle=True)
 
-        data_map = dict()
-        for key in self.data_map:
-            data_map[key] = self.data_map[key][indices[:batch_size]]
+        data_map = self._to_device(self._take(indices[:batch_size]))
         if return_indices:
             return data_map, indices
         else:
             return data_map
 
     def prioritized_random_batch_once(self, batch_size, return_indices=False, mode='proportional', alpha=0.6, init_beta=0.4, beta_step=0.00025/4):
+        """
+        Providing a batch which is sampled in proportion to priorities.
+        In proportional mode, a sum tree of data_map['pris'] is used for sampling.
+        In rank_based mode, probabilities are cached until priorities are changed.
+        Priorities should be updated by traj_functional.update_pris
+        to keep the tree up to date without rebuilding.
+
+        Parameters
+        ----------
+        batch_size : int
+        return_indices : bool
+            If True, indices are also returned.
+        mode : str
+            'proportional' or 'rank_based'
+        alpha : float
+            Used only in rank_based mode.
+        init_beta : float
+        beta_step : float
+
+        Returns
+        -------
+        data_map : dict of torch.Tensor
+            data_map['is_weights'] is importance sampling weights.
+        """
         if hasattr(self, 'pri_beta') == False:
             self.pri_beta = init_beta
         elif self.pri_beta >= 1.0:
@@ -227,24 +426,26 @@ class Traj(object):
         else:
             self.pri_beta += beta_step
 
-        pris = self.data_map['pris'].cpu().numpy()
-
         if mode == 'rank_based':
-            index = np.argsort(-pris)
-            pris = (index.astype(np.float32)+1) ** -1
-            pris = pris ** alpha
-
-        is_weights = (len(pris) * (pris/pris.sum())) ** -self.pri_beta
-        is_weights /= np.max(is_weights)
-        pris *= is_weights
-        pris = torch.tensor(pris)
-        indices = torch.utils.data.sampler.WeightedRandomSampler(
-            pris, batch_size, replacement=True)
-        indices = [index for index in indices]
-
-        data_map = dict()
-        for key in self.data_map:
-            data_map[key] = self.data_map[key][indices]
+            probs, cdf, min_prob = self._get_rank_probs(alpha)
+            indices = np.searchsorted(
+                cdf, np.random.random_sample(batch_size), side='right')
+            probs = probs[indices]
+        else:
+            tree = self._get_pri_tree()
+            indices = tree.sample(batch_size)
+            probs = tree.get(indices) / tree.total()
+            min_prob = tree.min() / tree.total()
+
+        # importance sampling weights normalized by the maximum over trajectory
+        is_weights = (probs / min_prob) ** -self.pri_beta
+        indices = torch.tensor(indices, dtype=torch.long,
+                               device=self._data_device())
+
+        data_map = self._take(indices)
+        data_map['is_weights'] = torch.tensor(
+            is_weights, dtype=torch.float, device=self._data_device())
+        data_map = self._to_device(data_map)
         if return_indices:
             return data_map, indices
         else:
@@ -258,32 +459,62 @@ class Traj(object):
         else:
             self.pri_beta += beta_step
 
-        seq_pris = self.data_map['seq_pris'].clone().detach()
-
-        start_indices = torch.utils.data.sampler.WeightedRandomSampler(
-            seq_pris, batch_size)  # , replacement=True)
-        start_indices = [idx for idx in start_indices]
-
-        seqs = []
-        length = []
-        for start in start_indices:
-            data_map = dict()
-            for key in self.data_map:
-                data_map[key] = self.data_map[key][start: start+seq_length]
-            seqs.append(data_map)
+        seq_pris = self.data_map['seq_pris']
+        start_indices = torch.multinomial(
+            seq_pris, batch_size, replacement=True)
 
-        batch = dict()
-        keys = seqs[0].keys()
-        for key in keys:
-            batch[key] = torch.stack([seq[key] for seq in seqs], dim=0)
-            # (batch_size, seq_length, *) -> (seq_length, batch_size, *)
-            batch[key] = batch[key].transpose(0, 1)
+        batch = self._gather_seqs(start_indices, seq_length)
 
         if return_indices:
             return batch, start_indices
         else:
             return batch
 
+    def _gather_seqs(self, start_indices, seq_length, lengths=None):
+        """
+        Gathering sequences of shape (seq_length, batch_size, *) at once.
+
+        Parameters
+        ----------
+        start_indices : torch.Tensor
+        seq_length : int
+        lengths : torch.Tensor or None
+            Lengths of valid steps of each sequence.
+            Steps after them are filled with 0.
+
+        Returns
+        -------
+        batch : dict of torch.Tensor
+        """
+        device = start_indices.device
+        steps = torch.arange(seq_length, device=device).unsqueeze(1)
+        indices = start_indices.unsqueeze(0) + steps
+        if lengths is None:
+            return self._gather(indices)
+        masks = (steps < lengths.unsqueeze(0)).to(torch.float)
+        return self._gather(indices, masks)
+
+    def _gather(self, indices, masks=None):
+        """
+        Gathering steps of all keys by an index tensor of shape (seq_length, batch_size).
+        If masks is given, masked steps are filled with 0
+        and masks are returned as out_masks.
+        """
+        if masks is not None:
+            indices = torch.where(masks > 0, indices,
+                                  torch.zeros_like(indices))
+        batch = self._take(indices)
+        if masks is None:
+            return self._to_device(batch)
+        keys = list(batch.keys())
+        batch['out_masks'] = masks
+        batch = self._to_device(batch)
+        masks = batch['out_masks']
+        for key in keys:
+            batch[key] = batch[key] * \
+                masks.reshape(masks.shape + (1, ) * (batch[key].dim() - 2))
+        return batch
+
     def random_batch(self, batch_size, epoch=1, indices=None, return_indices=False):
         """
         Providing batches which is randomly sampled from trajectory.
@@ -306,7 +537,7 @@ class Traj(object):
             if return_indices:
                 batch, indices = self.random_batch_once(
                     batch_size, indices, return_indices)
-                yield batch. indices
+                yield batch, indices
             else:
                 batch = self.random_batch_once(
                     batch_size, indices, return_indices)
@@ -316,6 +547,7 @@ class Traj(object):
         """
         Providing sequences of batch which is randomly sampled from trajectory.
         batch shape is (seq_length, batch_size, *)
+        Sequences are gathered at once by an index tensor of shape (seq_length, batch_size).
 
         Parameters
         ----------
@@ -328,47 +560,24 @@ class Traj(object):
         Returns
         -------
         batch : dict of torch.Tensor
+            Steps after the end of episode are 0 and masked by batch['out_masks'].
         """
 
+        epis_index = self._epis_index
+        epi_lengths = np.diff(epis_index)
         if seq_length is None:
-            seq_length = max([self._epis_index[i+1] - self._epis_index[i]
-                              for i in range(len(self._epis_index)-1)])
+            seq_length = np.max(epi_lengths)
 
         for _ in range(epoch):
-            seqs = []
-            lengths = []
             indices = np.random.randint(
-                0, len(self._epis_index)-1, (batch_size,))
-
-            for idx in indices:
-                length = min(
-                    self._epis_index[idx+1] - self._epis_index[idx], seq_length)
-                start = np.random.randint(
-                    self._epis_index[idx], self._epis_index[idx+1] - length + 1)
-                data_map = dict()
-                for key in self.data_map:
-                    if self._epis_index[-1] - self._epis_index[idx] < seq_length:
-                        pad = torch.zeros_like(self.data_map[key][:seq_length-length],
-                                               dtype=torch.float, device=get_device())
-                        data_map[key] = torch.cat(
-                            [self.data_map[key][start: start+length], pad])
-                    else:
-                        data_map[key] = self.data_map[key][start: start+seq_length]
-                lengths.append(length)
-                seqs.append(data_map)
-
-            batch = dict()
-            keys = seqs[0].keys()
-            for key in keys:
-                batch[key] = torch.stack([seq[key] for seq in seqs])
-                # (batch_size, seq_length, *) -> (seq_length, batch_size, *)
-                batch[key] = batch[key].transpose(0, 1)
-            out_masks = torch.ones(
-                (seq_length, batch_size), dtype=torch.float, device=get_device())
-            for i in range(batch_size):
-                out_masks[lengths[i]:, i] = 0
-            batch['out_masks'] = out_masks
-            yield batch
+                0, len(epis_index)-1, (batch_size,))
+            lengths = np.minimum(epi_lengths[indices], seq_length)
+            start_indices = np.random.randint(
+                epis_index[indices], epis_index[indices+1] - lengths + 1)
+            yield self._gather_seqs(
+                torch.tensor(start_indices, dtype=torch.long,
+                             device=self._data_device()), seq_length,
+                torch.tensor(lengths, dtype=torch.long, device=self._data_device()))
 
     def prioritized_random_batch(self, batch_size, epoch=1, return_indices=False):
         for _ in range(epoch):
@@ -406,7 +615,7 @@ class Traj(object):
                     batch_size, seq_length, return_indices)
                 yield batch, start_indices
             else:
-                batch = self.prioritized_random_batch_once(
+                batch = self.prioritized_random_batch_rnn_once(
                     batch_size, seq_length, return_indices)
                 yield batch
 
@@ -425,10 +634,11 @@ class Traj(object):
         data_map : dict of torch.Tensor
         """
         for _ in range(epoch):
+            data_map = self._take(slice(0, self.num_step))
             if return_indices:
-                yield self.data_map, torch.arange(self.num_step, device=get_device())
+                yield self._to_device(data_map), torch.arange(self.num_step, device=self._data_device())
             else:
-                yield self.data_map
+                yield self._to_device(data_map)
 
     def iterate_epi(self, shuffle=True):
         """
@@ -442,23 +652,20 @@ class Traj(object):
         -------
         epis : dict of torch.Tensor
         """
-        epis = []
-        for i in range(len(self._epis_index) - 1):
-            data_map = dict()
-            for key in self.data_map:
-                data_map[key] = self.data_map[key][self._epis_index[i]                                                   :self._epis_index[i+1]]
-            epis.append(data_map)
         if shuffle:
-            indices = np.random.permutation(range(len(epis)))
+            indices = np.random.permutation(self.num_epi)
         else:
-            indices = range(len(epis))
+            indices = range(self.num_epi)
         for idx in indices:
-            yield epis[idx]
+            start, end = self._epis_index[idx], self._epis_index[idx+1]
+            yield self._to_device(self._take(slice(start, end)))
 
     def iterate_rnn(self, batch_size, num_epi_per_seq=1, epoch=1):
         """
         Iterating batches for rnn.
         batch shape is (max_seq, batch_size, *)
+        Each epoch only permutes episodes, and a batch is gathered
+        from data_map at once with an index tensor computed from episode boundaries.
 
         Parameters
         ----------
@@ -472,40 +679,106 @@ class Traj(object):
         batch : dict of torch.Tensor
         """
         assert batch_size * num_epi_per_seq <= self.num_epi
+        epi_starts = self._epis_index[:-1]
+        epi_lengths = np.diff(self._epis_index)
+        num_seq = self.num_epi // num_epi_per_seq
         for _ in range(epoch):
-            epi_count = 0
-            all_batch = []
-            seq = []
-            for epi in self.iterate_epi(shuffle=True):
-                seq.append(epi)
-                epi_count += 1
-                if epi_count >= num_epi_per_seq:
-                    _seq = dict()
-                    for key in seq[0].keys():
-                        _seq[key] = torch.cat([s[key] for s in seq])
-                    all_batch.append(_seq)
-                    seq = []
-                    epi_count = 0
-            num_batch = len(all_batch)
-            idx = 0
-            while idx <= num_batch - batch_size:
-                cur_batch_size = min(batch_size, num_batch - idx)
-                batch = all_batch[idx:idx+cur_batch_size]
-                idx += cur_batch_size
-
-                lengths = [list(b.values())[0].size(0) for b in batch]
-                max_length = max(lengths)
-                out_masks = torch.ones(
-                    (max_length, cur_batch_size), dtype=torch.float, device=get_device())
-                time_slice = list(functools.reduce(
-                    lambda x, y: x+y, [list(range(l, max_length)) for l in lengths]))
-                batch_idx = list(functools.reduce(
-                    lambda x, y: x+y, [(max_length - l) * [i] for i, l in enumerate(lengths)]))
-                out_masks[time_slice, batch_idx] = 0
-
-                _batch = dict()
-                keys = batch[0].keys()
-                for key in keys:
-                    _batch[key] = pad_sequence([b[key] for b in batch])
-                _batch['out_masks'] = out_masks
-                yield _batch
+            seq_epis = np.random.permutation(self.num_epi)[
+                :num_seq * num_epi_per_seq].reshape(num_seq, num_epi_per_seq)
+            for idx in range(0, num_seq - batch_size + 1, batch_size):
+                epis = seq_epis[idx:idx+batch_size]
+                lengths = epi_lengths[epis]
+                ends = np.cumsum(lengths, axis=1)
+                seq_lengths = ends[:, -1]
+                steps = np.arange(np.max(seq_lengths))
+                # position of episode in sequence at each step, (batch_size, max_length)
+                pos = np.sum(steps[None, :, None] >=
+                             ends[:, None, :], axis=2)
+                pos = np.minimum(pos, num_epi_per_seq - 1)
+                rows = np.arange(len(epis))[:, None]
+                offsets = steps[None, :] - (ends - lengths)[rows, pos]
+                indices = epi_starts[epis][rows, pos] + offsets
+                masks = steps[:, None] < seq_lengths[None, :]
+                yield self._gather(
+                    torch.tensor(indices.T, dtype=torch.long,
+                                 device=self._data_device()),
+                    torch.tensor(masks, dtype=torch.float, device=self._data_device()))
+
+    def prefetch(self, batches, num_prefetch=2):
+        """
+        Preparing batches in a background thread.
+        While a batch is used, next batches are gathered on host
+        and copied to get_device() on a separate cuda stream.
+        If on_host is False, batches are returned as they are.
+        Priorities updated during iteration are not reflected in already prepared batches.
+
+        Parameters
+        ----------
+        batches : iterator
+            Batches of this trajectory, e.g. traj.random_batch(batch_size, epoch).
+        num_prefetch : int
+            Number of batches prepared in advance.
+
+        Returns
+        -------
+        batch : same as items of batches
+        """
+        if not self.on_host:
+            yield from batches
+            return
+
+        prepared = queue.Queue(num_prefetch)
+        stop = threading.Event()
+        stream = torch.cuda.Stream() if get_device().type == 'cuda' else None
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    prepared.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                with torch.cuda.stream(stream):
+                    for batch in batches:
+                        event = stream.record_event() if stream is not None else None
+                        if not put((batch, event)):
+                            return
+            except Exception as e:
+                put((e, None))
+                return
+            put(None)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = prepared.get()
+                if item is None:
+                    break
+                batch, event = item
+                if isinstance(batch, Exception):
+                    raise batch
+                if event is not None:
+                    current = torch.cuda.current_stream()
+                    current.wait_event(event)
+                    for tensor in _tensors(batch):
+                        if tensor.is_cuda:
+                            tensor.record_stream(current)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+def _tensors(item):
+    if isinstance(item, torch.Tensor):
+        return [item]
+    if isinstance(item, dict):
+        item = item.values()
+    elif not isinstance(item, (list, tuple)):
+        return []
+    return [tensor for value in item for tensor in _tensors(value)]
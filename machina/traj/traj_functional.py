@@ -6,7 +6,6 @@ import torch
 import numpy as np
 
 from machina import loss_functional as lf
-from machina.utils import get_device
 
 
 def update_pris(traj, td_loss, indices, alpha=0.6, epsilon=1e-6, update_epi_pris=False, seq_length=None, eta=0.9):
@@ -18,10 +17,12 @@ def update_pris(traj, td_loss, indices, alpha=0.6, epsilon=1e-6, update_epi_pris
     data : Traj
     td_loss : torch.Tensor
     indices : torch.Tensor ot List of int
+        Indices of td_loss.
+        Indices of several sequences can be given at once with same shape as td_loss.
     alpha : float
     epsilon : float
     update_epi_pris : bool
-        If True, all priorities of a episode including indices[0] are updated.
+        If True, sequence priorities of all episodes including indices are updated.
     seq_length : int
         Length of batch.
     eta : float
@@ -31,24 +32,53 @@ def update_pris(traj, td_loss, indices, alpha=0.6, epsilon=1e-6, update_epi_pris
     data : Traj
     """
     pris = (torch.abs(td_loss) + epsilon) ** alpha
-    traj.data_map['pris'][indices] = pris.detach()
+    indices = torch.as_tensor(indices, dtype=torch.long,
+                              device=traj.data_map['pris'].device)
+    traj.data_map['pris'][indices] = pris.detach().to(indices.device)
+    traj._update_pri_tree(indices.reshape(-1))
 
     if update_epi_pris:
-        epi_start = -1
-        epi_end = -1
-        seq_start = indices[0]
-        for i in range(1, len(traj._epis_index)):
-            if seq_start < traj._epis_index[i]:
-                epi_start = traj._epis_index[i-1]
-                epi_end = traj._epis_index[i]
-                break
-
-        pris = traj.data_map['pris'][epi_start: epi_end]
-        n_seq = len(pris) - seq_length + 1
-        abs_pris = np.abs(pris.cpu().numpy())
-        seq_pris = np.array([eta * np.max(abs_pris[i:i+seq_length]) + (1 - eta) *
-                             np.mean(abs_pris[i:i+seq_length]) for i in range(n_seq)], dtype='float32')
-        traj.data_map['seq_pris'][epi_start:epi_start +
-                                  n_seq] = torch.tensor(seq_pris, dtype=torch.float, device=get_device())
+        epis_index = traj._epis_index
+        epi_ids = np.unique(np.searchsorted(
+            epis_index, indices.reshape(-1).cpu().numpy(), side='right') - 1)
+        epi_starts = epis_index[epi_ids]
+        n_seqs = np.maximum(
+            epis_index[epi_ids + 1] - epi_starts - seq_length + 1, 0)
+        # start indices of all sequences in updated episodes
+        starts = np.repeat(epi_starts - np.cumsum(n_seqs) + n_seqs, n_seqs) + \
+            np.arange(np.sum(n_seqs))
+        if len(starts) > 0:
+            abs_pris = torch.abs(traj.data_map['pris'])
+            starts = torch.tensor(
+                starts, dtype=torch.long, device=abs_pris.device)
+            windows = abs_pris[starts.unsqueeze(
+                1) + torch.arange(seq_length, device=abs_pris.device)]
+            traj.data_map['seq_pris'][starts] = eta * torch.max(windows, dim=1)[0] + \
+                (1 - eta) * torch.mean(windows, dim=1)
 
     return traj
+
+
+def add_next_obs(traj):
+    """
+    Adding next observations to data_map.
+    As in epi_functional.add_next_obs,
+    next observation of the last step is the first observation of the episode.
+    This is used for registered trajectory, e.g. opened by epi_file.load_traj.
+
+    Parameters
+    ----------
+    traj : Traj
+
+    Returns
+    -------
+    traj : Traj
+    """
+    obs = traj.data_map['obs']
+    starts, ends = traj._epis_index[:-1], traj._epis_index[1:]
+    indices = np.arange(1, traj.num_step + 1)
+    nonempty = ends > starts
+    indices[ends[nonempty] - 1] = starts[nonempty]
+    traj.data_map['next_obs'] = obs[torch.as_tensor(
+        indices, dtype=torch.long, device=obs.device)]
+    return traj
@@ -1,3 +1,4 @@
 from machina.vfuncs.state_action_vfuncs.base import BaseSAVfunc
 from machina.vfuncs.state_action_vfuncs.deterministic_state_action_vfunc import DeterministicSAVfunc
 from machina.vfuncs.state_action_vfuncs.cem_state_action_vfunc import CEMDeterministicSAVfunc
+from machina.vfuncs.state_action_vfuncs.ensemble_state_action_vfunc import EnsembleSAVfunc
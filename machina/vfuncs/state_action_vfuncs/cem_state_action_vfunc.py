@@ -5,12 +5,15 @@ Deterministic State Action Value function with Cross Entropy Method
 from machina.vfuncs.state_action_vfuncs.deterministic_state_action_vfunc import DeterministicSAVfunc
 from machina.utils import get_device
 import torch
-from torch.distributions import Normal, MultivariateNormal
 
 
 class CEMDeterministicSAVfunc(DeterministicSAVfunc):
     """
     Deterministic State Action Vfunction with Cross Entropy Method.
+    Gaussians of all observations in a batch are fitted and sampled at once.
+    If eval_batch_size is given, samples are evaluated chunk by chunk
+    and only best samples are kept, so memory does not grow with num_sampling.
+
     Parameters
     ----------
     ob_space : gym.Space
@@ -27,21 +30,52 @@ class CEMDeterministicSAVfunc(DeterministicSAVfunc):
         Number of best samples used for fitting Gaussian in CEM.
     num_iter : int
         Number of iteration of CEM.
+    multivari : bool
+        If True, Gaussian with full covariance matrix is used.
+        Otherwise, Gaussian with diagonal covariance is used.
     delta : float
         Coefficient used for making covariance matrix positive definite.
+    elite_tol : float
+        If standard deviations of best samples of all observations are
+        less than this value, iteration of CEM is stopped early.
+        If 0, CEM is iterated num_iter times.
+    eval_batch_size : int or None
+        Maximum number of pairs of observation and action evaluated in one forward.
+        At least one sample per observation is evaluated in one forward.
+        If None, all samples are evaluated in one forward.
     """
 
-    def __init__(self, ob_space, ac_space, net, rnn=False, data_parallel=False, parallel_dim=0, num_sampling=64, num_best_sampling=6, num_iter=2, multivari=True, delta=1e-4):
+    def __init__(self, ob_space, ac_space, net, rnn=False, data_parallel=False, parallel_dim=0, num_sampling=64, num_best_sampling=6, num_iter=2, multivari=True, delta=1e-4, elite_tol=0., eval_batch_size=None):
         super().__init__(ob_space, ac_space, net, rnn, data_parallel, parallel_dim)
         self.num_sampling = num_sampling
         self.delta = delta
         self.num_best_sampling = num_best_sampling
         self.num_iter = num_iter
+        self.elite_tol = elite_tol
+        self.eval_batch_size = eval_batch_size
         self.net = net
         self.dim_ac = self.ac_space.shape[0]
         self.multivari = multivari
+        self._bounds_cache = dict()
         self.to(get_device())
 
+    def _bounds(self, device):
+        """
+        low, high, eye and initial samples on device.
+        They are made only once for each device.
+        """
+        if device not in self._bounds_cache:
+            low = torch.tensor(self.ac_space.low,
+                               dtype=torch.float, device=device)
+            high = torch.tensor(self.ac_space.high,
+                                dtype=torch.float, device=device)
+            eye = torch.eye(self.dim_ac, device=device)
+            init_samples = torch.linspace(0, 1, self.num_sampling, device=device).reshape(
+                self.num_sampling, -1) * (high - low) + low  # (self.num_sampling, dim_ac)
+            init_samples = torch.min(torch.max(init_samples, low), high)
+            self._bounds_cache[device] = (low, high, eye, init_samples)
+        return self._bounds_cache[device]
+
     def max(self, obs):
         """
         Max and Argmax of Qfunc
@@ -58,14 +92,9 @@ class CEMDeterministicSAVfunc(DeterministicSAVfunc):
 
         self.batch_size = obs.shape[0]
         self.dim_ob = obs.shape[1]
-        high = torch.tensor(self.ac_space.high,
-                            dtype=torch.float, device=get_device())
-        low = torch.tensor(
-            self.ac_space.low, dtype=torch.float, device=get_device())
-        init_samples = torch.linspace(0, 1, self.num_sampling, device=get_device()).reshape(
-            self.num_sampling, -1) * (high - low) + low  # (self.num_sampling, dim_ac)
-        init_samples = self._clamp(init_samples)
-        max_qs, max_acs = self._cem(obs, init_samples)
+        init_samples = self._bounds(obs.device)[3]
+        with torch.no_grad():
+            max_qs, max_acs = self._cem(obs, init_samples)
         return max_qs, max_acs
 
     def _cem(self, obs, init_samples):
@@ -80,91 +109,139 @@ class CEMDeterministicSAVfunc(DeterministicSAVfunc):
         -------
 
         """
-        obs = obs.repeat((1, self.num_sampling)).reshape(
-            (self.num_sampling * self.batch_size, self.dim_ob))
-        samples = init_samples.repeat((self.batch_size, 1))
+        batch_size = obs.shape[0]
+
+        def sampling(start, end):
+            return init_samples[start:end].expand(
+                (batch_size, end - start, self.dim_ac))
         for i in range(self.num_iter):
-            with torch.no_grad():
-                qvals, _ = self.forward(obs, samples)
-            if i != self.num_iter-1:
-                qvals = qvals.reshape((self.batch_size, self.num_sampling))
-                _, indices = torch.sort(qvals, dim=1, descending=True)
-                best_indices = indices[:, :self.num_best_sampling]
-                best_indices = best_indices + \
-                    torch.arange(0, self.num_sampling*self.batch_size,
-                                 self.num_sampling, device=get_device()).reshape(self.batch_size, 1)
-                best_indices = best_indices.reshape(
-                    (self.num_best_sampling * self.batch_size,))
-                # (self.num_best_sampling * self.batch_size,  self.dim_ac)
-                best_samples = samples[best_indices, :]
-                # (self.batch_size, self.num_best_sampling, self.dim_ac)
-                best_samples = best_samples.reshape(
-                    (self.batch_size, self.num_best_sampling, self.dim_ac))
-                samples = self._fitting_diag(
-                    best_samples) if not self.multivari else self._fitting_multivari(best_samples)
-        qvals = qvals.reshape((self.batch_size, self.num_sampling))
-        samples = samples.reshape(
-            (self.batch_size, self.num_sampling, self.dim_ac))
-        max_q, ind = torch.max(qvals, dim=1)
-        max_ac = samples[torch.arange(
-            self.batch_size, device=get_device()), ind]
-        max_ac = self._check_acs_shape(max_ac)
+            num_best = self.num_best_sampling if i != self.num_iter - 1 else 1
+            # (batch_size, num_best), (batch_size, num_best, self.dim_ac)
+            best_qvals, best_samples = self._evaluate(
+                obs, sampling, num_best)
+            if i == self.num_iter - 1:
+                break
+            if self.elite_tol > 0 and torch.std(best_samples, dim=1).max().item() < self.elite_tol:
+                break
+            mean, scale = self._fitting_diag(
+                best_samples) if not self.multivari else self._fitting_multivari(best_samples)
+
+            def sampling(start, end, mean=mean, scale=scale):
+                return self._sampling(mean, scale, end - start)
+        max_q = best_qvals[:, 0]
+        max_ac = self._check_acs_shape(best_samples[:, 0])
         return max_q, max_ac
 
+    def _evaluate(self, obs, sampling, num_best):
+        """
+        Evaluating samples chunk by chunk with keeping best samples.
+
+        Parameters
+        ----------
+        obs : torch.Tensor
+            shape (batch_size, dim_ob)
+        sampling : function
+            sampling(start, end) returns samples of shape (batch_size, end - start, self.dim_ac).
+        num_best : int
+            Number of kept best samples.
+
+        Returns
+        -------
+        best_qvals : torch.Tensor
+            shape (batch_size, num_best), sorted in descending order.
+        best_samples : torch.Tensor
+            shape (batch_size, num_best, self.dim_ac)
+        """
+        batch_size = obs.shape[0]
+        if self.eval_batch_size is None:
+            num_chunk_sampling = self.num_sampling
+        else:
+            num_chunk_sampling = min(
+                self.num_sampling, max(1, self.eval_batch_size // batch_size))
+        chunk_obs = None
+        best_qvals = best_samples = None
+        for start in range(0, self.num_sampling, num_chunk_sampling):
+            end = min(start + num_chunk_sampling, self.num_sampling)
+            samples = sampling(start, end)
+            if chunk_obs is None or chunk_obs.shape[0] != batch_size * (end - start):
+                chunk_obs = obs.unsqueeze(1).expand(
+                    (batch_size, end - start) + obs.shape[1:]).reshape((batch_size * (end - start), ) + obs.shape[1:])
+            qvals, _ = self.forward(
+                chunk_obs, samples.reshape((batch_size * (end - start), self.dim_ac)))
+            qvals = qvals.reshape((batch_size, end - start))
+            if best_qvals is not None:
+                qvals = torch.cat([best_qvals, qvals], dim=1)
+                samples = torch.cat([best_samples, samples], dim=1)
+            best_qvals, best_indices = torch.topk(
+                qvals, min(num_best, qvals.shape[1]), dim=1)
+            best_samples = torch.gather(
+                samples, 1, best_indices.unsqueeze(-1).expand(best_indices.shape + (self.dim_ac, )))
+        return best_qvals, best_samples
+
     def _fitting_diag(self, best_samples):
         """
-        fitting diagonal covariance gaussian and sampling from it
+        fitting diagonal covariance gaussian
         Parameters
         ----------
         best_samples : torch.Tensor
-            shape (self.batch_size, self.num_best_sampling, self.dim_ac)
+            shape (batch_size, self.num_best_sampling, self.dim_ac)
 
         Returns
         -------
-        samples : torch.Tensor
+        mean : torch.Tensor
+            shape (batch_size, 1, self.dim_ac)
+        std : torch.Tensor
+            shape (batch_size, 1, self.dim_ac)
         """
-        mean = torch.mean(
-            best_samples, dim=1)  # (self.batch_size, self.dim_ac)
-        std = torch.std(best_samples, dim=1)  # (self.batch_size, self.dim_ac)
-        samples = Normal(loc=mean, scale=std).rsample(
-            torch.Size((self.num_sampling,)))  # (self.num_best_sampling, self.batch_size, , self.dim_ac)
-        # (self.num_best_sampling, self.batch_size, self.dim_ac)
-        samples = samples.transpose(1, 0)
-        samples = samples.reshape((self.num_sampling * self.batch_size,
-                                   self.dim_ac))  # (self.num_best_sampling * self.batch_size,  self.dim_ac)
-        # (self.num_best_sampling * self.batch_size,  self.dim_ac)
-        samples = self._clamp(samples)
-        return samples
+        mean = torch.mean(best_samples, dim=1, keepdim=True)
+        # std of one sample is 0
+        std = torch.std(best_samples, dim=1, keepdim=True,
+                        unbiased=self.num_best_sampling > 1)
+        return mean, std
 
     def _fitting_multivari(self, best_samples):
         """
-        fitting multivariate gaussian and sampling from it
+        fitting multivariate gaussian.
+        Covariance matrices of all observations are decomposed by one batched Cholesky.
         Parameters
         ----------
         best_samples : torch.Tensor
-            shape (self.batch_size, self.num_best_sampling, self.dim_ac)
+            shape (batch_size, self.num_best_sampling, self.dim_ac)
 
+        Returns
+        -------
+        mean : torch.Tensor
+            shape (batch_size, 1, self.dim_ac)
+        scale_tril : torch.Tensor
+            shape (batch_size, self.dim_ac, self.dim_ac)
+        """
+        eye = self._bounds(best_samples.device)[2]
+        mean = best_samples.mean(dim=1, keepdim=True)
+        fs_m = best_samples - mean
+        # (batch_size, self.dim_ac, self.dim_ac)
+        cov_mat = torch.matmul(fs_m.transpose(1, 2), fs_m) / \
+            max(self.num_best_sampling - 1, 1)
+        cov_mat = cov_mat + self.delta * eye
+        scale_tril = torch.linalg.cholesky(cov_mat)
+        return mean, scale_tril
+
+    def _sampling(self, mean, scale, num_sampling):
+        """
+        sampling from gaussian fitted by _fitting_diag or _fitting_multivari
         Returns
         -------
         samples : torch.Tensor
+            shape (batch_size, num_sampling, self.dim_ac)
         """
-        def fitting(best_samples):
-            mean = best_samples.mean(dim=0)
-            fs_m = best_samples.sub(mean.expand_as(best_samples))
-            cov_mat = fs_m.transpose(0, 1).mm(fs_m) / (self.num_sampling - 1)
-            cov_mat = cov_mat + self.delta * torch.eye(cov_mat.shape[0])
-            pd = MultivariateNormal(mean, cov_mat)
-            samples = pd.sample((self.num_sampling,))
-            return samples
-        samples = torch.cat([fitting(best_sample)
-                             for best_sample in best_samples], dim=0)
-        return samples
+        noise = torch.randn((mean.shape[0], num_sampling, self.dim_ac),
+                            dtype=mean.dtype, device=mean.device)
+        if self.multivari:
+            samples = mean + torch.matmul(noise, scale.transpose(1, 2))
+        else:
+            samples = mean + scale * noise
+        return self._clamp(samples)
 
     def _clamp(self, samples):
-        low = torch.tensor(self.ac_space.low,
-                           dtype=torch.float, device=get_device())
-        high = torch.tensor(self.ac_space.high,
-                            dtype=torch.float, device=get_device())
-        samples = (samples - low) / (high - low)
-        samples = torch.clamp(samples, 0, 1) * (high - low) + low
+        low, high = self._bounds(samples.device)[:2]
+        samples = torch.min(torch.max(samples, low), high)
         return samples
@@ -0,0 +1,74 @@
+"""
+Ensemble of State Action Value functions
+"""
+
+import torch
+import torch.nn as nn
+
+try:
+    from torch.func import functional_call, vmap
+except ImportError:
+    vmap = None
+
+
+class EnsembleSAVfunc(nn.Module):
+    """
+    Ensemble of State Action Value Functions which have the same architecture.
+    Parameters of the value functions are stacked,
+    and all of them are computed in one forward with batched matmul.
+    Gradients are propagated to parameters of each value function,
+    so optimizers of them can be used as they are.
+    Parameters are stacked in every forward, so that updates of them
+    by any optimizer are reflected.
+    If vmap is not available or value functions are rnn or data parallel,
+    they are computed one by one.
+
+    Parameters
+    ----------
+    qfs : list of DeterministicSAVfunc
+    """
+
+    def __init__(self, qfs):
+        nn.Module.__init__(self)
+        self.qfs = nn.ModuleList(qfs)
+        shapes = [[(name, p.shape) for name, p in qf.named_parameters()]
+                  for qf in qfs]
+        self.stackable = vmap is not None and all(
+            [shape == shapes[0] for shape in shapes]) and not any([qf.rnn for qf in qfs])
+        # tensors of each name over value functions, which are stacked
+        self._params = dict()
+        for name, _ in qfs[0].named_parameters():
+            self._params[name] = [dict(qf.named_parameters())[name]
+                                  for qf in qfs]
+        self._buffers_of_qfs = dict()
+        for name, _ in qfs[0].named_buffers():
+            self._buffers_of_qfs[name] = [dict(qf.named_buffers())[name]
+                                          for qf in qfs]
+
+    def _stack(self):
+        params = {name: torch.stack(ps)
+                  for name, ps in self._params.items()}
+        buffers = {name: torch.stack(bs)
+                   for name, bs in self._buffers_of_qfs.items()}
+        return params, buffers
+
+    def forward(self, obs, acs):
+        """
+        Calculating values of all value functions.
+
+        Returns
+        -------
+        vs, info : torch.Tensor, dict
+            vs is of shape (len(qfs), *batch_shape).
+        """
+        if not self.stackable or any([qf.dp_run for qf in self.qfs]):
+            vs = torch.stack([qf(obs, acs)[0] for qf in self.qfs])
+            return vs, dict(mean=vs)
+
+        qf = self.qfs[0]
+
+        def call(params, buffers):
+            return functional_call(qf, (params, buffers), (obs, acs))[0]
+        params, buffers = self._stack()
+        vs = vmap(call)(params, buffers)
+        return vs, dict(mean=vs)
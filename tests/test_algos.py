@@ -3,6 +3,7 @@ Test script for algorithms.
 """
 
 import unittest
+from unittest import mock
 import os
 
 import os
@@ -19,11 +20,12 @@ from machina.pols import DeterministicActionNoisePol, ArgmaxQfPol, MPCPol, Rando
 from machina.noise import OUActionNoise
 from machina.algos import ppo_clip, ppo_kl, trpo, ddpg, sac, svg, qtopt, on_pol_teacher_distill, behavior_clone, gail, airl, mpc, r2d2_sac
 from machina.vfuncs import DeterministicSVfunc, DeterministicSAVfunc, CEMDeterministicSAVfunc
-from machina.models import DeterministicSModel
+from machina.models import DeterministicSModel, ModelEnsemble
+from machina.models import model_ensemble
 from machina.envs import GymEnv, C2DEnv
 from machina.traj import Traj
 from machina.traj import epi_functional as ef
-from machina.samplers import EpiSampler
+from machina.samplers import EpiSampler, VecEpiSampler
 from machina import logger
 from machina.utils import measure, set_device
 
@@ -473,6 +475,35 @@ class TestQTOPT(unittest.TestCase):
 
         del sampler
 
+    def test_cem_max(self):
+        class QuadNet(nn.Module):
+            def forward(self, ob, ac):
+                return -torch.sum((ac - ob[:, :1]) ** 2, dim=-1, keepdim=True)
+
+        ob_space = gym.spaces.Box(-1, 1, (4, ), dtype=np.float32)
+        ac_space = gym.spaces.Box(-1, 1, (3, ), dtype=np.float32)
+        obs = torch.rand(5, 4) - 0.5
+        for multivari, eval_batch_size in [(True, None), (False, None), (True, 64)]:
+            qf = CEMDeterministicSAVfunc(ob_space, ac_space, QuadNet(), num_sampling=500,
+                                         num_best_sampling=50, num_iter=5, multivari=multivari,
+                                         eval_batch_size=eval_batch_size)
+            max_qs, max_acs = qf.max(obs)
+            self.assertEqual(max_qs.shape, (5, ))
+            self.assertEqual(max_acs.shape, (5, 3))
+            self.assertTrue(torch.all(max_acs <= 1)
+                            and torch.all(max_acs >= -1))
+            self.assertLess(
+                torch.max(torch.abs(max_acs - obs[:, :1])).item(), 0.1)
+
+        # gaussian is fitted to only one best sample
+        for multivari in [True, False]:
+            qf = CEMDeterministicSAVfunc(ob_space, ac_space, QuadNet(), num_sampling=500,
+                                         num_best_sampling=1, num_iter=3, multivari=multivari)
+            max_qs, max_acs = qf.max(obs)
+            self.assertTrue(torch.all(torch.isfinite(max_qs)))
+            self.assertTrue(torch.all(max_acs <= 1)
+                            and torch.all(max_acs >= -1))
+
 
 class TestOnpolicyDistillation(unittest.TestCase):
     def setUp(self):
@@ -730,6 +761,80 @@ class TestMPC(unittest.TestCase):
 
         del sampler
 
+    def test_batched_planning(self):
+        def rew_func(next_obs, acs, mean_obs=0., std_obs=1., mean_acs=0., std_acs=1.):
+            next_obs = next_obs * std_obs + mean_obs
+            # Pendulum
+            rews = -(torch.acos(next_obs[:, 0].clamp(min=-1, max=1))**2 +
+                     0.1*(next_obs[:, 2].clamp(min=-8, max=8)**2) + 0.001 * acs.squeeze(-1)**2)
+            return rews
+
+        dm_net = ModelNet(self.env.ob_space, self.env.ac_space, 32, 32)
+        for method in ['random', 'cem', 'mppi']:
+            mpc_pol = MPCPol(self.env.ob_space, self.env.ac_space, dm_net, rew_func,
+                             16, 4, method=method, n_iter=2, warm_start=True)
+            sampler = VecEpiSampler(
+                self.env, mpc_pol, num_parallel=1, num_envs=3)
+            epis = sampler.sample(mpc_pol, max_steps=12)
+            self.assertEqual(len(epis), 3)
+            for epi in epis:
+                self.assertEqual(epi['acs'].shape, (len(epi['rews']), 1))
+                self.assertTrue(np.all(np.abs(epi['acs']) <= 2))
+            del sampler
+
+    def test_ensemble(self):
+        def rew_func(next_obs, acs, mean_obs=0., std_obs=1., mean_acs=0., std_acs=1.):
+            next_obs = next_obs * std_obs + mean_obs
+            # Pendulum
+            rews = -(torch.acos(next_obs[:, 0].clamp(min=-1, max=1))**2 +
+                     0.1*(next_obs[:, 2].clamp(min=-8, max=8)**2) + 0.001 * acs.squeeze(-1)**2)
+            return rews
+
+        dm_nets = [ModelNet(self.env.ob_space, self.env.ac_space, 32, 32)
+                   for _ in range(3)]
+        dm = ModelEnsemble(self.env.ob_space, self.env.ac_space, dm_nets)
+        obs = torch.randn(5, self.env.ob_space.shape[0])
+        acs = torch.randn(5, self.env.ac_space.shape[0])
+        d_obs, _ = dm(obs, acs)
+        self.assertEqual(d_obs.shape, (3, 5, self.env.ob_space.shape[0]))
+        for d_ob, dm_net in zip(d_obs, dm_nets):
+            self.assertTrue(torch.allclose(
+                d_ob, dm_net(obs, acs), atol=1e-5))
+        d_obs = dm.ts_forward(obs, acs)
+        self.assertTrue(torch.allclose(
+            d_obs[4], dm_nets[1](obs[4:], acs[4:])[0], atol=1e-5))
+
+        # without torch.func, models are computed one by one
+        all_d_obs, _ = dm(obs, acs)
+        with mock.patch.object(model_ensemble, 'vmap', None):
+            loop_dm = ModelEnsemble(
+                self.env.ob_space, self.env.ac_space, dm_nets)
+            loop_d_obs, _ = loop_dm(obs, acs)
+            self.assertTrue(torch.allclose(loop_d_obs, all_d_obs, atol=1e-5))
+            self.assertTrue(torch.allclose(
+                loop_dm.ts_forward(obs, acs), d_obs, atol=1e-5))
+            loop_d_obs, _ = loop_dm(obs.expand((3, 5, -1)), acs)
+            self.assertEqual(
+                loop_d_obs.shape, (3, 5, self.env.ob_space.shape[0]))
+
+        mpc_pol = MPCPol(self.env.ob_space, self.env.ac_space, dm, rew_func,
+                         8, 4, method='cem', n_iter=2)
+        optim_dm = torch.optim.Adam(dm.parameters(), 1e-3)
+
+        sampler = EpiSampler(self.env, mpc_pol, num_parallel=1)
+        epis = sampler.sample(mpc_pol, max_steps=32)
+
+        traj = Traj()
+        traj.add_epis(epis)
+        traj = ef.add_next_obs(traj)
+        traj.register_epis()
+
+        result_dict = mpc.train_dm(
+            traj, dm, optim_dm, epoch=2, batch_size=1)
+        self.assertTrue(np.all(np.isfinite(result_dict['DynModelLoss'])))
+
+        del sampler
+
 
 class TestR2D2SAC(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,241 @@
+"""
+Test script for loss functions.
+"""
+
+import copy
+import unittest
+
+import numpy as np
+import torch
+
+from machina import loss_functional as lf
+from machina.envs import GymEnv
+from machina.pols import GaussianPol
+from machina.vfuncs import DeterministicSAVfunc
+
+from simple_net import PolNetLSTM, QNetLSTM
+
+
+def r2d2_sac_loop(pol, qfs, targ_qfs, log_alpha, batch, gamma, sampling=1, burn_in_length=40, reparam=True, normalize=False, eps=1e-6):
+    """
+    Loss of the loop implementation before r2d2_sac was tensorized.
+    """
+    time_seq, batch_size, *_ = batch['obs'].size()
+    train_length = time_seq - burn_in_length - 1
+
+    pol.reset()
+    for qf, targ_qf in zip(qfs, targ_qfs):
+        qf.reset()
+        targ_qf.reset()
+
+    # trajectories for burn-in
+    bi_obs = batch['obs'][:burn_in_length]
+    bi_next_obs = batch['next_obs'][:burn_in_length]
+    bi_acs = batch['acs'][:burn_in_length]
+    bi_h_masks = batch['h_masks'][:burn_in_length]
+    bi_next_h_masks = batch['h_masks'][1:burn_in_length+1]
+
+    # trajectories for train
+    obs = batch['obs'][burn_in_length: -1]
+    acs = batch['acs'][burn_in_length: -1]
+    rews = batch['rews'][burn_in_length: -1]
+    next_obs = batch['next_obs'][burn_in_length: -1]
+    dones = batch['dones'][burn_in_length: -1]
+    h_masks = batch['h_masks'][burn_in_length: -1]
+    next_h_masks = batch['h_masks'][burn_in_length+1:]
+
+    # hidden states (time_seq, batch_size, *, cell_size)
+    init_a_hs = (batch['hs'][0, :, 0], batch['hs'][0, :, 1])
+    init_qf_hs = [(batch['q_hs'+str(i)][0, :, 0], batch['q_hs'+str(i)][0, :, 1])
+                  for i in range(len(qfs))]
+    init_targ_qf_hs = [(batch['targ_q_hs'+str(i)][0, :, 0],
+                        batch['targ_q_hs'+str(i)][0, :, 1]) for i in range(len(targ_qfs))]
+
+    alpha = torch.exp(log_alpha)
+
+    pol.hs = init_a_hs
+    # (time_seq, ['mean', 'log_std', 'hs'], *)
+    with torch.no_grad():
+        _bi_pd_params = pol(bi_obs, h_masks=bi_h_masks)[-1]
+        keys = sorted(_bi_pd_params.keys())
+        keys.remove('hs')
+        separated_bi_pd_params = [_bi_pd_params[key] for key in keys]
+        bi_pd_params = []
+        for params in zip(*separated_bi_pd_params):
+            params_dict = {key: param for key, param in zip(
+                keys, params)}
+            bi_pd_params.append(params_dict)
+
+    _pd_params = pol(obs, h_masks=h_masks)[-1]
+    keys = sorted(_pd_params.keys())
+    keys.remove('hs')
+    separated_pd_params = [_pd_params[key] for key in keys]
+    pd_params = []
+    for params in zip(*separated_pd_params):
+        params_dict = {key: param for key, param in zip(
+            keys, params)}
+        pd_params.append(params_dict)
+
+    bi_next_pd_params = bi_pd_params[1:] + pd_params[0:1]
+    next_pd_params = pd_params[1:] + \
+        [pol(batch["obs"][-1:], h_masks=next_h_masks[-1:])[-1]]
+    for key in sorted(pd_params[0].keys()):
+        next_pd_params[-1][key] = next_pd_params[-1][key][0]
+    pd = pol.pd
+
+    # (sampling, time_seq, batch_size, *)
+    bi_sampled_obs = bi_obs.expand([sampling] + list(bi_obs.size()))
+    bi_sampled_next_obs = bi_next_obs.expand(
+        [sampling] + list(bi_next_obs.size()))
+    sampled_obs = obs.expand([sampling] + list(obs.size()))
+    sampled_next_obs = next_obs.expand([sampling] + list(next_obs.size()))
+
+    # (time_seq, sampling, 1, batch_size, *)
+    bi_sampled_acs = torch.stack([pd.sample(bi_pd_params[i], torch.Size([sampling]))
+                                  for i in range(burn_in_length)])
+    bi_sampled_next_acs = torch.stack([pd.sample(bi_next_pd_params[i], torch.Size([sampling]))
+                                       for i in range(burn_in_length)])
+    sampled_acs = torch.stack([pd.sample(pd_params[i], torch.Size([sampling]))
+                               for i in range(train_length)])
+    sampled_next_acs = torch.stack([pd.sample(next_pd_params[i], torch.Size([sampling]))
+                                    for i in range(train_length)])
+
+    #    (time_seq, sampling, batch_size, *)
+    # -> (sampling, time_seq, batch_size, *)
+    bi_sampled_acs = bi_sampled_acs.transpose(0, 1)
+    bi_sampled_next_acs = bi_sampled_next_acs.transpose(0, 1)
+    sampled_acs = sampled_acs.transpose(0, 1)
+    sampled_next_acs = sampled_next_acs.transpose(0, 1)
+
+    # (sampling, time_seq, batch_size)
+    sampled_llh = torch.stack(
+        [torch.stack([pd.llh(sampled_acs[s][i].detach(), pd_params[i]) for i in range(train_length)]) for s in range(sampling)])
+    sampled_next_llh = torch.stack(
+        [torch.stack([pd.llh(sampled_next_acs[s][i], next_pd_params[i]) for i in range(train_length)]) for s in range(sampling)])
+
+    # forward of qfs and targ_qfs for burn-in
+    with torch.no_grad():
+        qf_hs = [[qf(bi_sampled_obs[i], bi_sampled_acs[i], hs=init_qf_hs[q],
+                     h_masks=bi_h_masks)[-1]['hs'] for i in range(sampling)] for q, qf in enumerate(qfs)]
+        targ_qf_hs = [[targ_qf(bi_sampled_next_obs[i], bi_sampled_next_acs[i], hs=init_targ_qf_hs[q],
+                               h_masks=bi_next_h_masks)[-1]['hs'] for i in range(sampling)] for q, targ_qf in enumerate(targ_qfs)]
+
+    # forward of qfs and targ_qfs for train
+    # (len(qfs), sampling, time_seq, batch_size)
+    sampled_qs = torch.stack([torch.stack([qf(sampled_obs[s], sampled_acs[s], hs=qf_hs[q][s], h_masks=h_masks)[
+        0] for s in range(sampling)]) for q, qf in enumerate(qfs)])
+    sampled_next_targ_qs = torch.stack([torch.stack([targ_qf(sampled_next_obs[s], sampled_next_acs[s], hs=targ_qf_hs[q][s], h_masks=next_h_masks)[
+        0] for s in range(sampling)]) for q, targ_qf in enumerate(targ_qfs)])
+
+    # (len(qfs), time_seq, batch_size)
+    next_vs = torch.stack([torch.mean(sampled_next_targ_q - alpha * sampled_next_llh, dim=0)
+                           for sampled_next_targ_q in sampled_next_targ_qs])
+
+    # (time-seq, batch_size)
+    next_vs = torch.min(next_vs, dim=0)[0]
+
+    # (time-seq, batch_size)
+    q_targ = rews + gamma * next_vs * (1 - dones)
+    q_targ = q_targ.detach()
+
+    for i in range(len(qfs)):
+        qfs[i].hs = init_qf_hs[i]
+
+    # (len(qfs), time_seq, batch_size)
+    with torch.no_grad():
+        _ = [qf(bi_obs, bi_acs, h_masks=bi_h_masks)[0] for qf in qfs]
+    qs = [qf(obs, acs, h_masks=h_masks)[0] for qf in qfs]
+
+    td_losses = [(q - q_targ) for q in qs]
+    qf_losses = [0.5 * torch.mean((td_loss)**2) for td_loss in td_losses]
+    td_losses = torch.stack([td_loss for td_loss in td_losses])
+    td_losses = torch.mean(td_losses, dim=0)
+
+    if reparam:
+        pol_losses = [torch.mean(torch.mean(alpha * sampled_llh - sampled_q, dim=0), dim=0)
+                      for sampled_q in sampled_qs]
+        pol_loss = torch.max(*pol_losses)
+        pol_loss = torch.mean(pol_loss)
+    else:
+        pg_weights = [torch.mean(torch.mean(
+            alpha * sampled_llh - sampled_q, dim=0), dim=0).detach() for sampled_q in sampled_qs]
+        pg_weight = torch.max(*pg_weights)
+
+        if normalize:
+            pg_weight = (pg_weight - pg_weight.mean()) / \
+                (pg_weight.std() + eps)
+
+        pol_loss = torch.mean(torch.mean(torch.mean(
+            sampled_llh, dim=0), dim=0) * pg_weight)
+
+    alpha_loss = - torch.mean(log_alpha * (sampled_llh -
+                                           np.prod(pol.ac_space.shape).item()).detach())
+    return batch, pol_loss, qf_losses, alpha_loss, td_losses
+
+
+def deterministic_sample(params, sample_shape=torch.Size()):
+    mean = params['mean']
+    return (mean + 0.1 * torch.exp(params['log_std'])).expand(
+        list(sample_shape) + list(mean.shape))
+
+
+class TestR2D2SAC(unittest.TestCase):
+    def setUp(self):
+        self.env = GymEnv('Pendulum-v0')
+
+    def losses_and_grads(self, loss_func, reparam):
+        torch.manual_seed(0)
+        ob_space, ac_space = self.env.ob_space, self.env.ac_space
+        pol = GaussianPol(ob_space, ac_space, PolNetLSTM(
+            ob_space, ac_space, h_size=16, cell_size=8), rnn=True)
+        pol.pd.sample = deterministic_sample
+        qfs = [DeterministicSAVfunc(ob_space, ac_space, QNetLSTM(
+            ob_space, ac_space, h_size=16, cell_size=8), rnn=True) for _ in range(2)]
+        targ_qfs = [copy.deepcopy(qf) for qf in qfs]
+        log_alpha = torch.zeros(1, requires_grad=True)
+
+        time_seq, batch_size, cell_size = 9, 4, 8
+        batch = dict(obs=torch.randn(time_seq, batch_size, 3),
+                     acs=torch.randn(time_seq, batch_size, 1),
+                     rews=torch.randn(time_seq, batch_size),
+                     next_obs=torch.randn(time_seq, batch_size, 3),
+                     dones=(torch.rand(time_seq, batch_size) > 0.8).float(),
+                     h_masks=(torch.rand(time_seq, batch_size) > 0.7).float(),
+                     hs=torch.randn(time_seq, batch_size, 2, cell_size))
+        for i in range(len(qfs)):
+            batch['q_hs' + str(i)] = torch.randn(
+                time_seq, batch_size, 2, cell_size)
+            batch['targ_q_hs' + str(i)] = torch.randn(
+                time_seq, batch_size, 2, cell_size)
+
+        _, pol_loss, qf_losses, alpha_loss, td_losses = loss_func(
+            pol, qfs, targ_qfs, log_alpha, batch, 0.99, sampling=2, burn_in_length=3, reparam=reparam)
+        pol_grads = torch.autograd.grad(
+            pol_loss, list(pol.parameters()), retain_graph=True)
+        qf_grads = [torch.autograd.grad(qf_loss, list(qf.parameters()), retain_graph=True)
+                    for qf_loss, qf in zip(qf_losses, qfs)]
+        return pol_loss, qf_losses, alpha_loss, td_losses, pol_grads, qf_grads
+
+    def test_same_as_loop(self):
+        for reparam in [True, False]:
+            new = self.losses_and_grads(lf.r2d2_sac, reparam)
+            old = self.losses_and_grads(r2d2_sac_loop, reparam)
+            pol_loss, qf_losses, alpha_loss, td_losses, pol_grads, qf_grads = new
+            self.assertAlmostEqual(pol_loss.item(), old[0].item(), places=5)
+            for qf_loss, old_qf_loss in zip(qf_losses, old[1]):
+                self.assertAlmostEqual(
+                    qf_loss.item(), old_qf_loss.item(), places=5)
+            self.assertAlmostEqual(alpha_loss.item(), old[2].item(), places=5)
+            np.testing.assert_allclose(
+                td_losses.detach().numpy(), old[3].detach().numpy(), atol=1e-5)
+            for grad, old_grad in zip(pol_grads, old[4]):
+                np.testing.assert_allclose(
+                    grad.numpy(), old_grad.numpy(), atol=1e-5)
+            for grads, old_grads in zip(qf_grads, old[5]):
+                for grad, old_grad in zip(grads, old_grads):
+                    np.testing.assert_allclose(
+                        grad.numpy(), old_grad.numpy(), atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
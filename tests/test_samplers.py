@@ -0,0 +1,295 @@
+"""
+Test script for samplers.
+"""
+
+import copy
+import unittest
+
+import gym
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from machina.pols import GaussianPol, CategoricalPol, MPCPol
+from machina.envs import GymEnv
+from machina.traj import Traj
+from machina.traj import epi_functional as ef
+from machina.samplers import EpiSampler, VecEpiSampler
+from machina.samplers.epi_recorder import EpiRecorder
+from machina.samplers.vec_epi_sampler import vec_epis
+from machina.samplers.shared_epi_buffer import SharedEpiWriter, SharedEpiReader
+from machina.samplers.shared_params import SharedParams
+
+from simple_net import ModelNet, PolNet, PolNetLSTM
+
+
+class TestVecEpiSampler(unittest.TestCase):
+    def setUp(self):
+        self.env = GymEnv('Pendulum-v0')
+
+    def test_sample(self):
+        pol_net = PolNet(self.env.ob_space, self.env.ac_space, h1=32, h2=32)
+        pol = GaussianPol(self.env.ob_space, self.env.ac_space, pol_net)
+
+        sampler = VecEpiSampler(self.env, pol, num_parallel=1, num_envs=3)
+
+        epis = sampler.sample(pol, max_steps=32)
+        self.assertEqual(len(epis), 3)
+        for epi in epis:
+            self.assertEqual(epi['obs'].shape, (len(epi['rews']), 3))
+            self.assertEqual(epi['acs'].shape, (len(epi['rews']), 1))
+            self.assertEqual(epi['a_is']['mean'].shape,
+                             (len(epi['rews']), 1))
+        # copied envs are seeded differently
+        self.assertFalse(np.allclose(epis[0]['obs'][0], epis[1]['obs'][0]))
+
+        epis = sampler.sample(pol, max_epis=2, deterministic=True)
+        self.assertEqual(len(epis), 2)
+
+        traj = Traj()
+        traj.add_epis(epis)
+        traj = ef.compute_h_masks(traj)
+        traj.register_epis()
+
+        del sampler
+
+    def test_prepro(self):
+        # prepro which changes shape and dtype of observations
+        def prepro(ob):
+            return ob[:2].astype(np.float64)
+        ob_space = gym.spaces.Box(-1, 1, (2, ), dtype=np.float32)
+        pol_net = PolNet(ob_space, self.env.ac_space, h1=32, h2=32)
+        pol = GaussianPol(ob_space, self.env.ac_space, pol_net)
+
+        # with 2 envs and 3 episodes, the second env is finished while the first one runs.
+        # with 3 envs and 2 episodes, the third env is never active.
+        for num_envs, max_epis in [(2, 3), (3, 2)]:
+            envs = [copy.deepcopy(self.env) for _ in range(num_envs)]
+            n_steps_global = torch.tensor(0, dtype=torch.long)
+            n_epis_global = torch.tensor(0, dtype=torch.long)
+            epis = []
+            for l, epi in vec_epis(envs, pol, 10000, max_epis, n_steps_global, n_epis_global, prepro=prepro):
+                n_steps_global += l
+                n_epis_global += 1
+                epis.append(epi)
+            self.assertEqual(len(epis), max_epis)
+            for epi in epis:
+                self.assertEqual(epi['obs'].shape, (len(epi['rews']), 2))
+
+    def test_mpc_warm_start(self):
+        def rew_func(next_obs, acs, mean_obs=0., std_obs=1., mean_acs=0., std_acs=1.):
+            return -torch.sum(acs ** 2, dim=-1)
+        dm_net = ModelNet(self.env.ob_space, self.env.ac_space, 16, 16)
+        pol = MPCPol(self.env.ob_space, self.env.ac_space, dm_net, rew_func,
+                     8, 3, method='cem', warm_start=True)
+        self.assertFalse(pol.rnn)
+        # initial means of planning in each call
+        means = []
+        _sample = pol._sample
+
+        def sample(buf, mean, std):
+            means.append(mean.clone())
+            _sample(buf, mean, std)
+        pol._sample = sample
+
+        envs = [copy.deepcopy(self.env) for _ in range(2)]
+        n_steps_global = torch.tensor(0, dtype=torch.long)
+        n_epis_global = torch.tensor(0, dtype=torch.long)
+        epis = []
+        for l, epi in vec_epis(envs, pol, 10000, 3, n_steps_global, n_epis_global):
+            n_steps_global += l
+            n_epis_global += 1
+            epis.append(epi)
+        self.assertEqual(len(epis), 3)
+
+        # the first env is reset and the plan of the previous episode is discarded
+        reset_step = len(epis[0]['rews'])
+        self.assertFalse(torch.all(means[reset_step - 1][:, 0] == 0))
+        self.assertTrue(torch.all(means[reset_step][:, 0] == 0))
+
+    def test_sample_rnn(self):
+        pol_net = PolNetLSTM(
+            self.env.ob_space, self.env.ac_space, h_size=32, cell_size=32)
+        pol = GaussianPol(self.env.ob_space,
+                          self.env.ac_space, pol_net, rnn=True)
+
+        sampler = VecEpiSampler(self.env, pol, num_parallel=1, num_envs=2)
+
+        epis = sampler.sample(pol, max_steps=32)
+        self.assertEqual(len(epis), 2)
+        for epi in epis:
+            self.assertEqual(epi['a_is']['hs'].shape,
+                             (len(epi['rews']), 2, 32))
+
+        del sampler
+
+    def test_sample_discrete(self):
+        env = GymEnv('CartPole-v0')
+        pol_net = PolNet(env.ob_space, env.ac_space, h1=32, h2=32)
+        pol = CategoricalPol(env.ob_space, env.ac_space, pol_net)
+
+        sampler = VecEpiSampler(env, pol, num_parallel=1, num_envs=4)
+
+        epis = sampler.sample(pol, max_steps=64)
+        self.assertGreaterEqual(sum([len(epi['rews']) for epi in epis]), 64)
+        for epi in epis:
+            self.assertEqual(epi['a_is']['pi'].shape, (len(epi['rews']), 2))
+
+        del sampler
+
+
+class TestEpiSamplerAsync(unittest.TestCase):
+    def setUp(self):
+        self.env = GymEnv('Pendulum-v0')
+
+    def test_async(self):
+        pol_net = PolNet(self.env.ob_space, self.env.ac_space, h1=32, h2=32)
+        pol = GaussianPol(self.env.ob_space, self.env.ac_space, pol_net)
+
+        sampler = EpiSampler(self.env, pol, num_parallel=2)
+
+        sampler.start_async(pol, max_epis=2)
+        with self.assertRaises(RuntimeError):
+            sampler.sample(pol, max_epis=1)
+
+        epis = sampler.get_epis(max_epis=3)
+        self.assertEqual(len(epis), 3)
+        for epi in epis:
+            self.assertEqual(epi['pol_version'], 1)
+
+        version = sampler.publish(pol)
+        self.assertEqual(version, 2)
+        epis = sampler.get_epis(max_steps=1000)
+        self.assertGreaterEqual(sum([len(epi['rews']) for epi in epis]), 1000)
+
+        traj = Traj()
+        traj.add_epis(epis)
+        traj = ef.add_next_obs(traj)
+        traj.register_epis()
+
+        sampler.stop_async()
+        epis = sampler.sample(pol, max_epis=1)
+        self.assertGreaterEqual(len(epis), 1)
+
+        class Sink(object):
+            def __init__(self):
+                self.epis = []
+
+            def write(self, epi):
+                self.epis.append(epi)
+        sink = Sink()
+        sampler.add_sink(sink)
+        epis = sampler.sample(pol, max_epis=1)
+        self.assertEqual(len(sink.epis), len(epis))
+
+        del sampler
+
+
+class TestSharedEpiBuffer(unittest.TestCase):
+    def test_write_and_read(self):
+        epi_queue = mp.Queue()
+        writer = SharedEpiWriter(epi_queue, 0, buffer_size=5)
+        reader = SharedEpiReader()
+
+        epis = []
+        for length in [3, 4, 9, 1]:
+            epi = dict(
+                obs=np.random.rand(length, 3).astype('float32'),
+                acs=np.random.rand(length, 1).astype('float32'),
+                rews=np.random.rand(length).astype('float32'),
+                dones=np.zeros(length, dtype='float32'),
+                a_is=dict(hs=np.random.rand(length, 2, 4).astype('float32')),
+                e_is=dict()
+            )
+            epis.append(epi)
+            writer.write(epi)
+        writer.finish()
+
+        read_epis = []
+        while True:
+            msg = epi_queue.get()
+            if msg[0] == 'finish':
+                break
+            epi = reader.read(msg)
+            if epi is not None:
+                read_epis.append(epi)
+
+        self.assertEqual(len(read_epis), len(epis))
+        for epi, read_epi in zip(epis, read_epis):
+            for key in ['obs', 'acs', 'rews', 'dones']:
+                np.testing.assert_array_equal(epi[key], read_epi[key])
+            np.testing.assert_array_equal(
+                epi['a_is']['hs'], read_epi['a_is']['hs'])
+
+    def test_dtype_and_size(self):
+        epi_queue = mp.Queue()
+        writer = SharedEpiWriter(epi_queue, 0)
+        reader = SharedEpiReader()
+
+        # uint8 observations are kept by recorder and others are float32
+        recorder = EpiRecorder(init_size=4)
+        for _ in range(6):
+            recorder.record('obs', np.random.randint(
+                256, size=(4, 4), dtype=np.uint8))
+            recorder.record('acs', np.random.rand(1))
+            recorder.record('rews', np.random.rand())
+            recorder.record('dones', False)
+            recorder.next_step()
+        epi = recorder.get_epi()
+        self.assertEqual(epi['obs'].dtype, np.uint8)
+        self.assertEqual(epi['acs'].dtype, np.float32)
+        self.assertEqual(epi['dones'].dtype, np.float32)
+        writer.write(epi)
+        # buffers are sized by the first episode and keep dtypes
+        self.assertEqual(writer.buffer_size, 6)
+        self.assertEqual(writer.data_map['obs'].dtype, torch.uint8)
+        writer.write(epi)
+        self.assertEqual(writer.buffer_size, 12)
+        writer.finish()
+
+        read_epis = []
+        while True:
+            msg = epi_queue.get()
+            if msg[0] == 'finish':
+                break
+            read_epi = reader.read(msg)
+            if read_epi is not None:
+                read_epis.append(read_epi)
+        self.assertEqual(len(read_epis), 2)
+        for read_epi in read_epis:
+            self.assertEqual(read_epi['obs'].dtype, np.uint8)
+            np.testing.assert_array_equal(epi['obs'], read_epi['obs'])
+
+
+class TestSharedParams(unittest.TestCase):
+    def test_publish(self):
+        env = GymEnv('Pendulum-v0')
+        pol_net = PolNetLSTM(env.ob_space, env.ac_space,
+                             h_size=32, cell_size=32)
+        sampler_net = PolNetLSTM(
+            env.ob_space, env.ac_space, h_size=32, cell_size=32)
+        shared_params = SharedParams(sampler_net)
+
+        self.assertTrue(shared_params.publish(pol_net, version=1))
+        for p, sp in zip(pol_net.parameters(), sampler_net.parameters()):
+            np.testing.assert_array_equal(
+                p.detach().numpy(), sp.detach().numpy())
+
+        with torch.no_grad():
+            for p in pol_net.parameters():
+                p.add_(1)
+        self.assertFalse(shared_params.publish(pol_net, version=1))
+        self.assertTrue(shared_params.publish(pol_net, version=2))
+        for p, sp in zip(pol_net.parameters(), sampler_net.parameters()):
+            np.testing.assert_array_equal(
+                p.detach().numpy(), sp.detach().numpy())
+
+        half_params = SharedParams(sampler_net, half=True)
+        half_params.publish(pol_net)
+        for p, sp in zip(pol_net.parameters(), sampler_net.parameters()):
+            np.testing.assert_allclose(
+                p.detach().numpy(), sp.detach().numpy(), rtol=1e-3, atol=1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()
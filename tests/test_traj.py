@@ -0,0 +1,567 @@
+"""
+Test script for traj.
+"""
+
+import copy
+import functools
+import os
+import shutil
+import tempfile
+import unittest
+
+import gym
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+
+from machina import loss_functional as lf
+from machina.pols import GaussianPol
+from machina.traj import Traj
+from machina.traj import epi_file
+from machina.traj import epi_functional as ef
+from machina.traj import traj_functional as tf
+from machina.vfuncs import DeterministicSAVfunc, DeterministicSVfunc
+
+from simple_net import DiscrimNet, PolNet, QNet, QNetLSTM, VNet, VNetLSTM
+
+
+def make_traj(lengths, start):
+    traj = Traj()
+    num_step = sum(lengths)
+    steps = torch.arange(start, start + num_step, dtype=torch.float)
+    traj.data_map = dict(obs=steps.reshape(-1, 1).repeat(1, 3), rews=steps,
+                         pris=torch.ones(num_step))
+    traj._epis_index = np.concatenate([[0], np.cumsum(lengths)])
+    return traj
+
+
+def make_epis(lengths, ob_space, ac_space):
+    epis = []
+    for l in lengths:
+        obs = np.random.randn(l + 1, ob_space.shape[0]).astype('float32')
+        epis.append(dict(obs=obs[:-1], next_obs=obs[1:],
+                         acs=np.random.randn(
+                             l, ac_space.shape[0]).astype('float32'),
+                         rews=np.random.randn(l).astype('float32'),
+                         dones=np.eye(l, dtype='float32')[-1]))
+    return epis
+
+
+def iterate_rnn_loop(traj, batch_size, num_epi_per_seq=1, epoch=1):
+    """
+    Batches of the loop implementation before iterate_rnn gathered them at once.
+    """
+    for _ in range(epoch):
+        epi_count = 0
+        all_batch = []
+        seq = []
+        for idx in np.random.permutation(range(traj.num_epi)):
+            start, end = traj._epis_index[idx], traj._epis_index[idx+1]
+            seq.append(dict([(key, value[start:end])
+                             for key, value in traj.data_map.items()]))
+            epi_count += 1
+            if epi_count >= num_epi_per_seq:
+                _seq = dict()
+                for key in seq[0].keys():
+                    _seq[key] = torch.cat([s[key] for s in seq])
+                all_batch.append(_seq)
+                seq = []
+                epi_count = 0
+        num_batch = len(all_batch)
+        idx = 0
+        while idx <= num_batch - batch_size:
+            cur_batch_size = min(batch_size, num_batch - idx)
+            batch = all_batch[idx:idx+cur_batch_size]
+            idx += cur_batch_size
+
+            lengths = [list(b.values())[0].size(0) for b in batch]
+            max_length = max(lengths)
+            out_masks = torch.ones(
+                (max_length, cur_batch_size), dtype=torch.float)
+            time_slice = list(functools.reduce(
+                lambda x, y: x+y, [list(range(l, max_length)) for l in lengths]))
+            batch_idx = list(functools.reduce(
+                lambda x, y: x+y, [(max_length - l) * [i] for i, l in enumerate(lengths)]))
+            out_masks[time_slice, batch_idx] = 0
+
+            _batch = dict()
+            keys = batch[0].keys()
+            for key in keys:
+                _batch[key] = pad_sequence([b[key] for b in batch])
+            _batch['out_masks'] = out_masks
+            yield _batch
+
+
+def mapped_files(tensor):
+    """
+    Files which are mapped on the memory of tensor.
+    """
+    address = tensor.data_ptr()
+    files = []
+    with open('/proc/self/maps') as f:
+        for line in f:
+            fields = line.split()
+            start, end = [int(a, 16) for a in fields[0].split('-')]
+            if start <= address < end and len(fields) >= 6:
+                files.append(fields[5])
+    return files
+
+
+class TestTraj(unittest.TestCase):
+    def test_add_traj(self):
+        traj = Traj()
+        start = 0
+        for lengths in [[3, 4], [5], [2, 2, 2]]:
+            traj.add_traj(make_traj(lengths, start))
+            start += sum(lengths)
+        np.testing.assert_array_equal(
+            traj.data_map['rews'].numpy(), np.arange(start))
+        np.testing.assert_array_equal(
+            traj._epis_index, [0, 3, 7, 12, 14, 16, 18])
+
+    def test_add_traj_ring(self):
+        traj = Traj(max_steps=20)
+        start = 0
+        for _ in range(30):
+            lengths = list(np.random.randint(1, 8, size=2))
+            traj.add_traj(make_traj(lengths, start))
+            start += sum(lengths)
+
+            self.assertLessEqual(traj.num_step, 20)
+            rews = traj.data_map['rews'].numpy()
+            self.assertEqual(len(rews), traj.num_step)
+            self.assertEqual(rews.max(), start - 1)
+            self.assertEqual(len(np.unique(rews)), len(rews))
+            # steps in an episode are not split
+            for s, e in zip(traj._epis_index[:-1], traj._epis_index[1:]):
+                np.testing.assert_array_equal(np.diff(rews[s:e]), 1)
+
+        batch = traj.random_batch_once(8)
+        np.testing.assert_array_equal(
+            batch['obs'][:, 0].numpy(), batch['rews'].numpy())
+
+        with self.assertRaises(ValueError):
+            traj.add_traj(make_traj([21], start))
+
+    def test_prioritized_random_batch(self):
+        traj = Traj(max_steps=20)
+        start = 0
+        for _ in range(10):
+            lengths = list(np.random.randint(1, 8, size=2))
+            traj.add_traj(make_traj(lengths, start))
+            start += sum(lengths)
+            batch, indices = traj.prioritized_random_batch_once(
+                8, return_indices=True)
+            np.testing.assert_array_equal(
+                batch['rews'].numpy(), traj.data_map['rews'][indices].numpy())
+            traj = tf.update_pris(traj, torch.rand(8), indices)
+
+            # tree is updated incrementally as well as rebuilt one
+            tree = traj._pri_tree
+            pris = traj.data_map['pris'].numpy()
+            self.assertAlmostEqual(tree.total(), pris.sum(), places=4)
+            self.assertAlmostEqual(tree.min(), pris.min(), places=6)
+            np.testing.assert_allclose(
+                tree.get(np.arange(traj.num_step)), pris, rtol=1e-6)
+            self.assertEqual(batch['is_weights'].shape, (8, ))
+            self.assertLessEqual(batch['is_weights'].max().item(), 1 + 1e-6)
+
+    def test_rank_based_random_batch(self):
+        traj = Traj(max_steps=20)
+        traj.add_traj(make_traj([5, 7, 4], 0))
+        for _ in range(3):
+            pris = traj.data_map['pris'].numpy()
+            probs = (np.argsort(-pris).astype(np.float32) + 1) ** -0.6
+            probs = probs / probs.sum()
+
+            np.random.seed(0)
+            expected = np.random.choice(len(probs), 8, p=probs)
+            np.random.seed(0)
+            batch, indices = traj.prioritized_random_batch_once(
+                8, return_indices=True, mode='rank_based')
+            np.testing.assert_array_equal(indices.numpy(), expected)
+            np.testing.assert_array_equal(
+                batch['rews'].numpy(), traj.data_map['rews'][indices].numpy())
+
+            # probabilities are cached until priorities are updated
+            cached = traj._rank_probs
+            traj.prioritized_random_batch_once(8, mode='rank_based')
+            self.assertIs(traj._rank_probs, cached)
+            traj = tf.update_pris(traj, torch.rand(8), indices)
+
+    def test_on_host(self):
+        traj = Traj(max_steps=20, on_host=True)
+        start = 0
+        for _ in range(5):
+            lengths = list(np.random.randint(1, 8, size=2))
+            traj.add_traj(make_traj(lengths, start))
+            start += sum(lengths)
+        self.assertEqual(traj.data_map['rews'].device.type, 'cpu')
+
+        batches = list(traj.prefetch(traj.random_batch(8, epoch=5)))
+        self.assertEqual(len(batches), 5)
+        for batch in batches:
+            np.testing.assert_array_equal(
+                batch['obs'][:, 0].cpu().numpy(), batch['rews'].cpu().numpy())
+
+        # iteration can be stopped while batches are prepared
+        for batch in traj.prefetch(traj.random_batch(8, epoch=100)):
+            break
+
+    def test_dtypes(self):
+        epis = [dict(obs=np.random.randint(0, 256, (l, 3)), rews=np.random.randn(l),
+                     dones=np.arange(l) == l - 1) for l in [4, 6]]
+        dtypes = dict(obs=torch.uint8, dones=torch.bool)
+        on_traj = Traj()
+        on_traj.add_epis(epis)
+        on_traj.register_epis()
+        traj = Traj(dtypes=dtypes)
+        traj.add_traj(on_traj)
+        self.assertEqual(traj.data_map['obs'].dtype, torch.uint8)
+        self.assertEqual(traj.data_map['dones'].dtype, torch.bool)
+
+        batch = next(traj.random_batch_rnn(4, seq_length=5))
+        for key in ['obs', 'rews', 'dones']:
+            self.assertEqual(batch[key].dtype, torch.float)
+        batch, indices = traj.random_batch_once(5, return_indices=True)
+        for key in ['obs', 'rews', 'dones']:
+            self.assertEqual(batch[key].dtype, torch.float)
+            np.testing.assert_array_equal(
+                batch[key].numpy(), on_traj.data_map[key][indices[:5]].numpy())
+
+    def test_virtual_next_obs(self):
+        epis = [dict(obs=np.random.randn(l, 3), rews=np.random.randn(l))
+                for l in [4, 1, 7, 3]]
+        on_traj = Traj()
+        on_traj.add_epis(epis)
+        on_traj = ef.add_next_obs(on_traj)
+        on_traj.register_epis()
+        traj = Traj(virtual_next_obs=True)
+        traj.add_traj(on_traj)
+        self.assertNotIn('next_obs', traj.data_map)
+
+        batch = next(traj.full_batch())
+        np.testing.assert_array_equal(
+            batch['next_obs'].numpy(), on_traj.data_map['next_obs'].numpy())
+        torch.manual_seed(0)
+        np.random.seed(0)
+        batch = next(traj.random_batch_rnn(4, seq_length=5))
+        torch.manual_seed(0)
+        np.random.seed(0)
+        expected = next(on_traj.random_batch_rnn(4, seq_length=5))
+        np.testing.assert_array_equal(
+            batch['next_obs'].numpy(), expected['next_obs'].numpy())
+
+    def test_random_batch_rnn(self):
+        traj = make_traj([5, 12, 3, 8], 0)
+        batch = next(traj.random_batch_rnn(16, seq_length=6))
+        self.assertEqual(batch['obs'].shape, (6, 16, 3))
+        rews = batch['rews'].numpy()
+        out_masks = batch['out_masks'].numpy()
+        for i in range(16):
+            length = int(out_masks[:, i].sum())
+            # steps are consecutive in an episode and 0 after it
+            np.testing.assert_array_equal(np.diff(rews[:length, i]), 1)
+            np.testing.assert_array_equal(rews[length:, i], 0)
+            start = rews[0, i]
+            epi = np.searchsorted(traj._epis_index, start, side='right') - 1
+            self.assertLessEqual(start + length, traj._epis_index[epi+1])
+            self.assertEqual(length, min(
+                6, traj._epis_index[epi+1] - traj._epis_index[epi]))
+
+    def test_iterate_rnn(self):
+        traj = make_traj([5, 12, 3, 8, 1, 6, 4], 0)
+        for batch_size, num_epi_per_seq in [(2, 1), (3, 2), (1, 3)]:
+            np.random.seed(0)
+            batches = list(traj.iterate_rnn(
+                batch_size, num_epi_per_seq, epoch=2))
+            np.random.seed(0)
+            loop_batches = list(iterate_rnn_loop(
+                traj, batch_size, num_epi_per_seq, epoch=2))
+            self.assertEqual(len(batches), len(loop_batches))
+            for batch, loop_batch in zip(batches, loop_batches):
+                self.assertEqual(set(batch.keys()), set(loop_batch.keys()))
+                for key in loop_batch:
+                    np.testing.assert_array_equal(
+                        batch[key].numpy(), loop_batch[key].numpy())
+
+    def test_update_seq_pris(self):
+        lengths = [20, 3, 15, 9]
+        epis = [dict(rews=np.zeros(l, dtype='float32'), pris=np.random.rand(
+            l).astype('float32')) for l in lengths]
+        traj = Traj()
+        traj.add_epis(epis)
+        traj = ef.compute_seq_pris(traj, 4)
+        traj.register_epis()
+        batched_traj = copy.deepcopy(traj)
+
+        starts = torch.tensor([0, 5, 23, 30, 38])
+        td_losses = torch.randn(3, len(starts))
+        for i, start in enumerate(starts):
+            traj = tf.update_pris(traj, td_losses[:, i], torch.arange(
+                start, start + 3), update_epi_pris=True, seq_length=4)
+        batched_traj = tf.update_pris(batched_traj, td_losses, torch.arange(
+            3).unsqueeze(1) + starts, update_epi_pris=True, seq_length=4)
+
+        for key in ['pris', 'seq_pris']:
+            np.testing.assert_allclose(
+                traj.data_map[key].numpy(), batched_traj.data_map[key].numpy(), rtol=1e-6)
+        # sequences crossing the end of episode are not sampled
+        self.assertEqual(traj.data_map['seq_pris'][17:23].sum().item(), 0)
+
+
+class TestEpiFunctional(unittest.TestCase):
+    def test_compute_rets_and_advs(self):
+        gamma = 0.99
+        lam = 0.95
+        epis = [dict(rews=np.random.randn(l).astype('float32'),
+                     vs=np.random.randn(l).astype('float32')) for l in [1, 5, 30, 2]]
+        traj = Traj()
+        traj.add_epis(epis)
+        traj = ef.compute_rets(traj, gamma)
+        traj = ef.compute_advs(traj, gamma, lam)
+
+        for epi in epis:
+            rews = epi['rews']
+            vs = np.append(epi['vs'], 0)
+            rets = np.empty(len(rews), dtype=np.float32)
+            advs = np.empty(len(rews), dtype=np.float32)
+            last_rew = 0
+            last_gaelam = 0
+            for t in reversed(range(len(rews))):
+                rets[t] = last_rew = rews[t] + gamma * last_rew
+                delta = rews[t] + gamma * vs[t + 1] - vs[t]
+                advs[t] = last_gaelam = delta + gamma * lam * last_gaelam
+            np.testing.assert_array_equal(epi['rets'], rets)
+            np.testing.assert_array_equal(epi['advs'], advs)
+
+        rews = torch.tensor(np.concatenate([epi['rews'] for epi in epis]))
+        rets = ef.discounted_cumsum(rews, gamma, [0, 1, 6, 36, 38])
+        np.testing.assert_allclose(rets.numpy(), np.concatenate(
+            [epi['rets'] for epi in epis]), rtol=1e-5, atol=1e-5)
+
+    def test_discounted_cumsum_long_epis(self):
+        # a few long episodes are computed by the segmented scan
+        gamma = 0.99
+        lengths = [300, 2, 1000]
+        epis_index = np.concatenate([[0], np.cumsum(lengths)])
+        rews = np.random.randn(epis_index[-1])
+        rets = np.empty_like(rews)
+        for start, end in zip(epis_index[:-1], epis_index[1:]):
+            last_rew = 0
+            for t in reversed(range(start, end)):
+                rets[t] = last_rew = rews[t] + gamma * last_rew
+        np.testing.assert_allclose(
+            ef.discounted_cumsum(rews, gamma, epis_index), rets, atol=1e-10)
+        np.testing.assert_allclose(ef.discounted_cumsum(
+            torch.tensor(rews), gamma, epis_index).numpy(), rets, atol=1e-10)
+
+    def test_batched_same_as_loop(self):
+        # episodes of different lengths are evaluated at once or by chunks
+        torch.manual_seed(0)
+        ob_space = gym.spaces.Box(-1, 1, (3, ), dtype=np.float32)
+        ac_space = gym.spaces.Box(-1, 1, (2, ), dtype=np.float32)
+        lengths = [1, 5, 12, 3]
+        vf = DeterministicSVfunc(ob_space, VNet(ob_space, 16, 16))
+        rnn_vf = DeterministicSVfunc(
+            ob_space, VNetLSTM(ob_space, 16, 8), rnn=True)
+        qf = DeterministicSAVfunc(
+            ob_space, ac_space, QNet(ob_space, ac_space, 16, 16))
+        targ_qf = DeterministicSAVfunc(
+            ob_space, ac_space, QNet(ob_space, ac_space, 16, 16))
+        pol = GaussianPol(ob_space, ac_space, PolNet(
+            ob_space, ac_space, 16, 16))
+        # next actions hardly depend on sampling noise
+        pol.net.log_std_param.data.fill_(-20)
+        discrim = DeterministicSAVfunc(
+            ob_space, ac_space, DiscrimNet(ob_space, ac_space, 16, 16))
+
+        with torch.no_grad():
+            loop_vs, loop_rnn_vs, loop_pris, loop_rews = [], [], [], []
+            epis = make_epis(lengths, ob_space, ac_space)
+            for epi in epis:
+                batch = dict([(key, torch.tensor(value))
+                              for key, value in epi.items()])
+                loop_vs.append(vf(batch['obs'])[0].numpy())
+                rnn_vf.reset()
+                loop_rnn_vs.append(
+                    rnn_vf(batch['obs'].unsqueeze(1))[0].numpy())
+                bellman_loss = lf.bellman(
+                    qf, targ_qf, pol, batch, 0.99, reduction='none')
+                loop_pris.append(
+                    ((torch.sqrt(bellman_loss*2) + 1e-6) ** 0.6).numpy())
+                logits, _ = discrim(batch['obs'], batch['acs'])
+                loop_rews.append(-F.logsigmoid(-logits).numpy())
+
+        for batch_size in [None, 2]:
+            _epis = copy.deepcopy(epis)
+            traj = Traj()
+            traj.add_epis(_epis)
+            traj = ef.compute_pris(
+                traj, qf, targ_qf, pol, 0.99, batch_size=batch_size)
+            traj = ef.compute_vs(traj, vf, batch_size=batch_size)
+            for epi, v, pri in zip(_epis, loop_vs, loop_pris):
+                np.testing.assert_allclose(epi['vs'], v, rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(
+                    epi['pris'], pri, rtol=1e-5, atol=1e-6)
+            traj = ef.compute_vs(traj, rnn_vf, batch_size=batch_size)
+            for epi, v in zip(_epis, loop_rnn_vs):
+                np.testing.assert_allclose(epi['vs'], v, rtol=1e-5, atol=1e-6)
+            traj = ef.compute_pseudo_rews(
+                traj, discrim, batch_size=batch_size)
+            for epi, _epi, rew in zip(epis, _epis, loop_rews):
+                np.testing.assert_allclose(
+                    _epi['rews'], rew, rtol=1e-5, atol=1e-6)
+                np.testing.assert_array_equal(_epi['real_rews'], epi['rews'])
+
+    def test_compute_hs(self):
+        torch.manual_seed(0)
+        ob_space = gym.spaces.Box(-1, 1, (3, ), dtype=np.float32)
+        ac_space = gym.spaces.Box(-1, 1, (2, ), dtype=np.float32)
+        vf = DeterministicSVfunc(
+            ob_space, VNetLSTM(ob_space, 16, 8), rnn=True)
+        qf = DeterministicSAVfunc(
+            ob_space, ac_space, QNetLSTM(ob_space, ac_space, 16, 8), rnn=True)
+        epis = make_epis([4, 1, 7, 2, 5], ob_space, ac_space)
+        # all episodes start from the same observation
+        for epi in epis:
+            epi['obs'][0] = epis[0]['obs'][0]
+            epi['acs'][0] = epis[0]['acs'][0]
+
+        # each episode is computed from initial hidden state one by one
+        loop_hs, loop_q_hs = [], []
+        with torch.no_grad():
+            for epi in epis:
+                obs = torch.tensor(epi['obs']).unsqueeze(1)
+                acs = torch.tensor(epi['acs']).unsqueeze(1)
+                vf.reset()
+                loop_hs.append(np.array([[h.squeeze().numpy() for h in vf(obs[i:i+1])[-1]['hs']]
+                                         for i in range(len(obs))]))
+                qf.reset()
+                loop_q_hs.append(np.array([[h.squeeze().numpy() for h in qf(obs[i:i+1], acs[i:i+1])[-1]['hs']]
+                                           for i in range(len(obs))]))
+
+        for batch_size in [None, 2]:
+            _epis = copy.deepcopy(epis)
+            traj = Traj()
+            traj.add_epis(_epis)
+            traj = ef.compute_hs(traj, vf, batch_size=batch_size)
+            traj = ef.compute_hs(
+                traj, qf, hs_name='q_hs', input_acs=True, batch_size=batch_size)
+            for epi, hs, q_hs in zip(_epis, loop_hs, loop_q_hs):
+                self.assertEqual(epi['hs'].shape, (len(epi['obs']), 2, 8))
+                np.testing.assert_allclose(
+                    epi['hs'], hs, rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(
+                    epi['q_hs'], q_hs, rtol=1e-5, atol=1e-6)
+                # hidden state is reset at the start of every episode
+                np.testing.assert_allclose(
+                    epi['hs'][0], _epis[0]['hs'][0], rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(
+                    epi['q_hs'][0], _epis[0]['q_hs'][0], rtol=1e-5, atol=1e-6)
+
+
+class TestEpiFile(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_save_and_load(self):
+        epis = [dict(obs=np.random.randn(l, 3), acs=np.random.randn(l, 2),
+                     rews=np.random.randn(l),
+                     e_is=dict(means=np.random.randn(l, 2)))
+                for l in [4, 1, 7]]
+        epi_file.save_epis(epis, self.dirname)
+
+        loaded_epis = epi_file.load_epis(self.dirname)
+        self.assertEqual(len(loaded_epis), 3)
+        for epi, loaded_epi in zip(epis, loaded_epis):
+            np.testing.assert_allclose(
+                loaded_epi['obs'], epi['obs'], rtol=1e-6)
+            np.testing.assert_allclose(
+                loaded_epi['e_is']['means'], epi['e_is']['means'], rtol=1e-6)
+
+        traj = Traj()
+        traj.add_epis(epis)
+        traj = ef.add_next_obs(traj)
+        traj.register_epis()
+        loaded_traj = epi_file.load_traj(self.dirname)
+        loaded_traj = tf.add_next_obs(loaded_traj)
+        np.testing.assert_array_equal(
+            loaded_traj._epis_index, traj._epis_index)
+        self.assertEqual(set(loaded_traj.data_map), set(traj.data_map))
+        for key in traj.data_map:
+            np.testing.assert_array_equal(
+                loaded_traj.data_map[key].numpy(), traj.data_map[key].numpy())
+
+        # data_map can be modified without changing files
+        loaded_traj.data_map['rews'][:] = 0
+        np.testing.assert_allclose(
+            epi_file.load_epis(self.dirname)[0]['rews'], epis[0]['rews'], rtol=1e-6)
+
+        test_traj = epi_file.load_traj(self.dirname, start_epi=1)
+        np.testing.assert_array_equal(test_traj._epis_index, [0, 1, 8])
+        np.testing.assert_array_equal(
+            test_traj.data_map['obs'].numpy(), traj.data_map['obs'][4:].numpy())
+
+    def test_writer(self):
+        epis = [dict(obs=np.random.randn(l, 3), rews=np.random.randn(l), pol_version=1)
+                for l in [4, 1, 7, 3, 5]]
+        writer = epi_file.EpiWriter(self.dirname, chunk_steps=6)
+        for epi in epis[:4]:
+            writer.write(epi)
+        writer.close()
+        # a chunk left by a crash is removed and writing is appended
+        os.mkdir(os.path.join(self.dirname, 'chunk_000002.tmp'))
+        writer = epi_file.EpiWriter(self.dirname, chunk_steps=6)
+        writer.write(epis[4])
+        writer.close()
+
+        self.assertEqual(sorted(os.listdir(self.dirname)), [
+                         'chunk_000000', 'chunk_000001', 'chunk_000002'])
+        loaded_epis = epi_file.load_epis(self.dirname)
+        self.assertEqual(len(loaded_epis), 5)
+        for epi, loaded_epi in zip(epis, loaded_epis):
+            np.testing.assert_allclose(
+                loaded_epi['obs'], epi['obs'], rtol=1e-6)
+        traj = epi_file.load_traj(self.dirname, start_epi=1)
+        np.testing.assert_array_equal(traj._epis_index, [0, 1, 8, 11, 16])
+        np.testing.assert_allclose(traj.data_map['obs'].numpy(), np.concatenate(
+            [epi['obs'] for epi in epis[1:]]), rtol=1e-6)
+        # chunks are merged into one file, which data_map is mapped on
+        merged_dirname = os.path.join(self.dirname, 'merged')
+        if os.path.exists('/proc/self/maps'):
+            self.assertIn(os.path.join(merged_dirname, 'obs.npy'),
+                          mapped_files(traj.data_map['obs']))
+
+        # merged directory is reused until chunks are added
+        mtime = os.path.getmtime(os.path.join(merged_dirname, 'obs.npy'))
+        epi_file.load_traj(self.dirname)
+        self.assertEqual(os.path.getmtime(
+            os.path.join(merged_dirname, 'obs.npy')), mtime)
+        writer = epi_file.EpiWriter(self.dirname, chunk_steps=6)
+        writer.write(epis[0])
+        writer.close()
+        traj = epi_file.load_traj(self.dirname)
+        np.testing.assert_array_equal(
+            traj._epis_index, [0, 4, 5, 12, 15, 20, 24])
+        np.testing.assert_allclose(traj.data_map['obs'].numpy(), np.concatenate(
+            [epi['obs'] for epi in epis + epis[:1]]), rtol=1e-6)
+
+    def test_dtypes(self):
+        epis = [dict(obs=np.random.randint(0, 256, (l, 3)), rews=np.random.randn(l))
+                for l in [4, 6]]
+        epi_file.save_epis(epis, self.dirname, dtypes=dict(obs=torch.uint8))
+        traj = epi_file.load_traj(self.dirname)
+        self.assertEqual(traj.data_map['obs'].dtype, torch.uint8)
+        batch = next(traj.full_batch())
+        self.assertEqual(batch['obs'].dtype, torch.float)
+        np.testing.assert_array_equal(
+            batch['obs'].numpy(), np.concatenate([epi['obs'] for epi in epis]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+Test script for value functions.
+"""
+
+import unittest
+
+import numpy as np
+import torch
+
+from machina.envs import GymEnv
+from machina.optims import AdamW
+from machina.vfuncs import DeterministicSAVfunc, EnsembleSAVfunc
+
+from simple_net import QNet
+
+
+class TestEnsembleSAVfunc(unittest.TestCase):
+    def setUp(self):
+        self.env = GymEnv('Pendulum-v0')
+
+    def test_same_as_loop(self):
+        torch.manual_seed(0)
+        qfs = [DeterministicSAVfunc(self.env.ob_space, self.env.ac_space,
+                                    QNet(self.env.ob_space, self.env.ac_space, 32, 32)) for _ in range(3)]
+        ensemble = EnsembleSAVfunc(qfs)
+        self.assertTrue(ensemble.stackable)
+        obs = torch.randn(16, self.env.ob_space.shape[0])
+        acs = torch.randn(16, self.env.ac_space.shape[0])
+
+        optim = torch.optim.SGD(
+            [p for qf in qfs for p in qf.parameters()], 0.1)
+        for _ in range(2):
+            # forward is repeated with the same parameters
+            for _ in range(2):
+                vs, _ = ensemble(obs, acs)
+                grads = torch.autograd.grad(
+                    torch.sum(vs ** 2), list(ensemble.parameters()))
+
+            loop_vs = torch.stack([qf(obs, acs)[0] for qf in qfs])
+            loop_grads = torch.autograd.grad(
+                torch.sum(loop_vs ** 2), list(ensemble.parameters()), retain_graph=True)
+
+            np.testing.assert_allclose(
+                vs.detach().numpy(), loop_vs.detach().numpy(), atol=1e-5)
+            for grad, loop_grad in zip(grads, loop_grads):
+                np.testing.assert_allclose(
+                    grad.numpy(), loop_grad.numpy(), atol=1e-5)
+
+            # updated parameters are used after an optimizer step
+            optim.zero_grad()
+            torch.sum(loop_vs ** 2).backward()
+            optim.step()
+
+    def test_after_adamw_step(self):
+        # AdamW updates parameters through .data
+        torch.manual_seed(0)
+        qfs = [DeterministicSAVfunc(self.env.ob_space, self.env.ac_space,
+                                    QNet(self.env.ob_space, self.env.ac_space, 32, 32)) for _ in range(3)]
+        ensemble = EnsembleSAVfunc(qfs)
+        obs = torch.randn(16, self.env.ob_space.shape[0])
+        acs = torch.randn(16, self.env.ac_space.shape[0])
+
+        optim = AdamW(ensemble.parameters(), lr=0.1)
+        vs, _ = ensemble(obs, acs)
+        optim.zero_grad()
+        torch.sum(vs ** 2).backward()
+        optim.step()
+
+        vs, _ = ensemble(obs, acs)
+        loop_vs = torch.stack([qf(obs, acs)[0] for qf in qfs])
+        np.testing.assert_allclose(
+            vs.detach().numpy(), loop_vs.detach().numpy(), atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()